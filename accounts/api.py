@@ -23,6 +23,8 @@ from tastypie.models import ApiKey, create_api_key
 from tastypie.resources import ModelResource
 from tastypie.utils import trailing_slash
 
+from base.api import PrefetchRelatedMixin
+from base.paginator import KeysetPaginator
 from dataserver.authentication import AnonymousApiKeyAuthentication
 from .models import Profile, ObjectProfileLink
 
@@ -33,7 +35,7 @@ from django.http import HttpResponse,HttpResponseRedirect
 
 from django.core.mail import send_mail
 import hashlib
-class UserResource(ModelResource):
+class UserResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = User.objects.exclude(pk=-1) # Exclude anonymous user
         detail_uri_name = 'username'
@@ -47,6 +49,9 @@ class UserResource(ModelResource):
             "username": ALL_WITH_RELATIONS,
             "email" : ['exact',],
         }
+        # Used by dehydrate
+        select_related = ('profile',)
+        prefetch_related = ('groups',)
 
     # groups = fields.ToManyField('accounts.api.GroupResource', 'groups', null=True, full=False)
 
@@ -313,7 +318,7 @@ class UserResource(ModelResource):
             return self.create_response(request, {'success': False}, HttpUnauthorized)
 
 
-class GroupResource(ModelResource):
+class GroupResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = Group.objects.all()
         resource_name = 'account/group'
@@ -326,7 +331,7 @@ class GroupResource(ModelResource):
 # Create API key for every new user
 models.signals.post_save.connect(create_api_key, sender=User)
 
-class ProfileResource(ModelResource):
+class ProfileResource(PrefetchRelatedMixin, ModelResource):
     user = fields.OneToOneField(UserResource, 'user', full=True)
     avatar = fields.FileField(attribute="mugshot", null=True, blank=True)
 
@@ -351,7 +356,7 @@ class ProfileResource(ModelResource):
             return {'meta': data['meta'], 'objects' : []}
         return data
 
-class ObjectProfileLinkResource(ModelResource):
+class ObjectProfileLinkResource(PrefetchRelatedMixin, ModelResource):
     """
     Resource for linking profile with objects s.a a Project, a Category, etc.
     """
@@ -363,6 +368,7 @@ class ObjectProfileLinkResource(ModelResource):
 
     class Meta:
         queryset = ObjectProfileLink.objects.all().order_by('-created_on')
+        paginator_class = KeysetPaginator
         resource_name = 'objectprofilelink'
         authentication = AnonymousApiKeyAuthentication()
         authorization = DjangoAuthorization()
@@ -377,6 +383,7 @@ class ObjectProfileLinkResource(ModelResource):
 
         }
         always_return_data = True
+        select_related = ('content_type',)
 
 
 
@@ -1,4 +1,7 @@
 from django.conf.urls import url
+from django.db import connection
+from django.db.models.query import prefetch_related_objects
+from tastypie.bundle import Bundle
 from tastypie.resources import (
     ModelResource,
     ObjectDoesNotExist,
@@ -7,6 +10,135 @@ from tastypie.resources import (
 from tastypie.http import HttpGone, HttpMultipleChoices
 
 
+# Depth of nested resources followed by prefetch plans, for resources
+# nesting themselves (e.g. post answers)
+PREFETCH_MAX_DEPTH = 4
+
+
+def _relation(model, attribute):
+    """
+    Return (is_multiple, related_model) if `attribute` of `model` is a
+    database relation, or None (properties, methods, plain fields...).
+    """
+    opts = model._meta
+    for field in opts.fields:
+        if field.name == attribute and field.rel:
+            return (False, field.rel.to)
+    for field in opts.many_to_many + opts.virtual_fields:
+        if field.name == attribute and getattr(field, 'rel', None):
+            return (True, field.rel.to)
+    for related in opts.get_all_related_objects():
+        if related.get_accessor_name() == attribute:
+            return (not related.field.unique, related.model)
+    for related in opts.get_all_related_many_to_many_objects():
+        if related.get_accessor_name() == attribute:
+            return (True, related.model)
+    return None
+
+
+def _joinable(model):
+    """
+    Whether `model` can be joined by ``select_related`` from any queryset.
+    On SpatiaLite, only GeoQuerySets read geometry columns: models with
+    geometries are prefetched instead, through their GeoManager.
+    """
+    if not getattr(connection.ops, 'spatialite', False):
+        return True
+    return not any(hasattr(field, 'geom_type') for field in model._meta.fields)
+
+
+class PrefetchRelatedMixin(object):
+
+    """ Load the related objects a resource serializes in a few queries.
+
+    The plan is derived from the related fields of the resource and,
+    recursively, of the ``full=True`` resources it nests: to-one relations
+    are joined with ``select_related`` (or prefetched once under a to-many
+    relation), to-many relations are prefetched. Related data used by
+    ``dehydrate`` methods can be added with ``Meta.select_related`` and
+    ``Meta.prefetch_related``, on any resource of the tree.
+
+    Plans are only applied to reads: written objects must not be
+    serialized back from stale prefetched data. Fields with a callable
+    ``use_in`` are evaluated against the request, the plans using them are
+    built for each request.
+    """
+
+    def _build_prefetch_plan(self, resource, model, prefix, in_prefetch, use_in, depth, plan, bundle):
+        select_related, prefetch_related, dynamic = plan
+
+        for lookup in getattr(resource._meta, 'select_related', ()):
+            (prefetch_related if in_prefetch else select_related).append(prefix + lookup)
+        for lookup in getattr(resource._meta, 'prefetch_related', ()):
+            prefetch_related.append(prefix + lookup)
+
+        for name, field in resource.fields.items():
+            if not getattr(field, 'is_related', False) or not isinstance(field.attribute, basestring):
+                continue
+            if callable(field.use_in):
+                dynamic.append(prefix + name)
+                if not field.use_in(bundle):
+                    continue
+            elif field.use_in not in ('all', use_in):
+                continue
+
+            # Follow the attribute path, skipping non database attributes
+            related_model = model
+            multiple = in_prefetch
+            for attribute in field.attribute.split('__'):
+                relation = _relation(related_model, attribute)
+                if relation is None:
+                    break
+                related_model = relation[1]
+                multiple = multiple or relation[0] or not _joinable(related_model)
+            else:
+                lookup = prefix + field.attribute
+                (prefetch_related if multiple else select_related).append(lookup)
+
+                full = field.full_list if use_in == 'list' else field.full_detail
+                if field.full is True and full is True and depth < PREFETCH_MAX_DEPTH:
+                    # Nested resources are always dehydrated as details
+                    self._build_prefetch_plan(field.to_class(), related_model, lookup + '__',
+                                              multiple, 'detail', depth + 1, plan, bundle)
+        return plan
+
+    def get_prefetch_plan(self, use_in, request=None):
+        """
+        Return the (select_related, prefetch_related) lookups used to
+        serialize objects in `use_in` ('list' or 'detail') mode.
+        """
+        plans = self.__dict__.setdefault('_prefetch_plans', {})
+        if use_in in plans:
+            return plans[use_in]
+        select_related, prefetch_related, dynamic = self._build_prefetch_plan(
+            self, self._meta.object_class, '', False, use_in, 0, ([], [], []), Bundle(request=request))
+        if not dynamic:
+            plans[use_in] = (select_related, prefetch_related)
+        return (select_related, prefetch_related)
+
+    def get_object_list(self, request):
+        object_list = super(PrefetchRelatedMixin, self).get_object_list(request)
+        if getattr(request, 'method', None) not in ('GET', 'HEAD'):
+            return object_list
+        select_related, prefetch_related = self.get_prefetch_plan('list', request)
+        if select_related:
+            object_list = object_list.select_related(*select_related)
+        if prefetch_related:
+            object_list = object_list.prefetch_related(*prefetch_related)
+        return object_list
+
+    def obj_get(self, bundle, **kwargs):
+        obj = super(PrefetchRelatedMixin, self).obj_get(bundle, **kwargs)
+        if getattr(bundle.request, 'method', None) in ('GET', 'HEAD'):
+            # get_object_list loaded the list plan, add what details need
+            list_plan = sum(self.get_prefetch_plan('list', bundle.request), [])
+            detail_only = [lookup for lookup in sum(self.get_prefetch_plan('detail', bundle.request), [])
+                           if lookup not in list_plan]
+            if detail_only:
+                prefetch_related_objects([obj], detail_only)
+        return obj
+
+
 class HistorizedModelResource(ModelResource):
 
     """ Allow any historized model to get an historized resource for free.
@@ -0,0 +1,237 @@
+"""
+API benchmark: query count, wall time and response size of every resource
+registered in `dataserver.urls.api`, against a synthetic dataset.
+
+See the `api_benchmark` management command, which runs it in a throwaway
+test database (e.g. with `--settings=dataserver.benchmark_settings`, on
+SpatiaLite) and compares the results with a stored baseline.
+"""
+import json
+import time
+from itertools import cycle
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Point
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+
+from django_comments.models import Comment
+from guardian.shortcuts import assign_perm
+from tastypie.models import ApiKey
+
+from accounts.models import Profile, ObjectProfileLink
+from bucket.models import Bucket, BucketFile
+from flipflop.models import Board, List, Card, Task, CardComment
+from projects.models import Project, ProjectProgressRange, ProjectProgress
+from projectsheet.models import (ProjectSheetTemplate, ProjectSheetQuestion, QuestionChoice,
+                                 ProjectSheet, ProjectSheetQuestionAnswer)
+from scout.models import Place, TileLayer, Map, MarkerCategory, Marker
+
+# Dataset sizes: projects (each with a sheet), buckets of `files` files,
+# boards of `cards` cards spread over `lists` lists, maps of `markers`
+# markers.
+SCALES = {
+    'small': dict(projects=10, buckets=2, files=10, boards=2, lists=3, cards=15, maps=2, markers=50),
+    'medium': dict(projects=50, buckets=5, files=50, boards=5, lists=5, cards=60, maps=5, markers=500),
+    'large': dict(projects=200, buckets=10, files=200, boards=10, lists=8, cards=200, maps=10, markers=5000),
+}
+
+TAGS = ('commons', 'energy', 'food', 'housing', 'mobility', 'education')
+
+# Search endpoints need arguments: (resource name, url builder, query string)
+SEARCH_ENDPOINTS = (
+    ('bucket/file', lambda data: 'bucket/file/bucket/%d/search/' % data['buckets'][0].pk, {'q': 'file'}),
+    ('project/sheet/projectsheet', lambda data: 'project/sheet/projectsheet/search/', {'q': 'project'}),
+)
+
+
+def build_dataset(projects, buckets, files, boards, lists, cards, maps, markers):
+    """
+    Create a synthetic dataset owned by a `benchmark` user, and return the
+    created objects by kind.
+    """
+    user = User.objects.create_user('benchmark', 'benchmark@example.org', 'benchmark')
+    other = User.objects.create_user('benchmark-other', 'other@example.org', 'benchmark')
+    for member in (user, other):
+        Profile.objects.get_or_create(user=member)
+        ApiKey.objects.get_or_create(user=member)
+    tags = cycle(TAGS)
+    data = {'user': user}
+
+    # Projects and their sheets
+    progress_range = ProjectProgressRange.objects.create(name='benchmark')
+    progress = ProjectProgress.objects.create(progress_range=progress_range, label='idea', description='')
+    template = ProjectSheetTemplate.objects.create(name='benchmark', active=True,
+                                                   type=settings.PROJECTSHEET_TEMPLATE_TYPES[0][0])
+    questions = []
+    for order in range(5):
+        question = ProjectSheetQuestion.objects.create(template=template, order=order, text='Question %d' % order)
+        for choice in range(3):
+            QuestionChoice.objects.create(question=question, text='Choice %d' % choice)
+        questions.append(question)
+
+    project_type = ContentType.objects.get_for_model(Project)
+    data['projects'] = []
+    for i in range(projects):
+        place = Place.objects.create(geo=Point(2.35 + i * 0.01, 48.85))
+        project = Project.objects.create(title='Project %d' % i, baseline='A benchmark project',
+                                         description='Lorem ipsum ' * 20, location=place, progress=progress)
+        project.tags.add(next(tags), next(tags))
+        # Readable by the user, unlike the default bucket of sheets
+        sheet = ProjectSheet.objects.create(project=project, template=template,
+                                            bucket=Bucket.objects.create(created_by=user, name=project.slug))
+        for question in questions:
+            ProjectSheetQuestionAnswer.objects.create(projectsheet=sheet, question=question, answer='Answer')
+        ObjectProfileLink.objects.create(profile=user.profile, content_type=project_type,
+                                         object_id=project.pk, level=0, detail='', isValidated=True)
+        Comment.objects.create(content_type=project_type, object_pk=str(project.pk), site_id=settings.SITE_ID,
+                               user=other, user_name=other.username, comment='Nice project')
+        data['projects'].append(project)
+
+    # Buckets
+    data['buckets'] = []
+    for i in range(buckets):
+        bucket = Bucket.objects.create(created_by=user, name='Bucket %d' % i)
+        for j in range(files):
+            bfile = BucketFile(bucket=bucket, uploaded_by=user, filename='file-%d.txt' % j,
+                               title='File %d' % j, type='document')
+            bfile.file = ContentFile('Benchmark file %d/%d' % (i, j), name='file-%d.txt' % j)
+            bfile.save()
+            bfile.tags.add(next(tags))
+        data['buckets'].append(bucket)
+
+    # Kanban boards
+    data['boards'] = []
+    for i in range(boards):
+        board = Board.objects.create(created_by=user, title='Board %d' % i)
+        assign_perm('view_board', other, board)
+        labels = [board.labels.create(label='Label %d' % n) for n in range(5)]
+        board_lists = [List.objects.create(board=board, title='List %d' % n) for n in range(lists)]
+        for j in range(cards):
+            card = Card.objects.create(title='Card %d' % j, description='Lorem ipsum',
+                                       submitter=user, list=board_lists[j % lists])
+            card.assigned_to.add(user, other)
+            card.labels.add(labels[j % len(labels)])
+            for n in range(3):
+                Task.objects.create(card=card, title='Task %d' % n, done=bool(n % 2))
+            CardComment.objects.create(card=card, user=other, text='A comment')
+        data['boards'].append(board)
+
+    # Maps
+    if not TileLayer.objects.exists():
+        TileLayer.objects.create(name='OSM', url_template='http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
+                                 attribution='OpenStreetMap')
+    data['maps'] = []
+    for i in range(maps):
+        map = Map.objects.create(name='Map %d' % i, privacy=('GROUP_RW', 'GROUP_RW_OTHERS_RO')[i % 2],
+                                 center=Point(2.35, 48.85), created_by=user,
+                                 bucket=Bucket.objects.create(created_by=user, name='Map %d' % i))
+        categories = [MarkerCategory.objects.create(map=map, name='Category %d' % n, icon_name='star',
+                                                    icon_color='white', marker_color='red')
+                      for n in range(3)]
+        datalayer = map.datalayers.all()[0]
+        Marker.objects.bulk_create([
+            Marker(position=Point(2.0 + (n % 100) * 0.01, 48.0 + (n / 100) * 0.01),
+                   datalayer=datalayer, created_by=user, category=categories[n % len(categories)],
+                   title='Marker %d' % n)
+            for n in range(markers)
+        ])
+        data['maps'].append(map)
+
+    return data
+
+
+def api_endpoints(api, data):
+    """
+    Yield (endpoint id, path, query parameters) for the list and detail of
+    every resource registered in `api`, and for the known search endpoints.
+    """
+    prefix = '/api/%s/' % api.api_name
+    for name, resource in sorted(api._registry.items()):
+        yield ('%s:list' % name, '%s%s/' % (prefix, name), {})
+
+        queryset = resource._meta.queryset
+        if queryset is None:
+            continue
+        obj = queryset.order_by('pk')[:1]
+        if obj:
+            yield ('%s:detail' % name, resource.get_resource_uri(obj[0]), {})
+
+    for name, path, params in SEARCH_ENDPOINTS:
+        if name in api._registry:
+            yield ('%s:search' % name, prefix + path(data), params)
+
+
+def measure(client, path, params, repeat=3):
+    """
+    GET `path` `repeat` times and return its status, number of queries,
+    best wall time (ms) and response size (bytes).
+    """
+    timings = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            response = client.get(path, params)
+            content = ''.join(response.streaming_content) if response.streaming else response.content
+            timings.append((time.time() - start) * 1000)
+    return {
+        'status': response.status_code,
+        'queries': len(queries),
+        'time_ms': round(min(timings), 2),
+        'bytes': len(content),
+    }
+
+
+def run(api, data, repeat=3):
+    """
+    Measure every endpoint of `api` as the dataset owner.
+    """
+    user = data['user']
+    auth = {'format': 'json', 'username': user.username, 'api_key': user.api_key.key}
+    client = Client()
+    results = {}
+    for endpoint, path, params in api_endpoints(api, data):
+        query = dict(auth, **params)
+        results[endpoint] = measure(client, path, query, repeat)
+    return results
+
+
+def compare(results, baseline, query_tolerance=0.1, time_tolerance=0.5, bytes_tolerance=0.5):
+    """
+    Return the list of regressions of `results` against `baseline`, as
+    (endpoint, message) tuples. Endpoints missing from the baseline are
+    ignored.
+    """
+    regressions = []
+    for endpoint, result in sorted(results.items()):
+        reference = baseline.get(endpoint)
+        if reference is None:
+            continue
+        if result['status'] >= 400 and reference['status'] < 400:
+            regressions.append((endpoint, "status %d, was %d" % (result['status'], reference['status'])))
+        if result['queries'] > reference['queries'] + max(1, int(reference['queries'] * query_tolerance)):
+            regressions.append((endpoint, "%d queries, was %d" % (result['queries'], reference['queries'])))
+        # Ignore jitter on very fast endpoints
+        if result['time_ms'] > reference['time_ms'] * (1 + time_tolerance) + 5:
+            regressions.append((endpoint, "%.1f ms, was %.1f ms" % (result['time_ms'], reference['time_ms'])))
+        if result['bytes'] > reference['bytes'] * (1 + bytes_tolerance):
+            regressions.append((endpoint, "%d bytes, was %d" % (result['bytes'], reference['bytes'])))
+    return regressions
+
+
+def load_baseline(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except IOError:
+        return {}
+
+
+def save_baseline(path, baseline):
+    with open(path, 'w') as fp:
+        json.dump(baseline, fp, indent=2, sort_keys=True)
+        fp.write('\n')
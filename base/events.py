@@ -0,0 +1,251 @@
+"""
+Change events, pushed to clients over Server-Sent Events or long-polling.
+
+Model signals publish small events (what changed, not the data) on a
+channel per watched object: a board, a map, the comments of an object.
+Clients subscribe with `stream_response`, then fetch what they need, e.g.
+the change feed of a board.
+
+Events go through the backend named by settings.EVENTS_BACKEND:
+
+* `InMemoryBackend` keeps them in the process, which is enough for a single
+  process server, and for tests,
+* `RedisBackend` fans them out to every process through Redis
+  (settings.EVENTS_REDIS), which multi-process deployments need.
+
+Events published inside a transaction are held until it is over (see
+`publish`), so that clients never fetch a change before it is committed.
+
+Each channel keeps its last EVENTS_HISTORY events, so that a client which
+reconnects with the id of the last event it got (``Last-Event-ID``) misses
+nothing. Streams end after EVENTS_STREAM_TIMEOUT seconds, EventSource
+clients then reconnect transparently.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.module_loading import import_by_path
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 15
+
+
+class InMemoryBackend(object):
+    """
+    Events kept in the memory of the process.
+    """
+    def __init__(self, history=100):
+        self.history = history
+        self.channels = {}
+        self.condition = threading.Condition()
+
+    def publish(self, channel, data):
+        with self.condition:
+            last_id, events = self.channels.setdefault(channel, (0, deque(maxlen=self.history)))
+            event_id = last_id + 1
+            events.append((event_id, data))
+            self.channels[channel] = (event_id, events)
+            self.condition.notify_all()
+        return event_id
+
+    def _events_after(self, channels, last_ids):
+        return [(channel, event_id, data)
+                for channel in channels
+                for event_id, data in self.channels.get(channel, (0, ()))[1]
+                if event_id > last_ids.get(channel, 0)]
+
+    def last_id(self, channel):
+        with self.condition:
+            return self.channels.get(channel, (0, ()))[0]
+
+    def read(self, channels, last_ids, timeout):
+        """
+        Return the (channel, id, data) events published on `channels` after
+        `last_ids` ({channel: id}), waiting up to `timeout` seconds for one.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                events = self._events_after(channels, last_ids)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                self.condition.wait(remaining)
+
+
+class RedisBackend(object):
+    """
+    Events stored in Redis lists and announced with PUBLISH.
+    """
+    def __init__(self, history=100, prefix='dataserver:events:'):
+        import redis
+        self.history = history
+        self.prefix = prefix
+        self.redis = redis.StrictRedis(**getattr(settings, 'EVENTS_REDIS', {}))
+
+    def publish(self, channel, data):
+        key = self.prefix + channel
+        event_id = self.redis.incr(key + ':id')
+        pipe = self.redis.pipeline()
+        pipe.lpush(key, json.dumps([event_id, data]))
+        pipe.ltrim(key, 0, self.history - 1)
+        pipe.publish(key, event_id)
+        pipe.execute()
+        return event_id
+
+    def last_id(self, channel):
+        return int(self.redis.get(self.prefix + channel + ':id') or 0)
+
+    def _events_after(self, channels, last_ids):
+        events = []
+        for channel in channels:
+            for item in reversed(self.redis.lrange(self.prefix + channel, 0, -1)):
+                event_id, data = json.loads(item)
+                if event_id > last_ids.get(channel, 0):
+                    events.append((channel, event_id, data))
+        return events
+
+    def read(self, channels, last_ids, timeout):
+        deadline = time.time() + timeout
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # Subscribe first so that nothing published meanwhile is missed
+        pubsub.subscribe(*[self.prefix + channel for channel in channels])
+        try:
+            while True:
+                events = self._events_after(channels, last_ids)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                pubsub.get_message(timeout=remaining)
+        finally:
+            pubsub.close()
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        backend_class = import_by_path(getattr(settings, 'EVENTS_BACKEND', 'base.events.InMemoryBackend'))
+        _backend = backend_class(history=getattr(settings, 'EVENTS_HISTORY', 100))
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replace the backend, e.g. with an InMemoryBackend in tests.
+    """
+    global _backend
+    _backend = backend
+
+
+# Events published inside a transaction, per thread (see publish)
+_pending = threading.local()
+
+
+def _send(channel, data):
+    try:
+        return get_backend().publish(channel, data)
+    except Exception:
+        logger.warning("Could not publish event on %s", channel, exc_info=True)
+
+
+def publish(channel, **data):
+    """
+    Publish an event on `channel`. Failures are logged, never raised: a
+    notification must not break the change it announces.
+
+    Inside a transaction, the event is held and None is returned: held
+    events are sent at the beginning and at the end of requests, before
+    the next event published outside a transaction, and when the process
+    exits. If the transaction is rolled back, clients only fetch nothing
+    new.
+    """
+    if connection.in_atomic_block:
+        if not hasattr(_pending, 'events'):
+            _pending.events = []
+        _pending.events.append((channel, data))
+        return None
+    flush()
+    return _send(channel, data)
+
+
+def flush(**kwargs):
+    """
+    Send the events held by `publish`.
+    """
+    events, _pending.events = getattr(_pending, 'events', []), []
+    for channel, data in events:
+        _send(channel, data)
+
+request_started.connect(flush)
+request_finished.connect(flush)
+atexit.register(flush)
+
+
+def _parse_int(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def stream_response(request, channel):
+    """
+    Response sending the events of `channel`.
+
+    With ``?poll=1``, long-polling: waits for the events after the id given
+    by ``last_id`` (by default, the current last event) and returns them as
+    JSON. Otherwise a Server-Sent Events stream, resumed after the
+    ``Last-Event-ID`` header or ``last_id`` parameter.
+    """
+    backend = get_backend()
+    current_id = backend.last_id(channel)
+    last_id = _parse_int(request.META.get('HTTP_LAST_EVENT_ID', request.GET.get('last_id')))
+    if last_id is None or last_id > current_id:
+        # Ids ahead of the channel come from a lost history (e.g. a restarted
+        # in-memory backend)
+        last_id = current_id
+    # Waiting clients must not hold a database connection
+    connection.close()
+
+    if request.GET.get('poll'):
+        max_timeout = getattr(settings, 'EVENTS_POLL_TIMEOUT', 25)
+        timeout = _parse_int(request.GET.get('timeout'))
+        timeout = max_timeout if timeout is None else min(timeout, max_timeout)
+        events = backend.read([channel], {channel: last_id}, timeout)
+        data = {
+            'last_id': events[-1][1] if events else last_id,
+            'events': [dict(data, id=event_id) for event_channel, event_id, data in events],
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def stream(last_id):
+        deadline = time.time() + getattr(settings, 'EVENTS_STREAM_TIMEOUT', 55)
+        # Tell EventSource to reconnect quickly once the stream ends
+        yield "retry: 1000\n\n"
+        while time.time() < deadline:
+            events = backend.read([channel], {channel: last_id},
+                                  min(HEARTBEAT_INTERVAL, max(deadline - time.time(), 0)))
+            if not events:
+                # Keeps proxies from closing an idle connection
+                yield ": heartbeat\n\n"
+            for event_channel, event_id, data in events:
+                last_id = event_id
+                yield "id: %s\ndata: %s\n\n" % (event_id, json.dumps(data))
+
+    response = StreamingHttpResponse(stream(last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Not buffered by nginx
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from base import benchmark
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(benchmark.__file__), 'benchmarks', 'baseline.json')
+
+DATASET_OPTIONS = ('projects', 'buckets', 'files', 'boards', 'lists', 'cards', 'maps', 'markers')
+
+
+class Command(BaseCommand):
+    help = ("Measure queries, time and response size of every v0 API endpoint on a synthetic "
+            "dataset, and fail on regressions against the stored baseline.")
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', dest='scale', default='small', choices=sorted(benchmark.SCALES),
+                    help="Dataset size: %s." % ", ".join(sorted(benchmark.SCALES))),
+        make_option('--baseline', dest='baseline', default=DEFAULT_BASELINE,
+                    help="JSON file of the reference measures, by scale."),
+        make_option('--update-baseline', action='store_true', dest='update_baseline', default=False,
+                    help="Store the measures as the new baseline of the scale instead of comparing."),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help="Number of requests per endpoint; the fastest one is kept."),
+        make_option('--query-tolerance', type='float', dest='query_tolerance', default=0.1,
+                    help="Allowed relative increase of the number of queries (at least one query)."),
+        make_option('--time-tolerance', type='float', dest='time_tolerance', default=0.5,
+                    help="Allowed relative increase of the response time."),
+        make_option('--bytes-tolerance', type='float', dest='bytes_tolerance', default=0.5,
+                    help="Allowed relative increase of the response size."),
+    ) + tuple(
+        make_option('--%s' % name, type='int', dest=name, default=None,
+                    help="Override the number of %s of the scale." % name)
+        for name in DATASET_OPTIONS
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        scale = options['scale']
+        sizes = dict(benchmark.SCALES[scale])
+        for name in DATASET_OPTIONS:
+            if options[name] is not None:
+                sizes[name] = options[name]
+        if sizes != benchmark.SCALES[scale] and options['update_baseline']:
+            raise CommandError("Refusing to store a baseline for overridden dataset sizes")
+        # Checked first: without a baseline, the run could not fail on a regression
+        baselines = benchmark.load_baseline(options['baseline'])
+        if scale not in baselines and not options['update_baseline']:
+            raise CommandError("No %s baseline in %s, run with --update-baseline to record one."
+                               % (scale, options['baseline']))
+
+        # Imported late: building the API imports every resource
+        from dataserver.urls import api
+
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+        setup_test_environment()
+        old_name = settings.DATABASES['default']['NAME']
+        old_media_root = settings.MEDIA_ROOT
+        settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='api-benchmark-')
+        connection.creation.create_test_db(verbosity=max(verbosity - 1, 0), autoclobber=True)
+        try:
+            if verbosity:
+                self.stdout.write("Building the %s dataset: %s" % (
+                    scale, ", ".join("%s=%d" % item for item in sorted(sizes.items()))))
+            data = benchmark.build_dataset(**sizes)
+            results = benchmark.run(api, data, repeat=options['repeat'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=max(verbosity - 1, 0))
+            shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+            settings.MEDIA_ROOT = old_media_root
+            teardown_test_environment()
+
+        if verbosity:
+            for endpoint, result in sorted(results.items()):
+                self.stdout.write("%-50s %3d %5d queries %9.1f ms %9d bytes" % (
+                    endpoint, result['status'], result['queries'], result['time_ms'], result['bytes']))
+
+        if options['update_baseline']:
+            baselines[scale] = results
+            folder = os.path.dirname(options['baseline'])
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            benchmark.save_baseline(options['baseline'], baselines)
+            if verbosity:
+                self.stdout.write("Stored the %s baseline in %s" % (scale, options['baseline']))
+            return
+
+        regressions = benchmark.compare(results, baselines[scale],
+                                        query_tolerance=options['query_tolerance'],
+                                        time_tolerance=options['time_tolerance'],
+                                        bytes_tolerance=options['bytes_tolerance'])
+        if regressions:
+            for endpoint, message in regressions:
+                self.stderr.write("%s: %s" % (endpoint, message))
+            raise CommandError("%d regression(s) against the %s baseline" % (len(regressions), scale))
+        if verbosity:
+            self.stdout.write("No regression against the %s baseline" % scale)
@@ -0,0 +1,18 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from django_comments.models import Comment
+
+from base import events
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def publish_comment_event(sender, instance, **kwargs):
+    """
+    Tell the clients watching the comments of an object that one of them
+    changed.
+    """
+    events.publish('comments.%s.%s' % (instance.content_type.model, instance.object_pk),
+                   kind='comment', id=instance.pk,
+                   action='changed' if 'created' in kwargs else 'deleted')
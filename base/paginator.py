@@ -0,0 +1,170 @@
+"""
+Keyset ("cursor") pagination for tastypie list endpoints.
+"""
+import base64
+import datetime
+import json
+
+from django.db.models import Q
+from django.utils import six
+
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator walking a list by the values of its ordering columns instead of
+    an offset, for resources crawled in full.
+
+    Requests carrying a ``cursor`` parameter (empty for the first page) get
+    pages of ``limit`` objects following the cursor, and a ``next`` link
+    holding the cursor of the last object of the page. The primary key is
+    appended to the ordering so that the position is unique: objects created
+    or deleted while a client crawls do not shift the following pages, and
+    deep pages cost the same as the first. The total count is only computed
+    when asked for with ``count=1``.
+
+    Requests without a ``cursor`` are paginated by offset, as with the
+    default paginator. The ordering columns must not be NULL.
+
+    Enabled with ``paginator_class = KeysetPaginator`` in a resource Meta.
+    """
+    cursor_param = 'cursor'
+    count_param = 'count'
+
+    def get_ordering(self):
+        """
+        Return the ordering of the objects as a list of (lookup, descending)
+        tuples, ending with the primary key.
+        """
+        query = self.objects.query
+        if query.order_by:
+            order_by = list(query.order_by)
+        elif query.default_ordering:
+            order_by = list(self.objects.model._meta.ordering)
+        else:
+            order_by = []
+
+        ordering = []
+        for lookup in order_by:
+            if not isinstance(lookup, six.string_types) or lookup == '?' or '.' in lookup:
+                raise BadRequest("Cursor pagination is not possible with this ordering.")
+            descending = lookup.startswith('-')
+            lookup = lookup.lstrip('-')
+            if lookup in ('pk', self.objects.model._meta.pk.name):
+                lookup = 'pk'
+            ordering.append((lookup, descending))
+            if lookup == 'pk':
+                break
+        else:
+            ordering.append(('pk', ordering[-1][1] if ordering else False))
+        return ordering
+
+    def _lookup_field(self, lookup):
+        model = self.objects.model
+        field = None
+        for name in lookup.split('__'):
+            if name == 'pk':
+                field = model._meta.pk
+            else:
+                field = model._meta.get_field_by_name(name)[0]
+            if getattr(field, 'rel', None) is not None:
+                model = field.rel.to
+        return field
+
+    def encode_cursor(self, obj, ordering):
+        values = []
+        for lookup, descending in ordering:
+            value = obj
+            for name in lookup.split('__'):
+                value = getattr(value, name)
+            if hasattr(value, '_get_pk_val'):
+                value = value.pk
+            if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+                value = value.isoformat()
+            values.append(value)
+        data = json.dumps([[lookup for lookup, descending in ordering], values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def decode_cursor(self, cursor, ordering):
+        try:
+            cursor = str(cursor)
+            lookups, values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (TypeError, ValueError, UnicodeError):
+            raise BadRequest("Invalid cursor '%s' provided." % cursor)
+        if lookups != [lookup for lookup, descending in ordering] or len(values) != len(lookups):
+            raise BadRequest("The cursor does not match the ordering of the list.")
+        return [self._lookup_field(lookup).to_python(value) for lookup, value in zip(lookups, values)]
+
+    def get_keyset_filter(self, ordering, values):
+        """
+        Q object selecting the objects after `values` in `ordering`:
+        (a > x) OR (a = x AND b > y) OR ...
+        """
+        keyset_filter = Q()
+        for i, (lookup, descending) in enumerate(ordering):
+            condition = Q(**{'%s__%s' % (lookup, 'lt' if descending else 'gt'): values[i]})
+            for previous_lookup, value in zip([l for l, d in ordering[:i]], values[:i]):
+                condition &= Q(**{previous_lookup: value})
+            keyset_filter |= condition
+        return keyset_filter
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        try:
+            request_params = self.request_data.copy()
+        except AttributeError:
+            request_params = dict(self.request_data)
+        for param in ('limit', 'offset', self.cursor_param):
+            request_params.pop(param, None)
+        request_params.update({'limit': limit, self.cursor_param: cursor})
+        try:
+            encoded_params = request_params.urlencode()
+        except AttributeError:
+            encoded_params = urlencode(dict(
+                (k, v.encode('utf-8') if isinstance(v, six.text_type) else v)
+                for k, v in request_params.items()))
+        return '%s?%s' % (self.resource_uri, encoded_params)
+
+    def page(self):
+        if self.cursor_param not in self.request_data:
+            return super(KeysetPaginator, self).page()
+
+        limit = self.get_limit()
+        ordering = self.get_ordering()
+        order_by = ['%s%s' % ('-' if descending else '', lookup) for lookup, descending in ordering]
+        objects = self.objects.order_by(*order_by)
+
+        cursor = self.request_data[self.cursor_param]
+        if cursor:
+            objects = objects.filter(self.get_keyset_filter(ordering, self.decode_cursor(cursor, ordering)))
+
+        if limit:
+            # One more object tells whether there is a next page, without a count
+            page = list(objects[:limit + 1])
+            has_next = len(page) > limit
+            page = page[:limit]
+        else:
+            page = list(objects)
+            has_next = False
+
+        meta = {
+            'limit': limit,
+            'cursor': cursor,
+            'previous': None,
+            'next': self._generate_cursor_uri(limit, self.encode_cursor(page[-1], ordering)) if has_next else None,
+        }
+        if self.request_data.get(self.count_param) in ('1', 'true'):
+            meta['total_count'] = self.get_count()
+
+        return {
+            self.collection_name: page,
+            'meta': meta,
+        }
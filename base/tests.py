@@ -0,0 +1,145 @@
+import datetime
+import json
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from tastypie.exceptions import BadRequest
+
+from base import events
+from base.paginator import KeysetPaginator
+
+
+class KeysetPaginatorTest(TestCase):
+    def setUp(self):
+        joined = datetime.datetime(2015, 1, 1)
+        # Pairs of users joined at the same time, so that pages end on ties
+        for number in range(10):
+            User.objects.create(username='user%02d' % number,
+                                date_joined=joined + datetime.timedelta(days=number / 2))
+        # Not guardian's anonymous user
+        self.users = User.objects.filter(username__startswith='user')
+
+    def page(self, objects, limit=3, **params):
+        return KeysetPaginator(params, objects, resource_uri='/api/v0/users/', limit=limit).page()
+
+    def crawl(self, objects, limit=3):
+        seen = []
+        page = self.page(objects, limit, cursor='')
+        while True:
+            seen.extend(user.username for user in page['objects'])
+            if not page['meta']['next']:
+                return seen
+            cursor = parse_qs(urlparse(page['meta']['next']).query)['cursor'][0]
+            page = self.page(objects, limit, cursor=cursor)
+
+    def test_crawl_follows_the_ordering(self):
+        for ordering in ('username', '-username', 'date_joined', '-date_joined'):
+            objects = self.users.order_by(ordering)
+            # Ties are broken by primary key, in the direction of the last column
+            expected = objects.order_by(ordering, '-pk' if ordering.startswith('-') else 'pk')
+            self.assertEqual(self.crawl(objects), [user.username for user in expected])
+
+    def test_pages_are_stable_when_objects_are_inserted(self):
+        objects = self.users.order_by('username')
+        page = self.page(objects, cursor='')
+        cursor = parse_qs(urlparse(page['meta']['next']).query)['cursor'][0]
+        User.objects.create(username='user00a')
+        page = self.page(objects, cursor=cursor)
+        self.assertEqual([user.username for user in page['objects']], ['user03', 'user04', 'user05'])
+
+    def test_last_page_has_no_next_link(self):
+        page = self.page(self.users.order_by('username'), limit=10, cursor='')
+        self.assertEqual(len(page['objects']), 10)
+        self.assertIsNone(page['meta']['next'])
+
+    def test_count_on_demand(self):
+        objects = self.users.order_by('username')
+        self.assertNotIn('total_count', self.page(objects, cursor='')['meta'])
+        self.assertEqual(self.page(objects, cursor='', count='1')['meta']['total_count'], 10)
+
+    def test_invalid_cursors(self):
+        objects = self.users.order_by('username')
+        self.assertRaises(BadRequest, self.page, objects, cursor='not a cursor')
+        page = self.page(self.users.order_by('date_joined'), cursor='')
+        cursor = parse_qs(urlparse(page['meta']['next']).query)['cursor'][0]
+        self.assertRaises(BadRequest, self.page, objects, cursor=cursor)
+
+    def test_offset_pagination_without_cursor(self):
+        page = self.page(self.users.order_by('username'), offset='3')
+        self.assertEqual(page['meta']['offset'], 3)
+        self.assertEqual(page['meta']['total_count'], 10)
+        self.assertEqual(page['objects'][0].username, 'user03')
+
+
+# Outside of TestCase transactions, which hold events
+class InMemoryEventsTest(TransactionTestCase):
+    def setUp(self):
+        self.backend = events.InMemoryBackend(history=3)
+        events.set_backend(self.backend)
+
+    def tearDown(self):
+        events.set_backend(None)
+
+    def test_read_after_last_id(self):
+        for number in range(2):
+            events.publish('board', number=number)
+        events.publish('other', number=9)
+        self.assertEqual(self.backend.last_id('board'), 2)
+        self.assertEqual(self.backend.read(['board'], {'board': 1}, 0), [('board', 2, {'number': 1})])
+        self.assertEqual(self.backend.read(['board', 'other'], {'board': 2}, 0), [('other', 1, {'number': 9})])
+
+    def test_history_is_bounded(self):
+        for number in range(5):
+            events.publish('board', number=number)
+        self.assertEqual([event_id for channel, event_id, data in self.backend.read(['board'], {}, 0)], [3, 4, 5])
+
+    def test_read_waits_for_events(self):
+        self.assertEqual(self.backend.read(['board'], {}, 0), [])
+        timer = threading.Timer(0.1, events.publish, ['board'], {'number': 1})
+        timer.start()
+        started = time.time()
+        self.assertEqual(self.backend.read(['board'], {}, 5), [('board', 1, {'number': 1})])
+        self.assertLess(time.time() - started, 5)
+        timer.join()
+
+    def test_events_wait_for_the_end_of_transactions(self):
+        with transaction.atomic():
+            self.assertIsNone(events.publish('board', number=1))
+            self.assertEqual(self.backend.last_id('board'), 0)
+        events.publish('board', number=2)
+        self.assertEqual(self.backend.read(['board'], {}, 0), [('board', 1, {'number': 1}),
+                                                               ('board', 2, {'number': 2})])
+        with transaction.atomic():
+            events.publish('board', number=3)
+        events.flush()
+        self.assertEqual(self.backend.last_id('board'), 3)
+
+    def test_publish_failures_are_not_raised(self):
+        events.set_backend(object())
+        self.assertIsNone(events.publish('board', number=1))
+
+    def test_long_polling(self):
+        events.publish('board', number=1)
+        events.publish('board', number=2)
+        request = RequestFactory().get('/events/', {'poll': 1, 'timeout': 0, 'last_id': 1})
+        data = json.loads(events.stream_response(request, 'board').content)
+        self.assertEqual(data, {'last_id': 2, 'events': [{'id': 2, 'number': 2}]})
+        # Ids ahead of the channel restart from its last event
+        request = RequestFactory().get('/events/', {'poll': 1, 'timeout': 0, 'last_id': 10})
+        self.assertEqual(json.loads(events.stream_response(request, 'board').content), {'last_id': 2, 'events': []})
+
+    @override_settings(EVENTS_STREAM_TIMEOUT=0.1)
+    def test_server_sent_events(self):
+        events.publish('board', number=1)
+        events.publish('board', number=2)
+        response = events.stream_response(RequestFactory().get('/events/', HTTP_LAST_EVENT_ID='1'), 'board')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = ''.join(response.streaming_content)
+        self.assertTrue(content.startswith('retry: 1000\n\nid: 2\ndata: {"number": 2}\n\n'))
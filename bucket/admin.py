@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.db import models
-from .models import Bucket, BucketFile
+from .models import Bucket, BucketFile, PreviewJob
 
 class InlineBucketFile(admin.TabularInline):
     model = BucketFile
@@ -30,3 +30,9 @@ class BucketAdmin(admin.ModelAdmin):
     files_count.admin_order_field = 'files__count'
 
 admin.site.register(Bucket, BucketAdmin)
+
+class PreviewJobAdmin(admin.ModelAdmin):
+    list_display = ('bucket_file', 'dim', 'border', 'status', 'attempts', 'updated_on')
+    list_filter = ('status', )
+
+admin.site.register(PreviewJob, PreviewJobAdmin)
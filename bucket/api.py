@@ -16,12 +16,13 @@ from tastypie.resources import ModelResource
 from tastypie.utils import trailing_slash
 from tastypie import fields
 
+from base.api import PrefetchRelatedMixin
 from dataserver.authorization import GuardianAuthorization
 from dataserver.authentication import AnonymousApiKeyAuthentication
 
 from .models import Bucket, BucketFile, Experience
 
-class BucketResource(ModelResource):
+class BucketResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         authentication = AnonymousApiKeyAuthentication()
         authorization = GuardianAuthorization(
@@ -112,7 +113,7 @@ class BucketExperienceResource(ModelResource):
     presentation = fields.CharField(attribute='presentation', null=True)
     success = fields.CharField(attribute='success', null=True)
 
-class BucketFileResource(ModelResource):
+class BucketFileResource(PrefetchRelatedMixin, ModelResource):
     """
     Rest Resource for a given file of a given bucket
     """
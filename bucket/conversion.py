@@ -0,0 +1,259 @@
+"""
+Document to PDF conversion service.
+
+* Single flight: one conversion runs per target file, host wide (thread
+  locks within a process, `flock` between processes). Other requests for
+  the same document wait for it and reuse its output.
+* Atomic output: the PDF is written to a temporary file next to the target
+  and renamed, so nobody ever reads a half written PDF.
+* Warm, bounded pool: conversions go through at most BUCKET_CONVERTERS
+  long-running `unoconv --listener` processes (one per port starting at
+  BUCKET_CONVERTER_BASE_PORT) instead of cold starting an office suite
+  for each document.
+* Bounded run time: a conversion running for more than
+  BUCKET_CONVERSION_MAX_TIME seconds is killed, with the listener it was
+  using, which is restarted on next use.
+"""
+import atexit
+import contextlib
+import errno
+import fcntl
+import logging
+import os
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from hashlib import sha1
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionError(Exception):
+    pass
+
+
+class ConversionTimeout(ConversionError):
+    pass
+
+
+def _lock_dir():
+    folder = getattr(settings, 'BUCKET_CONVERSION_LOCK_DIR', None) or \
+        os.path.join(tempfile.gettempdir(), 'dataserver-conversion')
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return folder
+
+
+def _lock_path(name):
+    return os.path.join(_lock_dir(), "%s.lock" % sha1(name).hexdigest())
+
+
+@contextlib.contextmanager
+def file_lock(name, blocking=True):
+    """
+    Exclusive host wide lock named `name`. When not `blocking`, yields
+    False instead of waiting if the lock is already taken.
+    """
+    fp = open(_lock_path(name), 'a')
+    try:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp, flags)
+        except IOError, e:
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+    finally:
+        fp.close()
+
+
+# Striped in-process locks, so that threads of a same process queue up on a
+# cheap lock before competing for the file lock.
+_thread_locks = [threading.Lock() for i in range(64)]
+
+
+def _thread_lock(name):
+    return _thread_locks[hash(name) % len(_thread_locks)]
+
+
+def _kill(process):
+    """
+    Kill `process` and its children (started in their own process group).
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # Already gone
+        pass
+
+
+def run_command(cmd, timeout):
+    """
+    Run `cmd` and return its output. Raises ConversionError if it fails,
+    or runs for more than `timeout` seconds: it is then killed with its
+    children.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               preexec_fn=os.setsid)
+    timed_out = threading.Event()
+
+    def watchdog():
+        timed_out.set()
+        _kill(process)
+
+    timer = threading.Timer(timeout, watchdog)
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+    if timed_out.is_set():
+        raise ConversionTimeout("%s killed after %d seconds" % (cmd[0], timeout))
+    if process.returncode:
+        raise ConversionError("%s failed: %s" % (cmd[0], output))
+    return output
+
+
+class ConverterPool(object):
+    """
+    A bounded pool of warm unoconv listeners, shared by every process of
+    the host. Each slot is a TCP port guarded by a file lock; the listener
+    of a slot is started on first use and left running afterwards. The
+    listeners started by a process are reaped once they exit, and stopped
+    with the process.
+    """
+    def __init__(self, size, base_port, timeout, max_time):
+        self.size = size
+        self.base_port = base_port
+        self.timeout = timeout
+        self.max_time = max_time
+        # Listeners started by this process, by port
+        self.listeners = {}
+        atexit.register(self.stop_listeners)
+
+    def _is_listening(self, port):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+        except socket.error:
+            return False
+        sock.close()
+        return True
+
+    def _reap_listeners(self):
+        for port, process in self.listeners.items():
+            if process.poll() is not None:
+                del self.listeners[port]
+
+    def _ensure_listener(self, port):
+        self._reap_listeners()
+        if self._is_listening(port):
+            return
+        logger.info("Starting unoconv listener on port %d", port)
+        with open(os.devnull, 'w') as devnull:
+            self.listeners[port] = subprocess.Popen(['unoconv', '--listener', '--port', str(port)],
+                                                    stdout=devnull, stderr=subprocess.STDOUT,
+                                                    preexec_fn=os.setsid)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self._is_listening(port):
+                return
+            time.sleep(0.2)
+        # unoconv will still start its own office instance if needed
+        logger.warning("unoconv listener on port %d did not come up", port)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Wait for a free converter and yield its port.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            for port in range(self.base_port, self.base_port + self.size):
+                with file_lock('unoconv-port-%d' % port, blocking=False) as acquired:
+                    if acquired:
+                        self._ensure_listener(port)
+                        yield port
+                        return
+            if time.time() > deadline:
+                raise ConversionError("No document converter available")
+            time.sleep(0.1)
+
+    def stop_listener(self, port):
+        """
+        Stop the listener this process started on `port`, if any.
+        """
+        process = self.listeners.pop(port, None)
+        if process is not None:
+            _kill(process)
+            process.wait()
+
+    def stop_listeners(self):
+        for port in self.listeners.keys():
+            self.stop_listener(port)
+
+    def convert(self, source, target, format='pdf'):
+        with self.slot() as port:
+            cmd = ['unoconv', '--port', str(port), '-f', format, '-o', target, source]
+            try:
+                run_command(cmd, self.max_time)
+            except ConversionTimeout:
+                # The listener may be the one stuck
+                self.stop_listener(port)
+                raise
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ConverterPool(getattr(settings, 'BUCKET_CONVERTERS', 2),
+                              getattr(settings, 'BUCKET_CONVERTER_BASE_PORT', 2002),
+                              getattr(settings, 'BUCKET_CONVERSION_TIMEOUT', 120),
+                              getattr(settings, 'BUCKET_CONVERSION_MAX_TIME', 300))
+    return _pool
+
+
+def convert_to_pdf(source, target):
+    """
+    Convert `source` into `target` PDF, unless it was already done. If the
+    same conversion is in progress elsewhere, wait for it instead of
+    running it again.
+    """
+    if os.path.isfile(target):
+        return target
+
+    with _thread_lock(target):
+        with file_lock(target):
+            # Somebody else may have done the work while we were waiting
+            if os.path.isfile(target):
+                return target
+
+            fd, tmp_path = tempfile.mkstemp(suffix='.pdf', prefix='.converting-',
+                                            dir=os.path.dirname(target))
+            os.close(fd)
+            try:
+                get_pool().convert(source, tmp_path)
+                os.rename(tmp_path, target)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    return target
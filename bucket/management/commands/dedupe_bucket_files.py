@@ -0,0 +1,41 @@
+import os
+from hashlib import sha1
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from bucket.models import Blob, BucketFile
+
+
+def file_sha1(path, chunk_size=64 * 1024):
+    hasher = sha1()
+    with open(path, 'rb') as fp:
+        for data in iter(lambda: fp.read(chunk_size), ''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+class Command(BaseCommand):
+    help = "Move the bucket files stored before content addressing into Blobs, merging duplicates."
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        moved = merged = 0
+
+        for bfile in BucketFile.objects.filter(blob__isnull=True).exclude(file='').exclude(file__isnull=True):
+            path = default_storage.path(bfile.file.name)
+            if not os.path.isfile(path):
+                if verbosity > 1:
+                    self.stdout.write("Missing file for bucket file %s: %s" % (bfile.pk, bfile.file.name))
+                continue
+
+            digest = file_sha1(path)
+            if Blob.objects.filter(sha1=digest).exists():
+                merged += 1
+            else:
+                moved += 1
+            blob = Blob.objects.adopt(path, digest, bfile.file.name)
+            BucketFile.objects.filter(pk=bfile.pk).update(blob=blob, file=blob.file.name)
+
+        if verbosity:
+            self.stdout.write("Moved %d file(s), merged %d duplicate(s)" % (moved, merged))
@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bucket.signals import process_queue
+
+
+class Command(BaseCommand):
+    help = "Update the search indexes for the objects changed since the last run."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=None,
+                    help="Number of objects indexed at once."),
+        make_option('--loop', type='int', dest='loop', default=None, metavar='SECONDS',
+                    help="Keep processing the queue, checking it every SECONDS when empty."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        while True:
+            processed = process_queue(limit=options['batch_size'])
+            if verbosity > 1 or (processed and verbosity > 0):
+                self.stdout.write("%d objects processed" % processed)
+            if options['loop'] is None and not processed:
+                break
+            if not processed:
+                time.sleep(options['loop'])
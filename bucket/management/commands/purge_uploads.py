@@ -0,0 +1,20 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bucket.uploads import purge_sessions
+
+
+class Command(BaseCommand):
+    help = "Delete abandoned chunked uploads and their partial files."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-age', type='int', dest='max_age', default=None,
+                    help="Age in seconds after which an idle upload is purged "
+                         "(defaults to BUCKET_UPLOAD_SESSION_EXPIRATION)."),
+    )
+
+    def handle(self, *args, **options):
+        count = purge_sessions(options['max_age'])
+        if int(options['verbosity']):
+            self.stdout.write("Purged %d upload(s)" % count)
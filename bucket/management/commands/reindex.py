@@ -0,0 +1,102 @@
+import multiprocessing
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django import db
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+
+from haystack import connection_router, connections
+
+from bucket.signals import index_objects
+
+
+def index_chunk(args):
+    using, label, pks = args
+    indexed = index_objects(using, label, pks)
+    db.reset_queries()
+    return indexed
+
+
+def reset_connections():
+    # Forked workers must not share the connections of the parent
+    for connection in db.connections.all():
+        connection.close()
+    for using in connections.connections_info:
+        connections.reload(using)
+
+
+def rate(count, started):
+    return count / max(time.time() - started, 0.001)
+
+
+def parse_since(value):
+    since = parse_datetime(value)
+    if since is None and parse_date(value) is not None:
+        since = datetime.combine(parse_date(value), datetime.min.time())
+    if since is None:
+        raise CommandError("Invalid --since '%s', expected YYYY-MM-DD or YYYY-MM-DD HH:MM." % value)
+    return since
+
+
+class Command(BaseCommand):
+    args = '[app_label.model_name ...]'
+    help = ("Index the objects of the given models, or of every indexed model, in chunks "
+            "of prefetched objects, optionally only those updated since a date, with a pool of workers.")
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+                    help="Only index the objects updated since this date (YYYY-MM-DD or YYYY-MM-DD HH:MM)."),
+        make_option('--workers', type='int', dest='workers', default=0,
+                    help="Number of worker processes (none by default)."),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help="Number of objects indexed at once."),
+        make_option('--using', action='append', dest='using', default=[],
+                    help="Search connection to update (all of them by default)."),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options['verbosity'])
+        since = parse_since(options['since']) if options['since'] else None
+        batch_size = options['batch_size']
+
+        for using in options['using'] or connection_router.for_write():
+            unified_index = connections[using].get_unified_index()
+            indexes = dict(('%s.%s' % (model._meta.app_label, model._meta.module_name), unified_index.get_index(model))
+                           for model in unified_index.get_indexed_models())
+            for label in labels:
+                if label.lower() not in indexes:
+                    raise CommandError("No index for '%s' on '%s'." % (label, using))
+
+            for label in [label.lower() for label in labels] or sorted(indexes):
+                pks = list(indexes[label].build_queryset(using=using, start_date=since)
+                                         .order_by('pk').values_list('pk', flat=True))
+                chunks = [(using, label, pks[start:start + batch_size])
+                          for start in range(0, len(pks), batch_size)]
+
+                started = time.time()
+                indexed = 0
+                pool = None
+                if options['workers'] > 0 and len(chunks) > 1:
+                    reset_connections()
+                    pool = multiprocessing.Pool(options['workers'], initializer=reset_connections)
+                    results = pool.imap_unordered(index_chunk, chunks)
+                else:
+                    results = (index_chunk(chunk) for chunk in chunks)
+                try:
+                    for count in results:
+                        indexed += count
+                        if verbosity > 1:
+                            self.stdout.write("  %s: %d of %d objects, %.0f objects/s" % (
+                                label, indexed, len(pks), rate(indexed, started)))
+                except BaseException:
+                    if pool is not None:
+                        pool.terminate()
+                    raise
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+                if verbosity > 0:
+                    self.stdout.write("%s: %d objects indexed on '%s' in %.1fs (%.0f objects/s)" % (
+                        label, indexed, using, time.time() - started, rate(indexed, started)))
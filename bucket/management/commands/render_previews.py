@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bucket.previews import claim_jobs, run_job, requeue_stale_jobs
+
+
+class Command(BaseCommand):
+    help = "Render queued bucket file previews (PDF conversion and standard thumbnails)."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help="Exit once the queue is empty instead of polling for new jobs."),
+        make_option('--batch', type='int', dest='batch', default=10,
+                    help="Number of jobs claimed at a time."),
+        make_option('--sleep', type='float', dest='sleep', default=2.0,
+                    help="Seconds to wait when the queue is empty."),
+        make_option('--stale-timeout', type='int', dest='stale_timeout', default=600,
+                    help="Requeue jobs left running for more than this many seconds."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+
+        requeued = requeue_stale_jobs(options['stale_timeout'])
+        if requeued and verbosity:
+            self.stdout.write("Requeued %d stale job(s)" % requeued)
+
+        while True:
+            jobs = list(claim_jobs(options['batch']))
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            for job in jobs:
+                ok = run_job(job)
+                if verbosity > 1:
+                    self.stdout.write("%s previews of bucket file %s" % ("Rendered" if ok else "Failed",
+                                                                         job.bucket_file_id))
@@ -1,17 +1,22 @@
 import os
+import shutil
+import tempfile
 import time
 from hashlib import sha1
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.core.files.storage import default_storage
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.utils.text import get_valid_filename
 from django.utils.translation import ugettext as _
 
 from guardian.shortcuts import assign_perm
 
+from jsonfield import JSONField
 from taggit.managers import TaggableManager
 
 class Bucket(models.Model):
@@ -36,9 +41,134 @@ class Experience(models.Model):
     success = models.TextField(null=True, blank=True)
 
 
+def _files_folder():
+    upload_path = getattr(settings, 'BUCKET_FILES_FOLDER')
+    if upload_path[-1] != '/':
+        upload_path += '/'
+    return upload_path
+
+
+def _blob_name(digest, filename):
+    filename = get_valid_filename(os.path.basename(filename))
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(_files_folder(), "%s%s" % (digest, ext))
+
+
+class BlobManager(models.Manager):
+    def store(self, content, filename):
+        """
+        Store `content` (a django File) under the sha1 of its bytes, hashed
+        while it is streamed to disk, and return its Blob with one more
+        reference. If the same bytes are already stored, the new copy is
+        dropped.
+        """
+        folder = default_storage.path(_files_folder())
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        hasher = sha1()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix='.blob-', dir=folder)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    fp.write(chunk)
+            return self.adopt(tmp_path, hasher.hexdigest(), filename, size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def adopt(self, path, digest, filename, size=None):
+        """
+        Turn the file at absolute `path`, whose sha1 is `digest`, into a
+        referenced Blob: it is renamed to its content address, or removed
+        if that content is already stored.
+        """
+        name = _blob_name(digest, filename)
+        if size is None:
+            size = os.path.getsize(path)
+        with transaction.atomic():
+            try:
+                blob = self.select_for_update().get(sha1=digest)
+            except self.model.DoesNotExist:
+                try:
+                    with transaction.atomic():
+                        blob = self.create(sha1=digest, file=name, size=size)
+                except IntegrityError:
+                    # Stored concurrently
+                    blob = self.select_for_update().get(sha1=digest)
+
+            if not default_storage.exists(blob.file.name):
+                os.rename(path, default_storage.path(blob.file.name))
+            elif os.path.exists(path):
+                os.remove(path)
+
+            self.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+            blob.ref_count += 1
+        return blob
+
+    def delete_content(self, digest, name):
+        """
+        Delete the stored content `digest` (at storage `name`) and its
+        derived files (PDF conversion, thumbnails), unless a Blob of that
+        content exists. Returns whether they were deleted.
+        """
+        try:
+            with transaction.atomic():
+                # Holding a row for the content while its files are deleted
+                # makes a concurrent `adopt` of the same content wait for us,
+                # and fails if one was stored meanwhile, committed or not.
+                placeholder = self.create(sha1=digest, file=name)
+                for derived in (name, '%s.pdf' % name):
+                    if default_storage.exists(derived):
+                        default_storage.delete(derived)
+                from .thumbnails import thumbnail_source_folder
+                shutil.rmtree(thumbnail_source_folder("blob-%s" % digest), ignore_errors=True)
+                placeholder.delete()
+        except IntegrityError:
+            return False
+        return True
+
+
+class Blob(models.Model):
+    """
+    Stored content of bucket files, addressed by the sha1 of its bytes and
+    shared by every BucketFile with the same content.
+    """
+    sha1 = models.CharField(max_length=40, unique=True)
+    file = models.FileField(upload_to=_files_folder(), max_length=255)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    def __unicode__(self):
+        return u"Blob %s (%d references)" % (self.sha1, self.ref_count)
+
+    def release(self):
+        """
+        Drop a reference, deleting the content and its derived files
+        (PDF conversion, thumbnails) once nobody uses it anymore.
+        """
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().get(pk=self.pk)
+            blob.ref_count = max(blob.ref_count - 1, 0)
+            if blob.ref_count:
+                Blob.objects.filter(pk=blob.pk).update(ref_count=blob.ref_count)
+                return False
+            blob.delete()
+        return Blob.objects.delete_content(blob.sha1, blob.file.name)
+
+
 class BucketFile(models.Model):
     """
-    A file contained in a bucket
+    A file contained in a bucket.
+
+    Uploaded content is stored once per distinct content (see Blob).
     """
     bucket = models.ForeignKey(Bucket, related_name='files')
     tags = TaggableManager(blank=True)
@@ -71,11 +201,7 @@ class BucketFile(models.Model):
         return u"File  %s from bucket %s" % (self.filename, self.bucket.name)
 
     def _upload_to(instance, filename):
-        upload_path = getattr(settings, 'BUCKET_FILES_FOLDER')
-
-        if upload_path[-1] != '/':
-            upload_path += '/'
-
+        upload_path = _files_folder()
         filename = get_valid_filename(os.path.basename(filename))
         filename, ext = os.path.splitext(filename)
         hash = sha1(str(time.time())).hexdigest()
@@ -84,6 +210,85 @@ class BucketFile(models.Model):
 
     file = models.FileField(upload_to=_upload_to, max_length=255, blank=True, null=True)
     thumbnail_url = models.CharField(max_length=2048)
+    blob = models.ForeignKey(Blob, null=True, blank=True, related_name='bucket_files', on_delete=models.SET_NULL)
+
+    def save(self, *args, **kwargs):
+        if not self.file or self.file._committed:
+            return super(BucketFile, self).save(*args, **kwargs)
+
+        # New content: store it by content instead of under _upload_to
+        upload, previous_blob = self.file, self.blob
+        blob = None
+        try:
+            with transaction.atomic():
+                blob = Blob.objects.store(upload.file, upload.name)
+                self.blob, self.file = blob, blob.file.name
+                super(BucketFile, self).save(*args, **kwargs)
+        except Exception:
+            # The reference was rolled back with the save
+            self.blob, self.file = previous_blob, upload
+            if blob is not None:
+                Blob.objects.delete_content(blob.sha1, blob.file.name)
+            raise
+
+        if previous_blob is not None:
+            previous_blob.release()
+
+
+class PreviewJob(models.Model):
+    """
+    A queued rendering of the previews of a bucket file (PDF conversion and
+    thumbnails), processed by the `render_previews` management command.
+
+    An empty `dim` means "the standard sizes" (BUCKET_PREVIEW_SIZES).
+    `source` identifies the content to render (see
+    bucket.thumbnails.thumbnail_source): files with the same content share
+    their jobs.
+    """
+    STATUS_CHOICES = (
+        ('pending', _("Pending")),
+        ('running', _("Running")),
+        ('failed', _("Failed")),
+    )
+
+    bucket_file = models.ForeignKey(BucketFile, related_name='preview_jobs')
+    source = models.CharField(max_length=100)
+    dim = models.CharField(max_length=20, blank=True)
+    border = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('created_on',)
+        unique_together = ('source', 'dim', 'border')
+
+    def __unicode__(self):
+        return u"Preview job for file %s (%s)" % (self.bucket_file_id, self.status)
+
+class UploadSession(models.Model):
+    """
+    A chunked, resumable upload in progress (see bucket.uploads).
+
+    Chunks are appended to the file stored at `path`, which becomes the
+    BucketFile's file once the upload is finalized.
+    """
+    token = models.CharField(max_length=40, unique=True)
+    bucket = models.ForeignKey(Bucket, related_name='upload_sessions')
+    uploaded_by = models.ForeignKey(User, related_name='upload_sessions')
+    filename = models.CharField(max_length=2048)
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField(null=True, blank=True)
+    offset = models.BigIntegerField(default=0)
+    metadata = JSONField(default={}, blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"Upload of %s (%d bytes received)" % (self.filename, self.offset)
+
 
 @receiver(post_save, sender=Bucket)
 def allow_user_to_edit_buckets(sender, instance, created, *args, **kwargs):
@@ -92,16 +297,37 @@ def allow_user_to_edit_buckets(sender, instance, created, *args, **kwargs):
     assign_perm("delete_bucket", user_or_group=instance.created_by, obj=instance)
 
 
+@receiver(post_init, sender=BucketFile)
+def remember_blob(sender, instance, **kwargs):
+    instance._original_blob_id = instance.__dict__.get('blob_id')
+
+
+@receiver(post_save, sender=BucketFile)
+def enqueue_standard_previews(sender, instance, created, raw=False, *args, **kwargs):
+    """
+    Render the previews of new content ahead of time; saves which leave the
+    content alone (title, tags...) queue nothing.
+    """
+    from .previews import enqueue_previews, previews_are_async
+
+    changed = created or instance.blob_id != instance._original_blob_id
+    instance._original_blob_id = instance.blob_id
+    if raw or not instance.file or not changed or not previews_are_async():
+        return
+    # Failures were about the previous content
+    instance.preview_jobs.filter(status='failed').delete()
+    enqueue_previews(instance)
+
+
 @receiver(post_save, sender=User)
 def allow_user_to_create_bucket_via_api(sender, instance, created, *args, **kwargs):
     if created:
         assign_perm("bucket.add_bucket", instance)
 
-# @receiver(pre_delete, sender=BucketFile)
-# def clear_file(sender, instance, **kwargs):
-#     media_root = getattr(settings, 'MEDIA_ROOT')
-#     basename = os.path.splitext(os.path.basename(instance.file.name))[0]
-#     for i in os.listdir(media_root):
-#         if os.path.isfile(os.path.join(media_root, i)) and basename in i:
-#             os.remove(os.path.join(media_root, i))
-#     instance.file.delete(False)
+@receiver(post_delete, sender=BucketFile)
+def release_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        try:
+            instance.blob.release()
+        except Blob.DoesNotExist:
+            pass
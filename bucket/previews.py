@@ -0,0 +1,168 @@
+"""
+Background rendering of bucket file previews.
+
+Saving a BucketFile enqueues a PreviewJob; the `render_previews` command
+converts office documents to PDF and renders the standard thumbnail sizes
+ahead of time, so ThumbnailView only has to serve finished files (or a
+placeholder while they are being rendered).
+"""
+import datetime
+import logging
+import mimetypes
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.images import ImageFile
+
+from . import conversion
+from .models import PreviewJob
+from .thumbnails import parse_dim, thumbnail_cache_key, thumbnail_cache_path, thumbnail_source, render_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Documents which need to be converted to PDF before being thumbnailed
+PREPROCESS_UNO = ('application/vnd.oasis.opendocument.text',
+                  'application/msword',
+                  'application/vnd.ms-excel',
+                  'application/vnd.ms-powerpoint')
+
+
+def previews_are_async():
+    """
+    When True (the default), previews are rendered by the `render_previews`
+    worker, which must then be running; when False, they are rendered
+    inline by ThumbnailView.
+    """
+    return getattr(settings, 'BUCKET_PREVIEWS_ASYNC', True)
+
+
+def standard_sizes():
+    return getattr(settings, 'BUCKET_PREVIEW_SIZES', ('100x100', '200x200'))
+
+
+def standard_widths():
+    """
+    Widths of the sorl thumbnails (?width=) rendered by the worker.
+    """
+    return [unicode(width) for width in getattr(settings, 'BUCKET_PREVIEW_WIDTHS', ())]
+
+
+def width_thumbnail_is_rendered(target, width):
+    """
+    Whether the sorl thumbnail `get_thumbnail(target, width)` would be
+    served from sorl's key value store instead of being rendered.
+    """
+    backend = default.backend
+    options = {'quality': 80, 'format': 'JPEG'}
+    for key, value in backend.default_options.items():
+        options.setdefault(key, value)
+    name = backend._get_thumbnail_filename(ImageFile(target), width, options)
+    return default.kvstore.get(ImageFile(name, default.storage)) is not None
+
+
+def needs_pdf(bfile):
+    mimetype, encoding = mimetypes.guess_type(bfile.file.name)
+    return mimetype in PREPROCESS_UNO
+
+
+def pdf_name(bfile):
+    """
+    Storage name of the PDF version of an office document.
+    """
+    return '%s.pdf' % bfile.file.name
+
+
+def convert_to_pdf(bfile):
+    """
+    Convert `bfile` to PDF, unless already done (see bucket.conversion).
+    """
+    return conversion.convert_to_pdf(bfile.file.path,
+                                     os.path.join(settings.MEDIA_ROOT, pdf_name(bfile)))
+
+
+def enqueue_previews(bfile, dim='', border=False):
+    """
+    Queue the rendering of `bfile` previews, unless the same previews of
+    its content are already queued, being rendered, or failed for good
+    (failed jobs are dropped when the content of the file changes).
+    Returns the new job, or None.
+    """
+    job, created = PreviewJob.objects.get_or_create(source=thumbnail_source(bfile), dim=dim, border=border,
+                                                    defaults={'bucket_file': bfile})
+    return job if created else None
+
+
+def render_job(job):
+    """
+    Render every artifact requested by `job`.
+    """
+    bfile = job.bucket_file
+    target = bfile.file.name
+    if needs_pdf(bfile):
+        convert_to_pdf(bfile)
+        target = pdf_name(bfile)
+
+    if job.dim:
+        sizes = [(job.dim, job.border)]
+    else:
+        sizes = [(size, False) for size in standard_sizes()]
+        # Also warm the sorl thumbnails requested with ?width=
+        for width in standard_widths():
+            get_thumbnail(target, width, quality=80, format='JPEG')
+
+    for size, border in sizes:
+        dim = parse_dim(size)
+        thumbnail_path = thumbnail_cache_path(thumbnail_cache_key(bfile, dim, border))
+        if not os.path.isfile(thumbnail_path):
+            render_thumbnail(bfile.file.path, dim, border, thumbnail_path)
+
+
+def claim_jobs(limit=10):
+    """
+    Atomically mark up to `limit` pending jobs as running and return them,
+    so that several workers can share the queue. Jobs which failed before
+    wait BUCKET_PREVIEW_RETRY_DELAY seconds between attempts.
+    """
+    retry_limit = datetime.datetime.now() - datetime.timedelta(
+        seconds=getattr(settings, 'BUCKET_PREVIEW_RETRY_DELAY', 300))
+    with transaction.atomic():
+        ids = list(PreviewJob.objects.select_for_update()
+                                     .filter(status='pending')
+                                     .filter(Q(attempts=0) | Q(updated_on__lt=retry_limit))
+                                     .values_list('pk', flat=True)[:limit])
+        PreviewJob.objects.filter(pk__in=ids).update(status='running',
+                                                     updated_on=datetime.datetime.now())
+    return PreviewJob.objects.filter(pk__in=ids).select_related('bucket_file')
+
+
+def run_job(job):
+    """
+    Process a claimed job. Done jobs are deleted, failing ones are retried
+    up to BUCKET_PREVIEW_MAX_ATTEMPTS times, then kept as failed so that
+    they are not queued again.
+    """
+    job.attempts += 1
+    try:
+        render_job(job)
+    except Exception, e:
+        logger.exception("Preview rendering failed for bucket file %s", job.bucket_file_id)
+        max_attempts = getattr(settings, 'BUCKET_PREVIEW_MAX_ATTEMPTS', 3)
+        job.status = 'failed' if job.attempts >= max_attempts else 'pending'
+        job.error = unicode(e)
+        job.save()
+        return False
+
+    job.delete()
+    return True
+
+
+def requeue_stale_jobs(timeout):
+    """
+    Put back in the queue the jobs left running by a dead worker.
+    """
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    return PreviewJob.objects.filter(status='running', updated_on__lt=limit).update(status='pending')
@@ -0,0 +1,164 @@
+"""
+Serving of bucket media (files, thumbnails, previews).
+
+With an offloading SENDFILE_BACKEND (nginx ``X-Accel-Redirect``, Apache
+``X-Sendfile``), the view only checks permissions and validators and the
+front server transfers the bytes, including range requests. With the
+development/simple backends, the file is streamed by Django, with support
+for single ``Range: bytes=`` requests so that videos can be seeked.
+"""
+import os
+import re
+
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_text
+from django.utils.http import urlquote, http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from sendfile import sendfile
+
+# Backends where the front server sends the file
+OFFLOAD_BACKENDS = ('sendfile.backends.nginx',
+                    'sendfile.backends.xsendfile',
+                    'sendfile.backends.mod_wsgi')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def is_offloaded():
+    return getattr(settings, 'SENDFILE_BACKEND', None) in OFFLOAD_BACKENDS
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Return True if the client copy identified by If-None-Match /
+    If-Modified-Since is still fresh.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        try:
+            etags = parse_etags(if_none_match)
+        except ValueError:
+            return False
+        return etag in etags or '*' in etags
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified:
+        if_modified_since = parse_http_date_safe(if_modified_since)
+        return if_modified_since is not None and int(last_modified) <= if_modified_since
+
+    return False
+
+
+def parse_range(request, size, etag):
+    """
+    Return the (first, last) byte positions requested by a single range
+    ``Range`` header, None to send the whole file, or False if the range
+    can't be satisfied.
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range.strip('"') != etag:
+        # Client copy changed: send the whole new version
+        return None
+    match = range_re.match(header.strip())
+    if not match:
+        # Multiple or malformed ranges: ignored, as the RFC allows
+        return None
+
+    first, last = match.groups()
+    if first:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # Suffix range: the last N bytes
+        first = max(size - int(last), 0)
+        last = size - 1
+    else:
+        return None
+    if first > last or first >= size:
+        return False
+    return (first, last)
+
+
+def content_disposition(filename):
+    """
+    ``attachment`` Content-Disposition for `filename`, with an RFC 5987
+    UTF-8 version for non ASCII names.
+    """
+    filename = force_text(filename)
+    ascii_filename = filename.encode('ascii', 'replace').replace('"', '')
+    value = 'attachment; filename="%s"' % ascii_filename
+    if ascii_filename != filename:
+        value += "; filename*=UTF-8''%s" % urlquote(filename)
+    return value
+
+
+def _read_file(path, first, length):
+    with open(path, 'rb') as fp:
+        fp.seek(first)
+        while length > 0:
+            data = fp.read(min(STREAM_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def serve_file(request, path, etag=None, attachment=False, attachment_filename=None,
+               max_age=None, private=True):
+    """
+    Send the file at `path` with Content-Length, ETag, Last-Modified and
+    Cache-Control headers, answering conditional and range requests.
+    `etag` defaults to one derived from the file mtime and size.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise Http404('"%s" does not exist' % path)
+    if etag is None:
+        etag = "%x-%x" % (int(stat.st_mtime), stat.st_size)
+    if max_age is None:
+        max_age = getattr(settings, 'BUCKET_MEDIA_MAX_AGE', 3600)
+
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    elif is_offloaded():
+        response = sendfile(request, path)
+        # The front server sets the length of what it actually sends
+        del response['Content-Length']
+    else:
+        response = sendfile(request, path)
+        byte_range = parse_range(request, stat.st_size, etag)
+        if byte_range is not None:
+            # Replaced by a partial response
+            response.close()
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+        elif byte_range is not None:
+            first, last = byte_range
+            length = last - first + 1
+            partial = StreamingHttpResponse(_read_file(path, first, length), status=206)
+            for header in ('Content-Type', 'Content-Encoding'):
+                if response.has_header(header):
+                    partial[header] = response[header]
+            partial['Content-Range'] = 'bytes %d-%d/%d' % (first, last, stat.st_size)
+            partial['Content-Length'] = length
+            response = partial
+        response['Accept-Ranges'] = 'bytes'
+
+    if attachment and response.status_code != 304:
+        response['Content-Disposition'] = content_disposition(attachment_filename or os.path.basename(path))
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if private:
+        patch_cache_control(response, private=True, max_age=max_age)
+    else:
+        patch_cache_control(response, public=True, max_age=max_age)
+    return response
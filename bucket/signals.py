@@ -1,5 +1,48 @@
+"""
+Signal processors keeping the haystack indexes up to date.
+
+`RelatedRealtimeSignalProcessor` updates the index within the request, on
+every save and delete. `QueuedSignalProcessor` only records which objects
+changed, as "app_label.model_name.pk" identifiers, in a queue where later
+changes of an object replace earlier ones; `process_queue` then updates
+the index in batches, from the `process_search_queue` command or at the end
+of the request (settings.SEARCH_QUEUE_FLUSH_ON_REQUEST). With the latter,
+changes made outside a request (commands, shell, workers) are indexed at
+once, and what is left in the queue when the process exits is flushed.
+
+The queue is the one named by settings.SEARCH_QUEUE_BACKEND:
+
+* `LocalQueue` lives in the process, which suits tests and a single process
+  server flushing at the end of requests,
+* `RedisQueue` is shared by every process (settings.SEARCH_QUEUE_REDIS),
+  and is processed by the `process_search_queue` command.
+"""
 from __future__ import unicode_literals
-from haystack.signals import RealtimeSignalProcessor
+
+import atexit
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.signals import request_finished, request_started
+from django.db import models
+from django.utils.module_loading import import_by_path
+
+from haystack import connection_router, connections
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor, RealtimeSignalProcessor
+from haystack.utils import get_identifier
+
+logger = logging.getLogger(__name__)
+
+UPDATE = 'update'
+DELETE = 'delete'
+
+# Models which are not indexed, but are rendered in the index of others
+PROJECT = 'projects.project'
+ANSWER = 'projectsheet.projectsheetquestionanswer'
 
 
 class RelatedRealtimeSignalProcessor(RealtimeSignalProcessor):
@@ -42,4 +85,243 @@ class RelatedRealtimeSignalProcessor(RealtimeSignalProcessor):
                 })
                 except Exception, e:
                     pass
-        return related
\ No newline at end of file
+        return related
+
+
+class LocalQueue(object):
+    """
+    Queue kept in the memory of the process.
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def push(self, identifier, operation):
+        with self.lock:
+            self.entries.pop(identifier, None)
+            self.entries[identifier] = operation
+
+    def push_back(self, identifier, operation):
+        """
+        Put back an entry taken by `pop`, unless the object changed
+        meanwhile.
+        """
+        with self.lock:
+            self.entries.setdefault(identifier, operation)
+
+    def pop(self, limit):
+        """
+        Remove and return the (identifier, operation) of up to `limit` of
+        the oldest entries.
+        """
+        with self.lock:
+            identifiers = list(self.entries)[:limit]
+            return [(identifier, self.entries.pop(identifier)) for identifier in identifiers]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class RedisQueue(object):
+    """
+    Queue kept in a Redis hash of {identifier: operation}.
+    """
+    # Entries are read and removed in one step, a change recorded meanwhile
+    # would be lost otherwise
+    POP_SCRIPT = """
+        local identifiers = redis.call('HKEYS', KEYS[1])
+        local entries = {}
+        for i = 1, math.min(#identifiers, tonumber(ARGV[1])) do
+            entries[#entries + 1] = identifiers[i]
+            entries[#entries + 1] = redis.call('HGET', KEYS[1], identifiers[i])
+            redis.call('HDEL', KEYS[1], identifiers[i])
+        end
+        return entries
+    """
+
+    def __init__(self, key='dataserver:search_queue'):
+        import redis
+        self.key = key
+        self.redis = redis.StrictRedis(**getattr(settings, 'SEARCH_QUEUE_REDIS', {}))
+        self.pop_script = self.redis.register_script(self.POP_SCRIPT)
+
+    def push(self, identifier, operation):
+        self.redis.hset(self.key, identifier, operation)
+
+    def push_back(self, identifier, operation):
+        self.redis.hsetnx(self.key, identifier, operation)
+
+    def pop(self, limit):
+        entries = [value.decode('utf-8') for value in self.pop_script(keys=[self.key], args=[limit])]
+        return zip(entries[::2], entries[1::2])
+
+    def __len__(self):
+        return self.redis.hlen(self.key)
+
+
+_queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        _queue = import_by_path(getattr(settings, 'SEARCH_QUEUE_BACKEND', 'bucket.signals.LocalQueue'))()
+    return _queue
+
+
+def set_queue(queue):
+    """
+    Replace the queue, e.g. by a fresh LocalQueue in tests.
+    """
+    global _queue
+    _queue = queue
+
+
+def _model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def index_objects(using, label, pks):
+    """
+    Index the `pks` objects of the `label` model ("app_label.model_name")
+    with a single query, through the `index_queryset` of its index, and
+    remove the ones it no longer holds. Return the number of objects
+    indexed.
+    """
+    model = models.get_model(*label.split('.'))
+    try:
+        index = connections[using].get_unified_index().get_index(model)
+    except NotHandled:
+        return 0
+    backend = connections[using].get_backend()
+    objects = list(index.index_queryset(using=using).filter(pk__in=pks))
+    updated = [obj for obj in objects if index.should_update(obj)]
+    if updated:
+        backend.update(index, updated)
+    # Deleted meanwhile, or no longer indexed
+    for pk in set('%s' % pk for pk in pks) - set('%s' % obj.pk for obj in objects):
+        backend.remove('%s.%s' % (label, pk))
+    return len(updated)
+
+
+def process_queue(limit=None):
+    """
+    Update the index for the objects in the queue, up to `limit` of them
+    (settings.SEARCH_QUEUE_BATCH_SIZE by default): one query per model
+    and one bulk update per index. Return the number of entries processed.
+    Entries are put back in the queue if the update fails, unless their
+    object changed meanwhile.
+    """
+    queue = get_queue()
+    entries = queue.pop(limit or getattr(settings, 'SEARCH_QUEUE_BATCH_SIZE', 500))
+    if not entries:
+        return 0
+
+    updates = defaultdict(set)
+    deletes = defaultdict(set)
+    for identifier, operation in entries:
+        label, pk = identifier.rsplit('.', 1)
+        (deletes if operation == DELETE else updates)[label].add(pk)
+
+    # Project sheets are indexed with the title and tags of their project
+    project_pks = updates.pop(PROJECT, None)
+    deletes.pop(PROJECT, None)
+    if project_pks:
+        from projectsheet.models import ProjectSheet
+        updates[_model_label(ProjectSheet)].update(
+            '%s' % pk for pk in ProjectSheet.objects.filter(project__in=project_pks).values_list('pk', flat=True))
+
+    try:
+        for using in connection_router.for_write():
+            for label, pks in updates.items():
+                index_objects(using, label, pks)
+            backend = connections[using].get_backend()
+            for label, pks in deletes.items():
+                for pk in pks:
+                    backend.remove('%s.%s' % (label, pk))
+    except Exception:
+        for identifier, operation in entries:
+            queue.push_back(identifier, operation)
+        raise
+    return len(entries)
+
+
+# Whether the thread is serving a request
+_request_state = threading.local()
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    Record the saved and deleted objects in the search queue, including the
+    objects whose tags changed and the sheets whose answers changed,
+    instead of indexing them in the request.
+    """
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+        self.flush_on_request = getattr(settings, 'SEARCH_QUEUE_FLUSH_ON_REQUEST', False)
+        if self.flush_on_request:
+            request_started.connect(self.handle_request_started)
+            request_finished.connect(self.handle_request_finished)
+            atexit.register(self.flush)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+        request_started.disconnect(self.handle_request_started)
+        request_finished.disconnect(self.handle_request_finished)
+        self.flush_on_request = False
+
+    def is_tracked(self, label):
+        if label == PROJECT:
+            return True
+        return any(label in self.indexed_labels(using) for using in self.connections.connections_info)
+
+    def indexed_labels(self, using):
+        return set(_model_label(model) for model in
+                   self.connections[using].get_unified_index().get_indexed_models())
+
+    def enqueue(self, sender, instance, operation):
+        from taggit.models import TaggedItem
+
+        queue = get_queue()
+        pushed = False
+        if self.is_tracked(_model_label(sender)):
+            queue.push(get_identifier(instance), operation)
+            pushed = True
+        if _model_label(sender) == ANSWER:
+            # Answers are indexed with their sheet
+            queue.push('projectsheet.projectsheet.%s' % instance.projectsheet_id, UPDATE)
+            pushed = True
+        if sender == TaggedItem:
+            # The tagged object is not fetched, only identified
+            content_type = ContentType.objects.get_for_id(instance.content_type_id)
+            label = '%s.%s' % (content_type.app_label, content_type.model)
+            if self.is_tracked(label):
+                queue.push('%s.%s' % (label, instance.object_id), UPDATE)
+                pushed = True
+        if pushed and not getattr(_request_state, 'active', False):
+            # No request end to flush the queue
+            self.flush()
+
+    def handle_save(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance, UPDATE)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue(sender, instance, DELETE)
+
+    def handle_request_started(self, **kwargs):
+        _request_state.active = True
+
+    def handle_request_finished(self, **kwargs):
+        _request_state.active = False
+        self.flush()
+
+    def flush(self):
+        if not self.flush_on_request:
+            return
+        try:
+            while process_queue():
+                pass
+        except Exception:
+            logger.exception("Search queue processing failed")
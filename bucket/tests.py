@@ -5,7 +5,28 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from hashlib import sha1
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError
 from django.test import TestCase
+from django.test.utils import override_settings
+
+from haystack import connection_router, connections
+from taggit.models import Tag
+from tastypie.models import ApiKey
+
+from . import conversion, signals, uploads
+from .models import Blob, Bucket, BucketFile, PreviewJob, UploadSession
+from .previews import claim_jobs, enqueue_previews
 
 
 class SimpleTest(TestCase):
@@ -14,3 +35,346 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class MediaTestCase(TestCase):
+    """
+    Runs with an empty MEDIA_ROOT, removed afterwards.
+    """
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+        self.user = User.objects.create_user('alice', 'alice@example.org', 'secret')
+        self.bucket = Bucket.objects.create(created_by=self.user, name='files')
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_file(self, content='content', name='notes.txt'):
+        return BucketFile.objects.create(bucket=self.bucket, uploaded_by=self.user,
+                                         file=SimpleUploadedFile(name, content))
+
+
+@override_settings(BUCKET_PREVIEWS_ASYNC=True)
+class PreviewJobTest(MediaTestCase):
+    def test_new_file_is_queued(self):
+        bfile = self.create_file()
+        self.assertEqual(PreviewJob.objects.filter(bucket_file=bfile).count(), 1)
+
+    def test_metadata_changes_are_not_queued(self):
+        bfile = self.create_file()
+        PreviewJob.objects.all().delete()
+        bfile.title = 'Notes'
+        bfile.save()
+        bfile = BucketFile.objects.get(pk=bfile.pk)
+        bfile.description = 'Meeting notes'
+        bfile.save()
+        self.assertFalse(PreviewJob.objects.exists())
+
+    def test_new_content_is_queued(self):
+        bfile = self.create_file()
+        PreviewJob.objects.all().delete()
+        bfile.file = SimpleUploadedFile('notes.txt', 'other content')
+        bfile.save()
+        self.assertEqual(PreviewJob.objects.filter(bucket_file=bfile).count(), 1)
+
+    def test_new_content_drops_failed_jobs(self):
+        bfile = self.create_file()
+        PreviewJob.objects.update(status='failed', attempts=3)
+        bfile.file = SimpleUploadedFile('notes.txt', 'other content')
+        bfile.save()
+        self.assertEqual(list(PreviewJob.objects.values_list('status', flat=True)), ['pending'])
+
+    def test_queued_running_and_failed_jobs_are_not_duplicated(self):
+        bfile = self.create_file()
+        for status in ('pending', 'running', 'failed'):
+            PreviewJob.objects.update(status=status)
+            self.assertIsNone(enqueue_previews(bfile))
+        self.assertEqual(PreviewJob.objects.count(), 1)
+
+    def test_files_with_the_same_content_share_jobs(self):
+        self.create_file()
+        other = self.create_file()
+        self.assertIsNone(enqueue_previews(other))
+        self.assertEqual(PreviewJob.objects.count(), 1)
+
+    def test_failed_jobs_wait_before_retrying(self):
+        self.create_file()
+        PreviewJob.objects.update(attempts=1)
+        self.assertEqual(list(claim_jobs()), [])
+        PreviewJob.objects.update(updated_on=datetime.datetime.now() - datetime.timedelta(hours=1))
+        self.assertEqual(len(claim_jobs()), 1)
+
+    def test_jobs_are_unique_per_content(self):
+        bfile = self.create_file()
+        job = PreviewJob.objects.get()
+        self.assertRaises(IntegrityError, PreviewJob.objects.create, bucket_file=bfile, source=job.source)
+
+    def get_width(self, bfile, width):
+        return self.client.get(reverse('bucket-thumbnail', args=[bfile.pk]), {'width': width})
+
+    @override_settings(BUCKET_PREVIEW_WIDTHS=('200',))
+    def test_configured_widths_are_queued(self):
+        os.makedirs(os.path.join(self.media_root, 'images'))
+        with open(os.path.join(self.media_root, 'images', 'defaultfilepreview.jpg'), 'wb') as placeholder:
+            placeholder.write('placeholder')
+        bfile = self.create_file()
+        PreviewJob.objects.all().delete()
+        with override_settings(STATIC_ROOT=self.media_root):
+            response = self.get_width(bfile, '200')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=0', response['Cache-Control'])
+        self.assertEqual(PreviewJob.objects.filter(bucket_file=bfile, dim='').count(), 1)
+
+    @override_settings(BUCKET_PREVIEW_WIDTHS=('200',))
+    def test_other_widths_are_rejected(self):
+        bfile = self.create_file()
+        self.assertEqual(self.get_width(bfile, '4000').status_code, 400)
+
+    @override_settings(BUCKET_PREVIEWS_ASYNC=False)
+    def test_nothing_is_queued_when_rendering_inline(self):
+        self.create_file()
+        self.assertFalse(PreviewJob.objects.exists())
+
+
+@override_settings(BUCKET_PREVIEWS_ASYNC=False, BUCKET_PREVIEW_SIZES=('100x100',))
+class ThumbnailTest(MediaTestCase):
+    def get_thumbnail(self, bfile, dim):
+        return self.client.get(reverse('bucket-thumbnail', args=[bfile.pk]), {'dim': dim})
+
+    def test_configured_sizes_are_rendered(self):
+        bfile = self.create_file()
+        response = self.get_thumbnail(bfile, '100x100')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+
+    def test_other_sizes_are_rejected(self):
+        bfile = self.create_file()
+        for dim in ('200x200', '100', 'axb', '0x0', '-100x-100'):
+            self.assertEqual(self.get_thumbnail(bfile, dim).status_code, 400, dim)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'bucket', 'thumbnails')))
+
+
+class ConversionTest(TestCase):
+    def test_output(self):
+        self.assertEqual(conversion.run_command(['echo', 'converted'], 10), 'converted\n')
+
+    def test_failures(self):
+        self.assertRaises(conversion.ConversionError, conversion.run_command, ['false'], 10)
+
+    def test_hung_commands_are_killed(self):
+        start = time.time()
+        self.assertRaises(conversion.ConversionTimeout, conversion.run_command,
+                          ['sh', '-c', 'sleep 30 & sleep 30'], 0.5)
+        self.assertLess(time.time() - start, 10)
+
+
+class ChunkedUploadTest(MediaTestCase):
+    content = 'x' * 1000 + 'y' * 500
+
+    def setUp(self):
+        super(ChunkedUploadTest, self).setUp()
+        self.auth = 'username=alice&api_key=%s' % ApiKey.objects.get_or_create(user=self.user)[0].key
+
+    def start(self, **data):
+        data.setdefault('bucket', self.bucket.pk)
+        data.setdefault('filename', 'notes.txt')
+        response = self.client.post('%s?%s' % (reverse('bucket-upload-chunked'), self.auth),
+                                    json.dumps(data), content_type='application/json')
+        return response
+
+    def put(self, token, offset, data):
+        return self.client.put('%s?offset=%s&%s' % (reverse('bucket-upload-chunk', args=[token]), offset, self.auth),
+                               data, content_type='application/octet-stream')
+
+    def finalize(self, token, checksum):
+        return self.client.post('%s?sha1=%s&%s' % (reverse('bucket-upload-finalize', args=[token]),
+                                                   checksum, self.auth))
+
+    def test_resumed_upload(self):
+        token = json.loads(self.start(size=len(self.content)).content)['id']
+        self.assertEqual(self.put(token, 0, self.content[:1000]).status_code, 200)
+
+        # A retried chunk starting at the wrong offset is refused
+        response = self.put(token, 0, self.content[:1000])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content)['offset'], 1000)
+
+        # The client asks where to resume
+        response = self.client.get('%s?%s' % (reverse('bucket-upload-chunk', args=[token]), self.auth))
+        self.assertEqual(json.loads(response.content)['offset'], 1000)
+        self.assertEqual(self.put(token, 1000, self.content[1000:]).status_code, 200)
+
+        response = self.finalize(token, sha1(self.content).hexdigest())
+        self.assertEqual(response.status_code, 200)
+        bfile = BucketFile.objects.get()
+        self.assertEqual(open(bfile.file.path, 'rb').read(), self.content)
+        self.assertEqual(bfile.blob.sha1, sha1(self.content).hexdigest())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_chunks_received_by_another_process(self):
+        token = json.loads(self.start().content)['id']
+        self.put(token, 0, self.content[:1000])
+        uploads._hashers.clear()
+        self.put(token, 1000, self.content[1000:])
+        self.assertNotIn(token, uploads._hashers)
+        self.assertEqual(self.finalize(token, sha1(self.content).hexdigest()).status_code, 200)
+
+    def test_checksum_mismatch(self):
+        token = json.loads(self.start().content)['id']
+        self.put(token, 0, self.content)
+        self.assertEqual(self.finalize(token, sha1('other').hexdigest()).status_code, 409)
+        self.assertFalse(BucketFile.objects.exists())
+
+    def test_upload_exceeding_announced_size(self):
+        token = json.loads(self.start(size=10).content)['id']
+        self.assertEqual(self.put(token, 0, self.content).status_code, 409)
+        self.assertEqual(UploadSession.objects.get().offset, 0)
+
+    def test_invalid_input(self):
+        self.assertEqual(self.start(size='big').status_code, 400)
+        self.assertEqual(self.start(size=-1).status_code, 400)
+        token = json.loads(self.start().content)['id']
+        self.assertEqual(self.put(token, 'start', 'data').status_code, 400)
+        self.assertEqual(self.put(token, -5, 'data').status_code, 400)
+
+    def test_hashers_are_bounded(self):
+        for number in range(uploads.MAX_HASHERS + 10):
+            uploads._remember_hasher('token%d' % number, 10, sha1())
+        self.assertEqual(len(uploads._hashers), uploads.MAX_HASHERS)
+        self.assertNotIn('token0', uploads._hashers)
+
+
+class BlobTest(MediaTestCase):
+    def test_same_content_is_stored_once(self):
+        first = self.create_file(name='a.txt')
+        second = self.create_file(name='b.txt')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+    def test_content_is_deleted_with_its_last_file(self):
+        first = self.create_file()
+        second = self.create_file()
+        path = first.blob.file.path
+
+        first.delete()
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+        second.delete()
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_replaced_content_is_released(self):
+        bfile = self.create_file()
+        previous = bfile.blob
+        bfile.file = SimpleUploadedFile('notes.txt', 'new content')
+        bfile.save()
+        self.assertNotEqual(bfile.blob_id, previous.pk)
+        self.assertFalse(Blob.objects.filter(pk=previous.pk).exists())
+        self.assertFalse(os.path.exists(previous.file.path))
+
+    def test_failed_saves_take_no_reference(self):
+        existing = self.create_file('shared')
+        for content in ('shared', 'new'):
+            # No uploader
+            bfile = BucketFile(bucket=self.bucket, file=SimpleUploadedFile('notes.txt', content))
+            self.assertRaises(IntegrityError, bfile.save)
+        self.assertEqual([(blob.pk, blob.ref_count) for blob in Blob.objects.all()], [(existing.blob_id, 1)])
+        self.assertEqual(os.listdir(os.path.dirname(existing.blob.file.path)),
+                         [os.path.basename(existing.blob.file.name)])
+
+    def test_stored_content_is_not_deleted(self):
+        blob = self.create_file().blob
+        self.assertFalse(Blob.objects.delete_content(blob.sha1, blob.file.name))
+        self.assertTrue(os.path.exists(blob.file.path))
+
+
+class RecordingQueue(signals.LocalQueue):
+    def __init__(self):
+        super(RecordingQueue, self).__init__()
+        self.popped = []
+
+    def pop(self, limit):
+        entries = super(RecordingQueue, self).pop(limit)
+        self.popped.extend(entries)
+        return entries
+
+
+class TagSignalProcessor(signals.QueuedSignalProcessor):
+    def is_tracked(self, label):
+        return label == 'taggit.tag'
+
+
+class SearchQueueTest(TestCase):
+    def setUp(self):
+        self.queue = RecordingQueue()
+        signals.set_queue(self.queue)
+        self.processor = None
+
+    def tearDown(self):
+        if self.processor is not None:
+            self.processor.teardown()
+        signals.set_queue(None)
+
+    def start(self, flush_on_request):
+        with self.settings(SEARCH_QUEUE_FLUSH_ON_REQUEST=flush_on_request):
+            self.processor = TagSignalProcessor(connections, connection_router)
+
+    def test_later_changes_replace_earlier_ones(self):
+        self.queue.push('taggit.tag.1', signals.UPDATE)
+        self.queue.push('taggit.tag.2', signals.UPDATE)
+        self.queue.push('taggit.tag.1', signals.DELETE)
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.pop(1), [('taggit.tag.2', signals.UPDATE)])
+        self.assertEqual(self.queue.pop(10), [('taggit.tag.1', signals.DELETE)])
+
+    def test_put_back_entries_do_not_replace_later_changes(self):
+        self.queue.push('taggit.tag.1', signals.UPDATE)
+        self.queue.push('taggit.tag.2', signals.UPDATE)
+        entries = self.queue.pop(10)
+        self.queue.push('taggit.tag.1', signals.DELETE)
+        for identifier, operation in entries:
+            self.queue.push_back(identifier, operation)
+        self.assertEqual(sorted(self.queue.pop(10)), [('taggit.tag.1', signals.DELETE),
+                                                      ('taggit.tag.2', signals.UPDATE)])
+
+    def test_failed_updates_are_put_back(self):
+        def index_objects(using, label, pks):
+            # Deleted during the update
+            self.queue.push('taggit.tag.1', signals.DELETE)
+            raise RuntimeError("Search engine unavailable")
+
+        self.queue.push('taggit.tag.1', signals.UPDATE)
+        self.queue.push('taggit.tag.2', signals.UPDATE)
+        original, signals.index_objects = signals.index_objects, index_objects
+        try:
+            self.assertRaises(RuntimeError, signals.process_queue)
+        finally:
+            signals.index_objects = original
+        self.assertEqual(sorted(self.queue.pop(10)), [('taggit.tag.1', signals.DELETE),
+                                                      ('taggit.tag.2', signals.UPDATE)])
+
+    def test_changes_in_a_request_are_indexed_at_its_end(self):
+        self.start(flush_on_request=True)
+        self.processor.handle_request_started()
+        tag = Tag.objects.create(name='search')
+        self.assertEqual(len(self.queue), 1)
+        self.processor.handle_request_finished()
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.popped, [('taggit.tag.%s' % tag.pk, signals.UPDATE)])
+
+    def test_changes_outside_requests_are_indexed_at_once(self):
+        self.start(flush_on_request=True)
+        tag = Tag.objects.create(name='search')
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.popped, [('taggit.tag.%s' % tag.pk, signals.UPDATE)])
+
+    def test_shared_queues_are_left_to_the_command(self):
+        self.start(flush_on_request=False)
+        tag = Tag.objects.create(name='search')
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(signals.process_queue(), 1)
+        self.assertEqual(self.queue.popped, [('taggit.tag.%s' % tag.pk, signals.UPDATE)])
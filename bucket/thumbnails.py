@@ -0,0 +1,137 @@
+"""
+On-disk thumbnail cache for bucket files.
+
+Thumbnails are stored under ``BUCKET_THUMBNAILS_FOLDER``, in one folder per
+source. Files backed by a Blob use the content address of the blob, so
+duplicates share their thumbnails and a hit never needs to look at the
+original; other files are keyed by file id and source mtime/size. A cache
+hit never opens the original with PIL.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+
+from PIL import Image, ExifTags
+
+from .serving import serve_file
+
+
+def parse_dim(preview_dim):
+    """
+    Parse a ``WIDTHxHEIGHT`` string into a tuple of ints, or raise ValueError.
+    """
+    width, height = preview_dim.lower().split('x')
+    dim = (int(width), int(height))
+    if min(dim) <= 0:
+        raise ValueError("Invalid dimensions '%s'" % preview_dim)
+    return dim
+
+
+def thumbnail_sizes():
+    """
+    Sizes thumbnails can be requested in, from BUCKET_PREVIEW_SIZES: any
+    other size would be rendered and kept on disk for good.
+    """
+    return [parse_dim(size) for size in getattr(settings, 'BUCKET_PREVIEW_SIZES', ('100x100', '200x200'))]
+
+
+def thumbnail_source(bfile):
+    """
+    Identifier of the content thumbnailed for `bfile`.
+    """
+    if bfile.blob_id:
+        return "blob-%s" % bfile.blob.sha1
+    try:
+        stat = os.stat(bfile.file.path)
+        source_state = "%d-%d" % (int(stat.st_mtime), stat.st_size)
+    except OSError:
+        source_state = "missing"
+    return "file-%s-%s" % (bfile.pk, source_state)
+
+
+def thumbnail_cache_key(bfile, dim, border=False):
+    """
+    Build the cache key of a thumbnail: source content and requested
+    geometry/border flag.
+    """
+    return "%s/%dx%d%s" % (thumbnail_source(bfile), dim[0], dim[1], "-border" if border else "")
+
+
+def thumbnail_source_folder(source):
+    folder = getattr(settings, 'BUCKET_THUMBNAILS_FOLDER', 'bucket/thumbnails')
+    return os.path.join(settings.MEDIA_ROOT, folder, source)
+
+
+def thumbnail_cache_path(key):
+    """
+    Absolute path of the cached thumbnail for `key`.
+    """
+    source, name = key.split('/')
+    return os.path.join(thumbnail_source_folder(source), "%s.jpg" % name)
+
+
+def _exif_transpose(image):
+    if not hasattr(image, '_getexif'):  # only present in JPEGs
+        return image
+    for orientation in ExifTags.TAGS.keys():
+        if ExifTags.TAGS[orientation] == 'Orientation':
+            break
+    try:
+        e = image._getexif()  # returns None if no EXIF data
+    except Exception:
+        return image
+    if e is None:
+        return image
+    exif = dict(e.items())
+    orientation = exif.get(orientation)
+    if orientation == 3:
+        image = image.transpose(Image.ROTATE_180)
+    elif orientation == 6:
+        image = image.transpose(Image.ROTATE_270)
+    elif orientation == 8:
+        image = image.transpose(Image.ROTATE_90)
+    return image
+
+
+def render_thumbnail(source_path, dim, border, destination):
+    """
+    Render a JPEG thumbnail of `source_path` fitting in `dim` into
+    `destination`. The image is written to a temporary file first and then
+    renamed, so concurrent readers never see a partial thumbnail.
+    """
+    try:
+        image = Image.open(source_path)
+    except IOError:
+        image = Image.new("RGB", dim, "black")
+    image = _exif_transpose(image)
+    image.thumbnail(dim, Image.ANTIALIAS)
+    if border:
+        background = Image.new('RGBA', dim, (0, 0, 0, 0))
+        background.paste(image, ((dim[0] - image.size[0]) / 2, (dim[1] - image.size[1]) / 2))
+        image = background
+
+    folder = os.path.dirname(destination)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Created concurrently
+            pass
+    fd, tmp_path = tempfile.mkstemp(suffix='.jpg', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            image.save(fp, "JPEG")
+        os.rename(tmp_path, destination)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return destination
+
+
+def serve_cached_thumbnail(request, path, etag):
+    """
+    Send a cached thumbnail with validators, or a 304 if the client has it.
+    """
+    return serve_file(request, path, etag=etag, private=False)
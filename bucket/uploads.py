@@ -0,0 +1,201 @@
+"""
+Chunked, resumable uploads.
+
+The protocol is:
+
+* ``POST /bucket/upload/chunked/`` creates an UploadSession,
+* ``PUT /bucket/upload/chunked/<token>/?offset=N`` appends a chunk, which
+  must start at the current offset of the session,
+* ``GET /bucket/upload/chunked/<token>/`` returns the current offset, so
+  that a client can resume after a dropped connection,
+* ``POST /bucket/upload/chunked/<token>/finalize/`` turns the session into
+  a BucketFile.
+
+Chunks are streamed from the request straight into the stored file, and
+the sha1 of the content is computed as the chunks arrive (or read back
+from the stored file when the chunks were received by several processes).
+"""
+import datetime
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+
+from .models import Blob, BucketFile, UploadSession
+
+CHUNK_READ_SIZE = 64 * 1024
+
+# Partial uploads live here until they are adopted by a Blob
+UPLOADS_FOLDER = 'bucket/uploads'
+
+# Metadata which can be given when creating a session, copied to the
+# BucketFile on finalization
+METADATA_FIELDS = ('title', 'type', 'url', 'description', 'video_id',
+                   'video_provider', 'is_author', 'author', 'review')
+
+# Running sha1 of the last MAX_HASHERS sessions whose chunks this process
+# received, by token: (offset, hasher). They are only a shortcut: when a
+# chunk lands on another process, the sha1 of the session is computed from
+# the stored file on finalization instead.
+MAX_HASHERS = 100
+_hashers = OrderedDict()
+_hashers_lock = threading.Lock()
+
+
+class ChunkError(Exception):
+    pass
+
+
+def create_session(bucket, user, filename, size=None, metadata=None):
+    token = uuid.uuid4().hex
+    path = default_storage.save(os.path.join(UPLOADS_FOLDER, '%s.part' % token), ContentFile(''))
+    session = UploadSession.objects.create(token=token,
+                                           bucket=bucket,
+                                           uploaded_by=user,
+                                           filename=os.path.basename(filename),
+                                           path=path,
+                                           size=size,
+                                           metadata=dict((k, v) for k, v in (metadata or {}).items()
+                                                         if k in METADATA_FIELDS))
+    return session
+
+
+def _remember_hasher(token, offset, hasher):
+    with _hashers_lock:
+        _hashers.pop(token, None)
+        _hashers[token] = (offset, hasher)
+        while len(_hashers) > MAX_HASHERS:
+            _hashers.popitem(last=False)
+
+
+def _forget_hasher(token):
+    with _hashers_lock:
+        _hashers.pop(token, None)
+
+
+def _running_hasher(session):
+    """
+    sha1 of the data received so far, if this process has it, else None.
+    """
+    if session.offset == 0:
+        return sha1()
+    with _hashers_lock:
+        offset, hasher = _hashers.get(session.token, (None, None))
+    return hasher.copy() if offset == session.offset else None
+
+
+def _stored_hasher(session):
+    hasher = sha1()
+    with open(default_storage.path(session.path), 'rb') as fp:
+        remaining = session.offset
+        while remaining > 0:
+            data = fp.read(min(CHUNK_READ_SIZE, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher
+
+
+def append_chunk(session, stream, offset, length=None):
+    """
+    Append the content of `stream` to `session` at `offset`, which must be
+    the number of bytes already received. Returns the new offset.
+
+    On error, the stored data is left as it was before the chunk.
+    """
+    if offset != session.offset:
+        raise ChunkError("Expected offset %d" % session.offset)
+
+    max_length = None
+    if session.size is not None:
+        max_length = session.size - session.offset
+        if length is not None and length > max_length:
+            raise ChunkError("Upload exceeds announced size")
+
+    hasher = _running_hasher(session)
+    received = 0
+    with open(default_storage.path(session.path), 'r+b') as fp:
+        # Drop any trailing bytes of a previously interrupted chunk
+        fp.truncate(session.offset)
+        fp.seek(session.offset)
+        try:
+            while length is None or received < length:
+                to_read = CHUNK_READ_SIZE if length is None else min(CHUNK_READ_SIZE, length - received)
+                data = stream.read(to_read)
+                if not data:
+                    break
+                received += len(data)
+                if max_length is not None and received > max_length:
+                    raise ChunkError("Upload exceeds announced size")
+                fp.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+        except Exception:
+            fp.truncate(session.offset)
+            raise
+
+    session.offset += received
+    UploadSession.objects.filter(pk=session.pk).update(offset=session.offset,
+                                                       updated_on=datetime.datetime.now())
+    if hasher is not None:
+        _remember_hasher(session.token, session.offset, hasher)
+    else:
+        _forget_hasher(session.token)
+    return session.offset
+
+
+def session_sha1(session):
+    return (_running_hasher(session) or _stored_hasher(session)).hexdigest()
+
+
+def finalize_session(session, checksum=None):
+    """
+    Create the BucketFile of a complete upload and delete the session. The
+    stored file is moved in place as the Blob of its content (or dropped if
+    that content is already stored), never copied.
+    """
+    if session.size is not None and session.offset != session.size:
+        raise ChunkError("Upload incomplete: %d of %d bytes received" % (session.offset, session.size))
+    digest = session_sha1(session)
+    if checksum and checksum.lower() != digest:
+        raise ChunkError("Checksum mismatch")
+
+    bfile = BucketFile(bucket=session.bucket,
+                       uploaded_by=session.uploaded_by,
+                       filename=session.filename)
+    for field, value in session.metadata.items():
+        setattr(bfile, field, value)
+    blob = Blob.objects.adopt(default_storage.path(session.path), digest,
+                              session.filename, size=session.offset)
+    bfile.blob = blob
+    bfile.file = blob.file.name
+    bfile.save()
+    bfile.thumbnail_url = reverse('bucket-thumbnail', args=[bfile.pk])
+    bfile.save()
+
+    _forget_hasher(session.token)
+    session.delete()
+    return bfile
+
+
+def purge_sessions(max_age=None):
+    """
+    Delete abandoned sessions and their partial files.
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'BUCKET_UPLOAD_SESSION_EXPIRATION', 24 * 3600)
+    limit = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+    count = 0
+    for session in UploadSession.objects.filter(updated_on__lt=limit):
+        default_storage.delete(session.path)
+        _forget_hasher(session.token)
+        session.delete()
+        count += 1
+    return count
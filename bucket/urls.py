@@ -1,9 +1,13 @@
 from django.conf.urls import patterns, include, url
 
-from .views import UploadView, ThumbnailView
+from .views import UploadView, ThumbnailView, DownloadView, ChunkedUploadView, ChunkedUploadFinalizeView
 
 urlpatterns = patterns('',
     (r'^multiup/', include('multiuploader.urls')),
+    url(r'^upload/chunked/$', ChunkedUploadView.as_view(), name='bucket-upload-chunked'),
+    url(r'^upload/chunked/(?P<token>[0-9a-f]+)/$', ChunkedUploadView.as_view(), name='bucket-upload-chunk'),
+    url(r'^upload/chunked/(?P<token>[0-9a-f]+)/finalize/$', ChunkedUploadFinalizeView.as_view(), name='bucket-upload-finalize'),
     url(r'^upload/', UploadView.as_view(), name='bucket-upload'),
     url(r'^file/(?P<pk>\d+)/thumbnail/', ThumbnailView.as_view(), name='bucket-thumbnail'),        
+    url(r'^file/(?P<pk>\d+)/download/$', DownloadView.as_view(), name='bucket-download'),
 )
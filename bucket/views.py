@@ -1,28 +1,32 @@
 import json
-import mimetypes
 import os.path
-import subprocess
 
 from django.conf import settings
+from django.db import transaction
 from django.core.urlresolvers import reverse
 from django.core.files.uploadedfile import UploadedFile
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.core.exceptions import PermissionDenied
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.edit import FormMixin
 from django.views.generic import View
 from django.utils.decorators import method_decorator
 from django.shortcuts import get_object_or_404
+from django.utils.cache import add_never_cache_headers
 
 from sendfile import sendfile
 from sorl.thumbnail import get_thumbnail
 
-from .models import BucketFile, Experience
+from .models import Bucket, BucketFile, Experience, UploadSession
 from .forms import BucketUploadForm
+from .previews import (PREPROCESS_UNO, previews_are_async, enqueue_previews, standard_widths,
+                       width_thumbnail_is_rendered, needs_pdf, pdf_name, convert_to_pdf)
 
 from .api import BucketFileResource
-
-from PIL import Image, ExifTags
+from .serving import serve_file
+from .uploads import ChunkError, create_session, append_chunk, finalize_session
+from .thumbnails import (parse_dim, thumbnail_cache_key, thumbnail_cache_path, thumbnail_sizes,
+                         render_thumbnail, serve_cached_thumbnail)
 
 class JSONResponseMixin(object):
     """
@@ -47,72 +51,66 @@ class ThumbnailView(View):
     """
     A view for generating thumbnails of documents, pictures and any
     other file supported.
-    FIXME: THIS VIEW IS TERRIBLE: NO CACHE AND NOTHING!
+
+    `dim` thumbnails are cached on disk (see bucket.thumbnails) and
+    served with ETag/Last-Modified validators; only the sizes of
+    BUCKET_PREVIEW_SIZES can be requested. Rendering and PDF conversion
+    are done by the `render_previews` worker (see bucket.previews): until
+    they are ready, a placeholder is served. The worker renders the
+    `width` thumbnails of BUCKET_PREVIEW_WIDTHS too; other widths are only
+    served once rendered.
     """
-    preprocess_uno = ('application/vnd.oasis.opendocument.text', 'application/msword', 'application/vnd.ms-excel', 'application/vnd.ms-powerpoint')
+    preprocess_uno = PREPROCESS_UNO
 
     def get(self, request, *args, **kwargs):
         file_id = self.kwargs['pk']
         preview_width = self.request.GET.get('width', None)
         preview_height = self.request.GET.get('height', None)
         preview_dim = self.request.GET.get('dim', None)
-        border = self.request.GET.get('border', False)
+        border = bool(self.request.GET.get('border', False))
 
         # Lookup bucket file first
-        bfile = get_object_or_404(BucketFile, pk=file_id)
+        bfile = get_object_or_404(BucketFile.objects.select_related('blob'), pk=file_id)
         # FIXME1: BUG in Tastypie causes file/image fields to be reconstructed with absolute path when PATCHing a file (see https://gist.github.com/ratpik/6308307)
         # so we strip off the /media/ if present
         if bfile.file.name[0:6] == "/media":
             bfile.file.name = bfile.file.name[7:]
         target = bfile.file.name
 
-        # Guess mimetype
-        mimetype, encoding = mimetypes.guess_type(bfile.file.url)
+        if preview_dim:
+            try:
+                dim = parse_dim(preview_dim)
+            except ValueError:
+                return HttpResponseBadRequest("Invalid dim '%s', expected WIDTHxHEIGHT." % preview_dim)
+            if dim not in thumbnail_sizes():
+                return HttpResponseBadRequest("Unsupported dim '%s'." % preview_dim)
+            key = thumbnail_cache_key(bfile, dim, border)
+            thumbnail_path = thumbnail_cache_path(key)
+            if not os.path.isfile(thumbnail_path):
+                if previews_are_async():
+                    enqueue_previews(bfile, "%dx%d" % dim, border)
+                    return self.placeholder(request)
+                render_thumbnail(bfile.file.path, dim, border, thumbnail_path)
+            return serve_cached_thumbnail(request, thumbnail_path, key)
 
         # Convert document to PDF first, if needed
-        # FIXME2: bug when several files are loaded => clashes
-        if mimetype in ThumbnailView.preprocess_uno:
-            target = '%s.pdf' % bfile.file.name
-            if  os.path.isfile(os.path.join(settings.MEDIA_ROOT, target)):
-                pass
-            else:
-                conversion_cmd = "unoconv -f pdf -o %s %s" % (os.path.join(settings.MEDIA_ROOT, target),
-                                                              os.path.join(settings.MEDIA_ROOT, bfile.file.name))
-                subprocess.check_output(conversion_cmd.split())
+        if needs_pdf(bfile):
+            target = pdf_name(bfile)
+            if not os.path.isfile(os.path.join(settings.MEDIA_ROOT, target)):
+                if previews_are_async():
+                    enqueue_previews(bfile)
+                    return self.placeholder(request)
+                convert_to_pdf(bfile)
 
-        if preview_dim:
-            d = preview_dim.split('x')
-            d = (int(d[0]), int(d[1]))
-            try:
-                image = Image.open(bfile.file.path)
-            except IOError:
-                image = Image.new("RGB", (int(preview_dim.split("x")[0]), int(preview_dim.split("x")[1])), "black")
-            if hasattr(image, '_getexif'): # only present in JPEGs
-                for orientation in ExifTags.TAGS.keys():
-                    if ExifTags.TAGS[orientation]=='Orientation':
-                        break
-                e = image._getexif()       # returns None if no EXIF data
-                if e is not None:
-                    exif=dict(e.items())
-                    try:
-                        orientation = exif[orientation]
-
-                        if orientation == 3:   image = image.transpose(Image.ROTATE_180)
-                        elif orientation == 6: image = image.transpose(Image.ROTATE_270)
-                        elif orientation == 8: image = image.transpose(Image.ROTATE_90)
-                    except:
-                        pass
-            thumbnail_path =  os.path.join(settings.MEDIA_ROOT, os.path.splitext(os.path.basename(bfile.file.path))[0] + '_thumb_' + preview_dim + '.jpg')
-            image.thumbnail(d, Image.ANTIALIAS)
-            if border :
-                background = Image.new('RGBA', d, (0, 0, 0, 0))
-                background.paste(image,((d[0] - image.size[0]) / 2, (d[1] - image.size[1]) / 2))
-                image = background
-            image.save(thumbnail_path, "JPEG")
-            return sendfile(request, thumbnail_path)
+        geometry = preview_width or preview_height
+        if previews_are_async() and not width_thumbnail_is_rendered(target, geometry):
+            if geometry not in standard_widths():
+                return HttpResponseBadRequest("Unsupported width '%s'." % geometry)
+            enqueue_previews(bfile)
+            return self.placeholder(request)
 
         try:
-            thumbnail = get_thumbnail(target, preview_width or preview_height, quality=80, format='JPEG')
+            thumbnail = get_thumbnail(target, geometry, quality=80, format='JPEG')
         except Exception:
             raise
             thumbnail = None
@@ -122,7 +120,39 @@ class ThumbnailView(View):
             fp = os.path.join(settings.MEDIA_ROOT, thumbnail.name)
         else:
             fp = os.path.join(settings.STATIC_ROOT, 'images/defaultfilepreview.jpg')
-        return sendfile(request, fp)
+        return serve_file(request, fp, private=False)
+
+    def placeholder(self, request):
+        """
+        Default preview, served while the real one is being rendered.
+        Never cached, so clients pick up the real thumbnail once ready.
+        """
+        response = sendfile(request, os.path.join(settings.STATIC_ROOT, 'images/defaultfilepreview.jpg'))
+        add_never_cache_headers(response)
+        return response
+
+class DownloadView(View):
+    """
+    Download a bucket file, for users allowed to view its bucket. The
+    transfer itself is offloaded to the front server when SENDFILE_BACKEND
+    allows it (see bucket.serving). Use ?inline=1 to play media in the
+    browser instead of saving it.
+    """
+    def get(self, request, *args, **kwargs):
+        bfile = get_object_or_404(BucketFile.objects.select_related('blob', 'bucket'), pk=kwargs['pk'])
+        try:
+            BucketFileResource().is_authenticated(request)
+        except:
+            raise PermissionDenied()
+        if not request.user.has_perm('bucket.view_bucket', bfile.bucket):
+            raise PermissionDenied()
+        if not bfile.file:
+            raise Http404()
+
+        return serve_file(request, bfile.file.path,
+                          etag=bfile.blob.sha1 if bfile.blob_id else None,
+                          attachment=not request.GET.get('inline'),
+                          attachment_filename=bfile.filename or os.path.basename(bfile.file.name))
 
 class UploadView(JSONResponseMixin, FormMixin, View):
     """
@@ -234,3 +264,124 @@ class UploadView(JSONResponseMixin, FormMixin, View):
         Once saved, return the object as if we were reading the API (json, ...)
         """
         return self.api_res.get_detail(self.request, pk=self.bf.pk)
+
+
+class ChunkedUploadView(JSONResponseMixin, View):
+    """
+    Chunked and resumable uploads, see bucket.uploads for the protocol.
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        return super(ChunkedUploadView, self).dispatch(*args, **kwargs)
+
+    def authenticate(self, request):
+        self.api_res = BucketFileResource()
+        try:
+            self.api_res.is_authenticated(request)
+        except:
+            raise PermissionDenied()
+
+    def get_session(self, request, token):
+        session = get_object_or_404(UploadSession, token=token)
+        if session.uploaded_by_id != request.user.pk:
+            raise PermissionDenied()
+        return session
+
+    def session_state(self, session):
+        return {'id': session.token, 'offset': session.offset, 'size': session.size}
+
+    def get(self, request, *args, **kwargs):
+        """
+        Current state of an upload, to resume it.
+        """
+        self.authenticate(request)
+        session = self.get_session(request, kwargs['token'])
+        return self.render_to_json_response(self.session_state(session))
+
+    def post(self, request, *args, **kwargs):
+        """
+        Start a new upload.
+        """
+        if 'token' in kwargs:
+            return self.http_method_not_allowed(request, *args, **kwargs)
+        self.authenticate(request)
+        try:
+            data = json.loads(request.body) if request.body else {}
+        except ValueError:
+            data = request.POST.dict()
+
+        bucket = get_object_or_404(Bucket, pk=data.get('bucket'))
+        if not request.user.has_perm('bucket.change_bucket', bucket):
+            raise PermissionDenied()
+        if not data.get('filename'):
+            return self.render_to_json_response({'error': 'missing filename'}, status=400)
+
+        size = data.get('size')
+        if size is not None:
+            try:
+                size = int(size)
+            except (TypeError, ValueError):
+                size = -1
+            if size < 0:
+                return self.render_to_json_response({'error': 'invalid size'}, status=400)
+        session = create_session(bucket, request.user, data['filename'], size=size, metadata=data)
+        return self.render_to_json_response(self.session_state(session), status=201)
+
+    def put(self, request, *args, **kwargs):
+        """
+        Append a chunk, starting at `?offset=` or at the first byte of its
+        Content-Range header.
+        """
+        self.authenticate(request)
+        with transaction.atomic():
+            session = self.get_session(request, kwargs['token'])
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+
+            offset = request.GET.get('offset')
+            content_range = request.META.get('HTTP_CONTENT_RANGE', '')
+            if offset is None and content_range.startswith('bytes '):
+                offset = content_range[6:].split('-')[0]
+            length = request.META.get('CONTENT_LENGTH')
+            try:
+                offset = int(offset or 0)
+            except ValueError:
+                return self.render_to_json_response({'error': 'invalid offset'}, status=400)
+            try:
+                length = int(length) if length else None
+            except ValueError:
+                return self.render_to_json_response({'error': 'invalid Content-Length'}, status=400)
+            if offset < 0 or (length is not None and length < 0):
+                return self.render_to_json_response({'error': 'invalid offset'}, status=400)
+            try:
+                append_chunk(session, request, offset, length)
+            except ChunkError, e:
+                state = self.session_state(session)
+                state['error'] = unicode(e)
+                return self.render_to_json_response(state, status=409)
+
+        return self.render_to_json_response(self.session_state(session))
+
+
+class ChunkedUploadFinalizeView(ChunkedUploadView):
+    """
+    Turn a complete chunked upload into a BucketFile.
+    """
+    def get(self, request, *args, **kwargs):
+        return self.http_method_not_allowed(request, *args, **kwargs)
+
+    def put(self, request, *args, **kwargs):
+        return self.http_method_not_allowed(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        self.authenticate(request)
+        with transaction.atomic():
+            session = self.get_session(request, kwargs['token'])
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            try:
+                bfile = finalize_session(session, checksum=request.GET.get('sha1'))
+            except ChunkError, e:
+                state = self.session_state(session)
+                state['error'] = unicode(e)
+                return self.render_to_json_response(state, status=409)
+
+        return self.api_res.get_detail(request, pk=bfile.pk)
@@ -1,12 +1,92 @@
 import logging
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
 
 from tastypie.authorization import DjangoAuthorization
 from tastypie.http import HttpGone, HttpForbidden, HttpNoContent, HttpMultipleChoices, HttpApplicationError, HttpNotImplemented
-from guardian.shortcuts import get_objects_for_user
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.utils import get_anonymous_user
 
 logger = logging.getLogger(__name__)
 
 
+class PermissionResolver(object):
+    """
+    Object permissions of a user, resolved in bulk.
+
+    The first check on a model loads every object permission the user holds
+    on that model, directly or through their groups (one query each), then
+    every check on that model is answered from memory. Same semantics as
+    `user.has_perm(perm, obj)` with guardian's backend: inactive users have
+    no permission, superusers have them all, anonymous users get the
+    permissions of guardian's anonymous user.
+
+    Use `get_resolver(request)` to share one resolver per request.
+    """
+    def __init__(self, user):
+        self.request_user = user
+        if user.is_anonymous():
+            user = get_anonymous_user()
+        self.user = user
+        # {content type id: {object pk: set of codenames}}
+        self._perms = {}
+
+    def _load(self, ctype):
+        perms = defaultdict(set)
+        user_perms = UserObjectPermission.objects.filter(user=self.user, content_type=ctype)
+        group_perms = GroupObjectPermission.objects.filter(group__user=self.user, content_type=ctype)
+        for queryset in (user_perms, group_perms):
+            for object_pk, codename in queryset.values_list('object_pk', 'permission__codename'):
+                perms[object_pk].add(codename)
+        return perms
+
+    def perms_for_model(self, model):
+        ctype = ContentType.objects.get_for_model(model)
+        if ctype.id not in self._perms:
+            self._perms[ctype.id] = self._load(ctype)
+        return self._perms[ctype.id]
+
+    def has_perm(self, perm, obj):
+        if not self.user.is_active:
+            return False
+        if self.user.is_superuser:
+            return True
+        if obj.pk is None:
+            return False
+        codename = perm.split('.')[-1]
+        return codename in self.perms_for_model(obj).get(unicode(obj.pk), ())
+
+    def filter_queryset(self, perm, queryset, public=None):
+        """
+        Restrict `queryset` to the objects the user has `perm` on, or that
+        match the `public` Q object whatever their permissions. Either way
+        a single query is run on `queryset`.
+        """
+        if not self.user.is_active:
+            return queryset.filter(public) if public is not None else queryset.none()
+        if self.user.is_superuser:
+            return queryset
+        codename = perm.split('.')[-1]
+        pks = [pk for pk, codenames in self.perms_for_model(queryset.model).items()
+               if codename in codenames]
+        allowed = Q(pk__in=pks)
+        if public is not None:
+            allowed |= public
+        return queryset.filter(allowed)
+
+
+def get_resolver(request):
+    """
+    The PermissionResolver of `request.user`, cached on the request.
+    """
+    resolver = getattr(request, '_permission_resolver', None)
+    if resolver is None or resolver.request_user is not request.user:
+        resolver = request._permission_resolver = PermissionResolver(request.user)
+    return resolver
+
+
 class GuardianAuthorization(DjangoAuthorization):
     """
 
@@ -72,7 +152,7 @@ class GuardianAuthorization(DjangoAuthorization):
             can access the item resource.
         """
         self.generic_base_check(object_list, bundle)
-        if not bundle.request.user.has_perm(permission, bundle.obj):
+        if not get_resolver(bundle.request).has_perm(permission, bundle.obj):
             return HttpForbidden("You are not allowed to access that resource.")
 
         return True
@@ -85,7 +165,7 @@ class GuardianAuthorization(DjangoAuthorization):
             TODO: debating whether to return an empty list or HttpNoContent
         """
         self.generic_base_check(object_list, bundle)
-        return get_objects_for_user(bundle.request.user, permission, object_list)
+        return get_resolver(bundle.request).filter_queryset(permission, object_list)
 
     # List Checks
     def create_list(self, object_list, bundle):
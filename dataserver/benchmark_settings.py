@@ -0,0 +1,34 @@
+"""
+Settings for `manage.py api_benchmark` on a workstation: SpatiaLite
+instead of PostGIS, in-process search, no external services.
+"""
+import os
+
+from .settings import *  # NOQA
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+        'NAME': os.environ.get('DATASERVER_BENCHMARK_DATABASE', 'benchmark.sqlite'),
+    }
+}
+SPATIALITE_LIBRARY_PATH = os.environ.get('SPATIALITE_LIBRARY_PATH', 'mod_spatialite')
+
+# Tables are created by syncdb, not by the (PostgreSQL-specific) migrations
+SOUTH_TESTS_MIGRATE = False
+# Synced last: its anonymous user gets AUTHENTICATED_USERS_PERMISSIONS,
+# which must exist by then
+INSTALLED_APPS = tuple(app for app in INSTALLED_APPS if app != 'guardian') + ('guardian',)
+
+HAYSTACK_CONNECTIONS = {
+    'default': {
+        'ENGINE': 'haystack.backends.simple_backend.SimpleEngine',
+    },
+}
+HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.BaseSignalProcessor'
+
+PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
+SENDFILE_BACKEND = 'sendfile.backends.simple'
+
+DEBUG = False
+TEMPLATE_DEBUG = False
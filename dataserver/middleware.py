@@ -0,0 +1,151 @@
+"""
+Opt-in request profiling.
+
+When PROFILING_ENABLED is set, ProfilingMiddleware records for every request
+the number and time of the SQL queries, the cacheops hits and misses (with a
+cacheops version sending the ``cache_read`` signal), the time spent
+serializing tastypie responses and the resource/method served. They are
+sent back in a ``Server-Timing`` header, and requests slower than
+PROFILING_SLOW_REQUEST_MS (or running more than PROFILING_SLOW_REQUEST_QUERIES
+queries) are logged to the ``dataserver.profiling`` logger with their most
+duplicated queries, which is where N+1 patterns show up.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from tastypie.resources import Resource
+
+logger = logging.getLogger('dataserver.profiling')
+
+cache_read = None
+# Importing cacheops installs it, so only when it is enabled
+if 'cacheops' in settings.INSTALLED_APPS:
+    try:
+        from cacheops.signals import cache_read
+    except ImportError:
+        pass
+
+# Literals replaced by `?` to group queries differing by their parameters
+sql_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+sql_in_re = re.compile(r"\bIN \((?:\?, )*\?\)")
+# How the SQLite backend reports queries
+sqlite_query_re = re.compile(r"^QUERY = u?'(.*)' - PARAMS = \(.*\)$", re.DOTALL)
+
+
+def normalize_sql(sql):
+    match = sqlite_query_re.match(sql)
+    if match:
+        sql = match.group(1)
+    sql = sql_literal_re.sub('?', sql)
+    return sql_in_re.sub('IN (...)', sql)
+
+
+def duplicate_queries(queries, limit=5):
+    """
+    Return the `limit` statements run more than once in `queries`, as
+    (count, normalized sql) tuples.
+    """
+    counts = Counter(normalize_sql(query['sql']) for query in queries)
+    return [(count, sql) for sql, count in counts.most_common(limit) if count > 1]
+
+
+def _profiled_serialize(serialize):
+    def wrapper(self, request, data, format, options=None):
+        start = time.time()
+        try:
+            return serialize(self, request, data, format, options)
+        finally:
+            if request is not None and hasattr(request, '_profiling'):
+                request._profiling['serialize'] += time.time() - start
+    wrapper._profiled = True
+    return wrapper
+
+
+class ProfilingMiddleware(object):
+    def __init__(self):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            raise MiddlewareNotUsed()
+        if not getattr(Resource.serialize, '_profiled', False):
+            Resource.serialize = _profiled_serialize(Resource.serialize.im_func)
+        if cache_read is not None:
+            cache_read.connect(self.count_cache_read, weak=False)
+        self.slow_ms = getattr(settings, 'PROFILING_SLOW_REQUEST_MS', 500)
+        self.slow_queries = getattr(settings, 'PROFILING_SLOW_REQUEST_QUERIES', 50)
+        # Profiling of the request being handled by each thread
+        self._local = threading.local()
+
+    def count_cache_read(self, sender, func=None, hit=False, **kwargs):
+        profiling = getattr(self._local, 'profiling', None)
+        if profiling is not None:
+            profiling['cache_hits' if hit else 'cache_misses'] += 1
+
+    def process_request(self, request):
+        request._profiling = {
+            'start': time.time(),
+            'first_query': len(connection.queries),
+            'debug_cursor': connection.use_debug_cursor,
+            'serialize': 0.0,
+            'cache_hits': 0,
+            'cache_misses': 0,
+            'view': None,
+        }
+        # Record queries without DEBUG
+        connection.use_debug_cursor = True
+        self._local.profiling = request._profiling
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not hasattr(request, '_profiling'):
+            return
+        if 'resource_name' in view_kwargs:
+            match = getattr(request, 'resolver_match', None)
+            request._profiling['view'] = '%s:%s' % (view_kwargs['resource_name'],
+                                                    match.url_name if match else view_func.__name__)
+        else:
+            request._profiling['view'] = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        profiling = getattr(request, '_profiling', None)
+        if profiling is None:
+            return response
+        del request._profiling
+        self._local.profiling = None
+        connection.use_debug_cursor = profiling['debug_cursor']
+
+        total = (time.time() - profiling['start']) * 1000
+        queries = connection.queries[profiling['first_query']:]
+        db_time = sum(float(query['time']) for query in queries) * 1000
+        serialize = profiling['serialize'] * 1000
+
+        timings = [
+            'db;dur=%.1f;desc="%d queries"' % (db_time, len(queries)),
+            'serialize;dur=%.1f' % serialize,
+            'total;dur=%.1f' % total,
+        ]
+        if cache_read is not None:
+            timings.append('cache;desc="%d hits, %d misses"' % (profiling['cache_hits'],
+                                                                 profiling['cache_misses']))
+        response['Server-Timing'] = ', '.join(timings)
+
+        if total >= self.slow_ms or len(queries) >= self.slow_queries:
+            logger.warning("Slow request %s %s: %s", request.method, request.path, json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': profiling['view'],
+                'status': response.status_code,
+                'total_ms': round(total, 1),
+                'db_ms': round(db_time, 1),
+                'queries': len(queries),
+                'serialize_ms': round(serialize, 1),
+                'cache_hits': profiling['cache_hits'],
+                'cache_misses': profiling['cache_misses'],
+                'duplicate_queries': duplicate_queries(queries),
+            }))
+        return response
@@ -84,6 +84,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # Only active with PROFILING_ENABLED, first to time the whole request
+    'dataserver.middleware.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -152,6 +154,7 @@ INSTALLED_APPS = (
     'haystack',
     # 'cacheops',
 
+    'base',
     'accounts',
     'bucket',
     'flipflop',
@@ -159,7 +162,6 @@ INSTALLED_APPS = (
     'scout',
     'projects',
     'projectsheet',
-    'graffiti',
 
     'simple_history',
 
@@ -183,7 +185,11 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -191,9 +197,63 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'dataserver.profiling': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
     }
 }
 
+# Request profiling (see dataserver.middleware): Server-Timing headers and a
+# log of the requests slower than PROFILING_SLOW_REQUEST_MS or running more
+# than PROFILING_SLOW_REQUEST_QUERIES queries.
+PROFILING_ENABLED = os.environ.get('DATASERVER_PROFILING', '') == '1'
+PROFILING_SLOW_REQUEST_MS = int(os.environ.get('DATASERVER_PROFILING_SLOW_MS', 500))
+PROFILING_SLOW_REQUEST_QUERIES = int(os.environ.get('DATASERVER_PROFILING_SLOW_QUERIES', 50))
+
+# Markers of scout maps seen below this zoom level are clustered (see
+# scout.api.MarkerResource.get_viewport).
+SCOUT_CLUSTER_MAX_ZOOM = 15
+# Clusters, and markers, sent at most for a map view
+SCOUT_VIEWPORT_MAX_FEATURES = 1000
+
+# GeoJSON tiles of scout data layers (see scout.tiles): cache alias, highest
+# zoom level served, and max-age sent to browsers and CDNs. Tile versions are
+# kept in that cache, which must be shared by every process: the default is
+# a database cache (run `manage.py createcachetable scout_tiles` once),
+# memcached is faster.
+try:
+    CACHES
+
+except NameError:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
+CACHES.setdefault('scout_tiles', {
+    'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+    'LOCATION': 'scout_tiles',
+})
+SCOUT_TILES_CACHE = 'scout_tiles'
+SCOUT_TILES_MAX_ZOOM = 18
+SCOUT_TILES_MAX_AGE = 60
+
+# Compiled scout map documents, by map revision (see
+# scout.api.MapResource.get_detail)
+SCOUT_MAP_DOCUMENTS_CACHE = 'default'
+
+# Geocoding of addresses and markers (see scout.geocoding), resolved by the
+# process_geocoding command. 'scout.geocoding.DummyProvider' works offline.
+SCOUT_GEOCODING_PROVIDER = os.environ.get('DATASERVER_GEOCODING_PROVIDER', 'scout.geocoding.GoogleProvider')
+# Decimals of the coordinates kept for reverse lookups (4 is about 10 m)
+SCOUT_GEOCODING_PRECISION = 4
+# Provider lookups per second
+SCOUT_GEOCODING_RATE_LIMIT = 10
+SCOUT_GEOCODING_MAX_ATTEMPTS = 3
+
 LEAFLET_CONFIG = {
     'TILES_URL': 'http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
     'MINIMAP': True,
@@ -223,6 +283,23 @@ TASTYPIE_DEFAULT_FORMATS = ['json']
 
 # bucket
 BUCKET_FILES_FOLDER = 'bucket'
+BUCKET_THUMBNAILS_FOLDER = 'bucket/thumbnails'
+# Previews are rendered in the background, by `manage.py render_previews`
+# (see README); set to False to render them inline, in the request.
+BUCKET_PREVIEWS_ASYNC = True
+BUCKET_PREVIEW_SIZES = ('100x100', '200x200')
+BUCKET_PREVIEW_WIDTHS = ()
+BUCKET_PREVIEW_MAX_ATTEMPTS = 3
+# Seconds between the attempts of a failing preview job
+BUCKET_PREVIEW_RETRY_DELAY = 300
+# Warm unoconv listeners used for document to PDF conversion (one per port)
+BUCKET_CONVERTERS = 2
+BUCKET_CONVERTER_BASE_PORT = 2002
+# Seconds to wait for a free converter, and a conversion may run for
+BUCKET_CONVERSION_TIMEOUT = 120
+BUCKET_CONVERSION_MAX_TIME = 300
+# Chunked uploads left untouched for longer are purged by `purge_uploads`
+BUCKET_UPLOAD_SESSION_EXPIRATION = 24 * 3600
 
 # multiuploader
 MULTIUPLOADER_FILE_EXPIRATION_TIME = 3600
@@ -252,7 +329,15 @@ MULTIUPLOADER_FORMS_SETTINGS = {
 }
 
 # SENDFILE
-SENDFILE_BACKEND = 'sendfile.backends.development'
+# In production, let the front server transfer media: 'nginx'
+# (X-Accel-Redirect to an `internal` location at SENDFILE_URL aliased to
+# MEDIA_ROOT) or 'xsendfile' (Apache mod_xsendfile). 'development' and
+# 'simple' stream files from Django.
+SENDFILE_BACKEND = 'sendfile.backends.%s' % os.environ.get('DATASERVER_SENDFILE_BACKEND', 'development')
+SENDFILE_ROOT = MEDIA_ROOT
+SENDFILE_URL = os.environ.get('DATASERVER_SENDFILE_URL', '/protected-media')
+# Cache lifetime (seconds) of served bucket files and thumbnails
+BUCKET_MEDIA_MAX_AGE = 3600
 
 # SORL
 # Needed for Pdf conv
@@ -261,17 +346,18 @@ THUMBNAIL_CONVERT = 'gm convert'
 THUMBNAIL_IDENTIFY = 'gm identify'
 # ———————————————————————————————————————————————————————————————————— Cacheops
 
+def redis_db(value):
+    """
+    Connection parameters of a "host:port:db" Redis database setting.
+    """
+    host, port, db = value.split(':', 2)
+    return {'host': host, 'port': int(port), 'db': int(db)}
+
+
 DATASERVER_REDIS_CACHE_DB = os.environ.get('DATASERVER_REDIS_CACHE_DB',
                                            u'127.0.0.1:6379:2')
 
-CACHE_HOST, CACHE_PORT, CACHE_DB_NUM = DATASERVER_REDIS_CACHE_DB.split(':', 3)
-
-CACHEOPS_REDIS = {
-    'host': CACHE_HOST,
-    'port': int(CACHE_PORT),
-    'db': int(CACHE_DB_NUM),
-    'socket_timeout': 5,
-}
+CACHEOPS_REDIS = dict(redis_db(DATASERVER_REDIS_CACHE_DB), socket_timeout=5)
 
 # Not necessary until https://github.com/Suor/django-cacheops/pull/134 is integrated  # NOQA
 CACHEOPS_USE_LOCK = False
@@ -308,3 +394,44 @@ except NameError:
         # need a more granular configuration.
         '*.*': {'ops': 'all', 'timeout': CACHE_ONE_DAY},
     }
+
+# —————————————————————————————————————————————————————————————————————— Events
+
+import warnings
+
+# Change events pushed to clients (see base.events). The in-memory backend
+# only reaches clients connected to the same process, so it is meant for
+# development (DEBUG): deployments use 'base.events.RedisBackend'.
+EVENTS_BACKEND = os.environ.get('DATASERVER_EVENTS_BACKEND',
+                                'base.events.InMemoryBackend' if DEBUG else 'base.events.RedisBackend')
+if not DEBUG and EVENTS_BACKEND == 'base.events.InMemoryBackend':
+    warnings.warn("The in-memory events backend only serves one process, "
+                  "set DATASERVER_EVENTS_BACKEND to 'base.events.RedisBackend' with several processes.")
+
+DATASERVER_REDIS_EVENTS_DB = os.environ.get('DATASERVER_REDIS_EVENTS_DB',
+                                            u'%(host)s:%(port)s:3' % CACHEOPS_REDIS)
+
+EVENTS_REDIS = redis_db(DATASERVER_REDIS_EVENTS_DB)
+
+# Events kept per channel for reconnecting clients
+EVENTS_HISTORY = 100
+# Streams hold a worker: they end after EVENTS_STREAM_TIMEOUT seconds (clients
+# reconnect), long-polls after EVENTS_POLL_TIMEOUT seconds.
+EVENTS_STREAM_TIMEOUT = 55
+EVENTS_POLL_TIMEOUT = 25
+
+# ———————————————————————————————————————————————————————————————— Search queue
+
+# Objects to reindex, recorded by bucket.signals.QueuedSignalProcessor. The
+# local queue is flushed at the end of the requests of its process, and at
+# once outside requests (commands, shell); use 'bucket.signals.RedisQueue'
+# with several processes, and run the process_search_queue command.
+SEARCH_QUEUE_BACKEND = os.environ.get('DATASERVER_SEARCH_QUEUE_BACKEND', 'bucket.signals.LocalQueue')
+SEARCH_QUEUE_FLUSH_ON_REQUEST = SEARCH_QUEUE_BACKEND == 'bucket.signals.LocalQueue'
+# Objects indexed per batch
+SEARCH_QUEUE_BATCH_SIZE = 500
+
+DATASERVER_REDIS_SEARCH_QUEUE_DB = os.environ.get('DATASERVER_REDIS_SEARCH_QUEUE_DB',
+                                                  u'%(host)s:%(port)s:4' % CACHEOPS_REDIS)
+
+SEARCH_QUEUE_REDIS = redis_db(DATASERVER_REDIS_SEARCH_QUEUE_DB)
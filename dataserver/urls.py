@@ -14,6 +14,7 @@ from projectsheet.api import (ProjectSheetResource, ProjectSheetTemplateResource
                               ProjectSheetQuestionAnswerResource, ProjectSheetQuestionResource, QuestionChoiceResource)
 from scout.api import (MapResource, TileLayerResource, DataLayerResource,
                        MarkerResource, MarkerCategoryResource, PostalAddressResource, PlaceResource)
+from ucomment.api import CommentResource
 
 
 admin.autodiscover()
@@ -60,19 +61,6 @@ api.register(ProjectSheetQuestionAnswerResource())
 api.register(ProjectSheetQuestionResource())
 api.register(QuestionChoiceResource())
 
-# Projects Tools
-api.register(ProjectToolResource())
-
-
-# Unisson
-api.register(IngredientResource())
-api.register(EvaluationIngredientResource())
-
-# Prestation
-api.register(PrestationResource())
-api.register(PrestationModuleResource())
-api.register(SelectedModulesResource())
-
 # Graffiti
 api.register(TagResource())
 api.register(TaggedItemResource())
@@ -1,18 +1,71 @@
+import datetime
+from collections import defaultdict
+
 from django.conf.urls import url
+from django.db import transaction
 from tastypie.authorization import DjangoAuthorization, Authorization
 from tastypie.authentication import ApiKeyAuthentication, Authentication
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
 from tastypie.resources import ModelResource
-from tastypie import fields
+from tastypie import fields, http
 from tastypie.utils import trailing_slash
 
 from guardian.shortcuts import assign_perm
 
 from accounts.api import UserResource
-from dataserver.authorization import GuardianAuthorization
+from base.api import PrefetchRelatedMixin
+from base.events import stream_response
+from dataserver.authorization import GuardianAuthorization, get_resolver
+
+from .models import Board, List, Card, Task, CardComment, Label, BoardChange, record_cards_move
+
+
+def _ids(value, name):
+    try:
+        return [int(pk) for pk in value]
+    except (TypeError, ValueError):
+        raise BadRequest("'%s' must be a list of ids." % name)
+
+
+def _dicts(value, name):
+    if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+        raise BadRequest("'%s' must be a list of objects." % name)
+    return value
+
+
+def _batch(data):
+    if not isinstance(data, dict):
+        raise BadRequest("A batch must be an object.")
+    return data
+
+
+def _boards_of(model, ids, board_lookup):
+    """
+    Return {pk: board id} for the objects `ids` of `model`, or raise
+    BadRequest if some do not exist.
+    """
+    ids = set(ids)
+    if not ids:
+        return {}
+    boards = dict(model.objects.filter(pk__in=ids).values_list('pk', board_lookup))
+    missing = ids - set(boards)
+    if missing:
+        raise BadRequest("Unknown %s ids: %s" % (model._meta.model_name, ", ".join(str(pk) for pk in sorted(missing))))
+    return boards
+
+
+def check_board_access(request, board_ids, perm='flipflop.view_board'):
+    """
+    Raise a 403 unless the user holds `perm` on every board of `board_ids`:
+    reading a board takes view_board, batch changes change_board.
+    """
+    resolver = get_resolver(request)
+    for board_id in set(board_ids):
+        if not resolver.has_perm(perm, Board(pk=board_id)):
+            raise ImmediateHttpResponse(response=http.HttpForbidden())
 
-from .models import Board, List, Card, Task, CardComment, Label
 
-class ListResource(ModelResource):
+class ListResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = List.objects.all()
         resource_name = 'flipflop/list'
@@ -23,7 +76,7 @@ class ListResource(ModelResource):
     board = fields.ForeignKey('flipflop.api.BoardResource', 'board')
     cards = fields.ToManyField('flipflop.api.CardResource', 'cards', full=True, null=True, blank=True)    
 
-class BoardResource(ModelResource):
+class BoardResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = Board.objects.all()
         resource_name = 'flipflop/board'
@@ -40,6 +93,102 @@ class BoardResource(ModelResource):
     lists = fields.ToManyField('flipflop.api.ListResource', 'lists', use_in='detail', full=True, null=True, blank=True)
     members = fields.ToManyField(UserResource, attribute='members', null=True, blank=True, full=True, readonly=True)
     labels = fields.ToManyField('flipflop.api.LabelResource', 'labels', null=True, blank=True, full=True)
+    revision = fields.IntegerField(attribute='revision', readonly=True)
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/(?P<pk>\d+)/changes%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_changes'),
+                name="api_board_changes"),
+            url(r"^(?P<resource_name>%s)/(?P<pk>\d+)/events%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_events'),
+                name="api_board_events"),
+        ]
+
+    def get_changes(self, request, **kwargs):
+        """
+        Objects of the board changed after the revision given by `since`:
+        ``{"revision": current revision, "changed": {kind: [objects]},
+        "deleted": {kind: [ids]}}``, kinds being board, list, card, task,
+        label and cardcomment. Lists are sent without their cards, cards as
+        in the card list.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            since = int(request.GET.get('since', 0))
+        except ValueError:
+            raise BadRequest("Invalid revision '%s' provided." % request.GET['since'])
+        try:
+            board = Board.objects.get(pk=kwargs['pk'])
+        except Board.DoesNotExist:
+            return http.HttpNotFound()
+        check_board_access(request, [board.pk])
+
+        changed = defaultdict(list)
+        deleted = defaultdict(list)
+        for kind, object_id, is_deleted in BoardChange.objects.filter(board_id=board.pk, revision__gt=since) \
+                                                              .values_list('kind', 'object_id', 'deleted'):
+            (deleted if is_deleted else changed)[kind].append(object_id)
+
+        data = {
+            'revision': board.revision,
+            'since': since,
+            'changed': {},
+            'deleted': dict(deleted),
+        }
+        resources = {
+            'board': self,
+            'card': CardResource(),
+            'task': TaskResource(),
+            'label': LabelResource(),
+            'cardcomment': CardCommentResource(),
+        }
+        for kind, ids in changed.items():
+            if kind == 'list':
+                data['changed'][kind] = [
+                    {'id': pk, 'title': title, 'board': self.get_resource_uri(board),
+                     'resource_uri': ListResource().get_resource_uri(List(pk=pk))}
+                    for pk, title in List.objects.filter(pk__in=ids).values_list('pk', 'title')
+                ]
+                continue
+            resource = resources[kind]
+            objects = resource.get_object_list(request).filter(pk__in=ids)
+            data['changed'][kind] = [resource.full_dehydrate(resource.build_bundle(obj=obj, request=request),
+                                                             for_list=True)
+                                     for obj in objects]
+
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
+    def get_events(self, request, **kwargs):
+        """
+        Changes of the board as they happen, over Server-Sent Events or
+        long-polling (see `base.events.stream_response`). Each event holds
+        the new revision and the changed ids by kind: clients then get the
+        objects from the change feed.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if not Board.objects.filter(pk=kwargs['pk']).exists():
+            return http.HttpNotFound()
+        check_board_access(request, [int(kwargs['pk'])])
+
+        self.log_throttled_access(request)
+        return stream_response(request, 'flipflop.board.%s' % kwargs['pk'])
+
+    def refresh_revision(self, bundle):
+        # Bumped by the changes of the board, its labels and members
+        bundle.obj.revision = Board.objects.filter(pk=bundle.obj.pk).values_list('revision', flat=True)[0]
+        return bundle
+
+    def save(self, bundle, skip_errors=False):
+        bundle = super(BoardResource, self).save(bundle, skip_errors=skip_errors)
+        return self.refresh_revision(bundle)
 
     def obj_create(self, bundle, **kwargs):
         bundle.obj = Board(created_by=bundle.request.user)
@@ -49,6 +198,7 @@ class BoardResource(ModelResource):
         # Create default labels
         for i in range(1, 6): 
            bundle.obj.labels.create(label="Label %d" % i)
+        self.refresh_revision(bundle)
 
         # Give permission to creator
         # assign_perm('flipflop.change_board', bundle.request.user, bundle.obj)
@@ -65,6 +215,83 @@ class TaskResource(ModelResource):
 
     card = fields.ForeignKey('flipflop.api.CardResource', 'card')
 
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/batch%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_batch'),
+                name="api_task_batch"),
+        ]
+
+    def dispatch_batch(self, request, **kwargs):
+        """
+        Create, update and delete tasks in one transaction. Expects::
+
+            {"create": [{"card": id, "title": "...", "done": false}, ...],
+             "update": [{"id": id, "done": true, "title": "..."}, ...],
+             "delete": [id, ...]}
+
+        and returns the created and updated tasks as id/card/title/done
+        dicts, and the deleted ids.
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = _batch(self.deserialize(request, request.body,
+                                       format=request.META.get('CONTENT_TYPE', 'application/json')))
+        creations = _dicts(data.get('create', []), 'create')
+        updates = _dicts(data.get('update', []), 'update')
+        deletions = _ids(data.get('delete', []), 'delete')
+        try:
+            new_card_ids = [int(task['card']) for task in creations]
+            updated_ids = [int(task['id']) for task in updates]
+        except (KeyError, TypeError, ValueError):
+            raise BadRequest("Tasks to create need a card, tasks to update an id.")
+
+        boards = _boards_of(Card, new_card_ids, 'list__board').values()
+        boards += _boards_of(Task, updated_ids + deletions, 'card__list__board').values()
+        check_board_access(request, boards, 'flipflop.change_board')
+
+        with transaction.atomic():
+            created = Task.objects.create_many([Task(card_id=int(task['card']),
+                                                     title=task.get('title', ''),
+                                                     done=bool(task.get('done', False)))
+                                                for task in creations])
+
+            # Toggles are grouped into one UPDATE per value
+            for done in (True, False):
+                ids = [int(task['id']) for task in updates if 'done' in task and bool(task['done']) == done]
+                if ids:
+                    Task.objects.filter(pk__in=ids).update(done=done)
+            for task in updates:
+                if 'title' in task:
+                    Task.objects.filter(pk=int(task['id'])).update(title=task['title'])
+
+            if deletions:
+                Task.objects.filter(pk__in=deletions).delete()
+            # Deleted tasks go through the signals, created and updated ones
+            # are counted and recorded at once
+            changed_ids = [task.pk for task in created] + updated_ids
+            if changed_ids:
+                changed = list(Task.objects.filter(pk__in=changed_ids).values_list('pk', 'card', 'card__list__board'))
+                Card.objects.update_counters([card_id for pk, card_id, board_id in changed])
+                changes = defaultdict(lambda: defaultdict(list))
+                for pk, card_id, board_id in changed:
+                    changes[board_id]['task'].append(pk)
+                    changes[board_id]['card'].append(card_id)
+                for board_id, board_changes in changes.items():
+                    BoardChange.objects.record(board_id, board_changes)
+
+        columns = ('id', 'card', 'title', 'done')
+        data = {
+            'created': [dict(id=task.pk, card=task.card_id, title=task.title, done=task.done) for task in created],
+            'updated': [dict(zip(columns, values)) for values in
+                        Task.objects.filter(pk__in=updated_ids).exclude(pk__in=deletions).values_list(*columns)],
+            'deleted': deletions,
+        }
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
 class LabelResource(ModelResource):
     class Meta:
         queryset = Label.objects.all()
@@ -72,7 +299,7 @@ class LabelResource(ModelResource):
         authentication = ApiKeyAuthentication()
         authorization = Authorization()
 
-class CardResource(ModelResource):
+class CardResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = Card.objects.all()
         resource_name = 'flipflop/card'
@@ -92,6 +319,7 @@ class CardResource(ModelResource):
     comment_count = fields.IntegerField(attribute='comment_count', readonly=True)
     attachment_count = fields.IntegerField(attribute='attachment_count', readonly=True)
     tasks_done_count = fields.IntegerField(attribute='tasks_done_count', readonly=True)
+    task_count = fields.IntegerField(attribute='task_count', readonly=True)
 
     def hydrate(self, bundle):
         if not bundle.obj.pk:
@@ -99,7 +327,117 @@ class CardResource(ModelResource):
             
         return bundle    
 
-class CardCommentResource(ModelResource):
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/batch%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_batch'),
+                name="api_card_batch"),
+        ]
+
+    def dispatch_batch(self, request, **kwargs):
+        """
+        Reorder, move, relabel, archive and delete cards in one transaction.
+        Expects::
+
+            {"order": [{"list": id, "cards": [id, ...]}, ...],
+             "labels": [{"card": id, "add": [id, ...], "remove": [id, ...]}, ...],
+             "archive": [id, ...],
+             "delete": [id, ...]}
+
+        where each "order" entry gives the new content of a list, top to
+        bottom. Returns the new list/position of the moved cards, the labels
+        of the relabeled cards, and the archived and deleted ids.
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = _batch(self.deserialize(request, request.body,
+                                       format=request.META.get('CONTENT_TYPE', 'application/json')))
+        try:
+            orders = [(int(entry['list']), _ids(entry['cards'], 'cards'))
+                      for entry in _dicts(data.get('order', []), 'order')]
+            label_changes = [(int(change['card']),
+                              _ids(change.get('add', []), 'add'),
+                              _ids(change.get('remove', []), 'remove'))
+                             for change in _dicts(data.get('labels', []), 'labels')]
+        except (KeyError, TypeError, ValueError):
+            raise BadRequest("Malformed card batch.")
+        archived = _ids(data.get('archive', []), 'archive')
+        deleted = _ids(data.get('delete', []), 'delete')
+
+        moved_ids = [card_id for list_id, card_ids in orders for card_id in card_ids]
+        if len(moved_ids) != len(set(moved_ids)):
+            raise BadRequest("A card can only be ordered once.")
+        list_boards = _boards_of(List, [list_id for list_id, card_ids in orders], 'board')
+        card_boards = _boards_of(Card, moved_ids + [change[0] for change in label_changes] + archived + deleted,
+                                 'list__board')
+        check_board_access(request, list_boards.values() + card_boards.values(), 'flipflop.change_board')
+
+        # Labels belong to boards
+        label_ids = set(label_id for change in label_changes for label_id in change[1] + change[2])
+        board_labels = set(Board.labels.through.objects.filter(label__in=label_ids)
+                           .values_list('board', 'label'))
+        for card_id, add, remove in label_changes:
+            for label_id in add + remove:
+                if (card_boards[card_id], label_id) not in board_labels:
+                    raise BadRequest("Label %d is not a label of the board of card %d." % (label_id, card_id))
+
+        now = datetime.datetime.now()
+        with transaction.atomic():
+            for list_id, card_ids in orders:
+                Card.objects.set_positions(list_id, card_ids)
+
+            through = Card.labels.through
+            for card_id, add, remove in label_changes:
+                if remove:
+                    through.objects.filter(card=card_id, label__in=remove).delete()
+            existing = set(through.objects.filter(card__in=[change[0] for change in label_changes])
+                           .values_list('card', 'label'))
+            through.objects.bulk_create([through(card_id=card_id, label_id=label_id)
+                                         for card_id, add, remove in label_changes
+                                         for label_id in set(add) - set(remove)
+                                         if (card_id, label_id) not in existing])
+            if label_changes:
+                Card.objects.filter(pk__in=[change[0] for change in label_changes]).update(modified_date=now)
+
+            if archived:
+                Card.objects.filter(pk__in=archived).update(archived=True, modified_date=now)
+
+            # Deleted cards go through the signals
+            changed = defaultdict(set)
+            moved_between_boards = defaultdict(list)
+            for list_id, card_ids in orders:
+                changed[list_boards[list_id]].update(card_ids)
+                for card_id in card_ids:
+                    if card_boards[card_id] != list_boards[list_id]:
+                        moved_between_boards[(card_boards[card_id], list_boards[list_id])].append(card_id)
+            for card_id in [change[0] for change in label_changes] + archived:
+                changed[card_boards[card_id]].add(card_id)
+            for (previous_board_id, board_id), card_ids in moved_between_boards.items():
+                record_cards_move(card_ids, previous_board_id, board_id)
+            for board_id, card_ids in changed.items():
+                BoardChange.objects.record(board_id, {'card': card_ids - set(deleted)})
+
+            if deleted:
+                Card.objects.filter(pk__in=deleted).delete()
+
+        labels = {}
+        for card_id, label_id in through.objects.filter(card__in=[change[0] for change in label_changes]) \
+                                                .values_list('card', 'label'):
+            labels.setdefault(card_id, []).append(label_id)
+        data = {
+            'moved': [{'id': card_id, 'list': list_id, 'position': position}
+                      for list_id, card_ids in orders
+                      for position, card_id in enumerate(card_ids)],
+            'labels': dict((card_id, sorted(labels.get(card_id, []))) for card_id, add, remove in label_changes),
+            'archived': archived,
+            'deleted': deleted,
+        }
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
+class CardCommentResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = CardComment.objects.all()
         resource_name = 'flipflop/cardcomment'
@@ -115,4 +453,4 @@ class CardCommentResource(ModelResource):
         
 
     user = fields.ForeignKey(UserResource, 'user', full=True)
-    card = fields.ForeignKey(CardResource, 'card')
\ No newline at end of file
+    card = fields.ForeignKey(CardResource, 'card')
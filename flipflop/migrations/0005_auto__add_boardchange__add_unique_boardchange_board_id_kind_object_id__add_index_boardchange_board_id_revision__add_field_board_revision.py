@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'BoardChange'
+        db.create_table(u'flipflop_boardchange', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('board_id', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('kind', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('object_id', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('revision', self.gf('django.db.models.fields.PositiveIntegerField')()),
+            ('deleted', self.gf('django.db.models.fields.BooleanField')(default=False)),
+        ))
+        db.send_create_signal(u'flipflop', ['BoardChange'])
+
+        # Adding unique constraint on 'BoardChange', fields ['board_id', 'kind', 'object_id']
+        db.create_unique(u'flipflop_boardchange', ['board_id', 'kind', 'object_id'])
+
+        # Adding index on 'BoardChange', fields ['board_id', 'revision']
+        db.create_index(u'flipflop_boardchange', ['board_id', 'revision'])
+
+        # Adding field 'Board.revision'
+        db.add_column(u'flipflop_board', 'revision',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Removing index on 'BoardChange', fields ['board_id', 'revision']
+        db.delete_index(u'flipflop_boardchange', ['board_id', 'revision'])
+
+        # Removing unique constraint on 'BoardChange', fields ['board_id', 'kind', 'object_id']
+        db.delete_unique(u'flipflop_boardchange', ['board_id', 'kind', 'object_id'])
+
+        # Deleting model 'BoardChange'
+        db.delete_table(u'flipflop_boardchange')
+
+        # Deleting field 'Board.revision'
+        db.delete_column(u'flipflop_board', 'revision')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'flipflop.board': {
+            'Meta': {'object_name': 'Board'},
+            'created_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'kanban_created'", 'to': u"orm['auth.User']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'labels': ('django.db.models.fields.related.ManyToManyField', [], {'blank': 'True', 'related_name': "'boards'", 'null': 'True', 'symmetrical': 'False', 'to': u"orm['flipflop.Label']"}),
+            'revision': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'flipflop.boardchange': {
+            'Meta': {'unique_together': "(('board_id', 'kind', 'object_id'),)", 'object_name': 'BoardChange', 'index_together': "(('board_id', 'revision'),)"},
+            'board_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'deleted': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'kind': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'revision': ('django.db.models.fields.PositiveIntegerField', [], {})
+        },
+        u'flipflop.card': {
+            'Meta': {'ordering': "('position', 'submitted_date', 'title')", 'object_name': 'Card'},
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'assigned_to': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.User']", 'symmetrical': 'False', 'blank': 'True'}),
+            'comment_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'description': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'due_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'labels': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'to': u"orm['flipflop.Label']", 'null': 'True', 'blank': 'True'}),
+            'list': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'cards'", 'to': u"orm['flipflop.List']"}),
+            'modified_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'position': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'submitted_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'submitter': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'submitted_cards'", 'to': u"orm['auth.User']"}),
+            'task_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'tasks_done_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'flipflop.cardcomment': {
+            'Meta': {'object_name': 'CardComment'},
+            'card': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'comments'", 'to': u"orm['flipflop.Card']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'posted_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'flipflop.label': {
+            'Meta': {'object_name': 'Label'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'label': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'flipflop.list': {
+            'Meta': {'object_name': 'List'},
+            'board': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'lists'", 'to': u"orm['flipflop.Board']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'flipflop.task': {
+            'Meta': {'object_name': 'Task'},
+            'card': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'tasks'", 'to': u"orm['flipflop.Card']"}),
+            'done': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255'})
+        }
+    }
+
+    complete_apps = ['flipflop']
\ No newline at end of file
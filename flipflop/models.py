@@ -1,10 +1,19 @@
-from django.db import models
-from django.db.models.signals import post_save
+import datetime
+
+from collections import defaultdict
+
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import F, Max
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+
+from guardian.models import UserObjectPermission, GroupObjectPermission
+from guardian.shortcuts import assign_perm
 
-from guardian.shortcuts import get_users_with_perms, assign_perm
+from base import events
 
 class Label(models.Model):
     label = models.CharField(max_length=100)
@@ -24,10 +33,20 @@ class Board(models.Model):
     title = models.CharField(_('title'), max_length=100)
 
     labels = models.ManyToManyField(Label, null=True, blank=True, related_name='boards')
-    
-    @property
-    def members(self):
-        return get_users_with_perms(self)
+
+    # Incremented on every change of the board content, see BoardChange
+    revision = models.PositiveIntegerField(default=0)
+
+    # Users holding a permission on the board, directly or through a group
+    # (guardian's get_users_with_perms), maintained by sync_board_members
+    members = models.ManyToManyField(User, related_name='kanban_member_of', blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert') and 'update_fields' not in kwargs:
+            # Do not write back a revision bumped meanwhile
+            kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                       if not field.primary_key and field.name != 'revision']
+        return super(Board, self).save(*args, **kwargs)
 
     def __unicode__(self):
         return self.title
@@ -43,12 +62,64 @@ class List(models.Model):
         return self.title
 
 
+class CardManager(models.Manager):
+    def set_positions(self, list_id, card_ids):
+        """
+        Move the cards `card_ids` to the list `list_id`, in that order, with
+        a single UPDATE.
+        """
+        if not card_ids:
+            return 0
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s = %%s, %s = %%s, %s = CASE %s %s END WHERE %s IN (%s)" % (
+            qn(self.model._meta.db_table),
+            qn('list_id'),
+            qn('modified_date'),
+            qn('position'),
+            qn('id'),
+            ' '.join(['WHEN %s THEN %s'] * len(card_ids)),
+            qn('id'),
+            ', '.join(['%s'] * len(card_ids)),
+        )
+        params = [list_id, datetime.datetime.now()]
+        for position, card_id in enumerate(card_ids):
+            params.extend((card_id, position))
+        params.extend(card_ids)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    def update_counters(self, card_ids):
+        """
+        Recompute the task and comment counters of the cards `card_ids` with
+        a single UPDATE.
+        """
+        card_ids = list(set(card_ids))
+        if not card_ids:
+            return
+        qn = connection.ops.quote_name
+        card_table = qn(self.model._meta.db_table)
+        task_table = qn(Task._meta.db_table)
+        comment_table = qn(CardComment._meta.db_table)
+        count = "(SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s%s)"
+        sql = "UPDATE %s SET %s = %s, %s = %s, %s = %s WHERE %s IN (%s)" % (
+            card_table,
+            qn('task_count'), count % (task_table, task_table, qn('card_id'), card_table, qn('id'), ''),
+            qn('tasks_done_count'), count % (task_table, task_table, qn('card_id'), card_table, qn('id'),
+                                             ' AND %s.%s = %%s' % (task_table, qn('done'))),
+            qn('comment_count'), count % (comment_table, comment_table, qn('card_id'), card_table, qn('id'), ''),
+            qn('id'),
+            ', '.join(['%s'] * len(card_ids)),
+        )
+        connection.cursor().execute(sql, [True] + card_ids)
+
+
 class Card(models.Model):
     """
     A card, describing something, such as a User Story.
     """
     class Meta:
-        ordering = ('submitted_date', 'title')
+        ordering = ('position', 'submitted_date', 'title')
     
     title = models.CharField(_('title'), max_length=100)
     description = models.TextField(_('description'), blank=True)
@@ -63,23 +134,36 @@ class Card(models.Model):
     assigned_to = models.ManyToManyField(User, verbose_name=_('assigned to'), blank=True)
 
     list = models.ForeignKey(List, related_name='cards')
+    # Rank of the card in its list, new cards without one are appended
+    position = models.PositiveIntegerField(default=None, db_index=True)
     labels = models.ManyToManyField(Label, null=True, blank=True)
 
+    # Maintained by the Task and CardComment signals, see update_counters
+    task_count = models.PositiveIntegerField(default=0, editable=False)
+    tasks_done_count = models.PositiveIntegerField(default=0, editable=False)
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = CardManager()
+
+    COUNTERS = ('task_count', 'tasks_done_count', 'comment_count')
+
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            if self.position is None:
+                # New cards go to the bottom of their list
+                last = Card.objects.filter(list_id=self.list_id).aggregate(last=Max('position'))['last']
+                self.position = 0 if last is None else last + 1
+        elif not kwargs.get('force_insert') and 'update_fields' not in kwargs:
+            # Do not write back counters updated meanwhile
+            kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                       if not field.primary_key and field.name not in self.COUNTERS]
+        return super(Card, self).save(*args, **kwargs)
+
     @property
     def completion(self):
-        tasks = self.tasks.all()
-        if len(tasks) == 0:
+        if self.task_count == 0:
             return -1
-        done_tasks = [t for t in tasks if t.done]
-        return float(len(done_tasks)) / len(tasks)
-
-    @property
-    def tasks_done_count(self):
-        return len(self.tasks.filter(done=True))
-    
-    @property
-    def comment_count(self):
-        return len(self.comments.all())
+        return float(self.tasks_done_count) / self.task_count
 
     @property
     def attachment_count(self):
@@ -90,6 +174,38 @@ class Card(models.Model):
 
         
 
+class TaskManager(models.Manager):
+    def create_many(self, tasks):
+        """
+        Insert the unsaved `tasks` without sending the signals, with a
+        single INSERT where the database returns the new ids, and set their
+        primary keys. Counters and changes are then up to the caller.
+        """
+        if not tasks:
+            return tasks
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        columns = ', '.join(qn(column) for column in ('card_id', 'title', 'done'))
+        cursor = connection.cursor()
+        if connection.features.can_return_id_from_insert:
+            sql = "INSERT INTO %s (%s) VALUES %s RETURNING %s" % (
+                table, columns, ', '.join(['(%s, %s, %s)'] * len(tasks)), qn('id'))
+            params = []
+            for task in tasks:
+                params.extend((task.card_id, task.title, task.done))
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+        else:
+            ids = []
+            for task in tasks:
+                cursor.execute("INSERT INTO %s (%s) VALUES (%%s, %%s, %%s)" % (table, columns),
+                               [task.card_id, task.title, task.done])
+                ids.append(connection.ops.last_insert_id(cursor, self.model._meta.db_table, 'id'))
+        for task, pk in zip(tasks, ids):
+            task.pk = pk
+        return tasks
+
+
 class Task(models.Model):
     """
     Something to do, linked to a card
@@ -98,6 +214,8 @@ class Task(models.Model):
     card = models.ForeignKey(Card, related_name='tasks')
     done = models.BooleanField(default=False)
 
+    objects = TaskManager()
+
     def __unicode__(self):
         return self.title
 
@@ -110,7 +228,271 @@ class CardComment(models.Model):
 
     posted_at = models.DateTimeField(auto_now_add=True)    
     text = models.TextField()
+
+
+class BoardChangeManager(models.Manager):
+    def record(self, board_id, changes, deleted=False):
+        """
+        Bump the revision of the board and mark the objects in `changes`
+        ({kind: [object ids]}) as changed, or deleted, at that revision.
+        """
+        changes = dict((kind, set(ids)) for kind, ids in changes.items() if ids)
+        if board_id is None or not changes:
+            return None
+        with transaction.atomic():
+            # The UPDATE locks the board row until the end of the transaction
+            if not Board.objects.filter(pk=board_id).update(revision=F('revision') + 1):
+                # Board being deleted
+                return None
+            revision = Board.objects.filter(pk=board_id).values_list('revision', flat=True)[0]
+            for kind, ids in changes.items():
+                existing = self.filter(board_id=board_id, kind=kind, object_id__in=ids)
+                existing.update(revision=revision, deleted=deleted)
+                new_ids = ids - set(existing.values_list('object_id', flat=True))
+                if new_ids:
+                    try:
+                        with transaction.atomic():
+                            self.bulk_create([BoardChange(board_id=board_id, kind=kind, object_id=object_id,
+                                                          revision=revision, deleted=deleted)
+                                              for object_id in new_ids])
+                    except IntegrityError:
+                        # Recorded concurrently
+                        existing.update(revision=revision, deleted=deleted)
+        events.publish('flipflop.board.%s' % board_id, revision=revision, deleted=deleted,
+                       changes=dict((kind, sorted(ids)) for kind, ids in changes.items()))
+        return revision
+
+
+class BoardChange(models.Model):
+    """
+    Last change of an object of a board, for incremental sync: clients ask
+    for the changes after the board revision they have. Only the last change
+    of each object is kept; deleted objects are kept as tombstones.
+    """
+    KINDS = ('board', 'list', 'card', 'task', 'label', 'cardcomment')
+
+    # Not a foreign key: changes of the content are recorded while a board
+    # is being deleted, they are cleaned up afterwards
+    board_id = models.PositiveIntegerField()
+    kind = models.CharField(max_length=20)
+    object_id = models.PositiveIntegerField()
+    revision = models.PositiveIntegerField()
+    deleted = models.BooleanField(default=False)
+
+    objects = BoardChangeManager()
+
+    class Meta:
+        unique_together = (('board_id', 'kind', 'object_id'),)
+        index_together = (('board_id', 'revision'),)
     
+def record_cards_move(card_ids, previous_board_id, board_id):
+    """
+    Record cards moved to another board: the tasks and comments of the
+    cards move with them.
+    """
+    content = {
+        'task': Task.objects.filter(card__in=card_ids).values_list('pk', flat=True),
+        'cardcomment': CardComment.objects.filter(card__in=card_ids).values_list('pk', flat=True),
+    }
+    BoardChange.objects.record(previous_board_id, dict(content, card=card_ids), deleted=True)
+    BoardChange.objects.record(board_id, content)
+
+
+@receiver(post_init, sender=Task)
+def remember_task_card(sender, instance, *args, **kwargs):
+    instance._original_card_id = instance.card_id
+
+
+@receiver(post_save, sender=Task)
+@receiver(post_delete, sender=Task)
+def record_task_change(sender, instance, *args, **kwargs):
+    deleted = kwargs.get('signal') is post_delete
+    card_ids = set([instance.card_id, instance._original_card_id]) - set([None])
+    Card.objects.update_counters(card_ids)
+
+    # The counters of the cards changed too
+    boards = dict(Card.objects.filter(pk__in=card_ids).values_list('pk', 'list__board'))
+    board_id = boards.get(instance.card_id)
+    BoardChange.objects.record(board_id, {'task': [instance.pk]}, deleted=deleted)
+    BoardChange.objects.record(board_id, {'card': [instance.card_id]})
+    previous_board_id = boards.get(instance._original_card_id)
+    if instance._original_card_id not in (None, instance.card_id):
+        if previous_board_id != board_id:
+            BoardChange.objects.record(previous_board_id, {'task': [instance.pk]}, deleted=True)
+        BoardChange.objects.record(previous_board_id, {'card': [instance._original_card_id]})
+    instance._original_card_id = instance.card_id
+
+
+@receiver(post_save, sender=CardComment)
+@receiver(post_delete, sender=CardComment)
+def record_comment_change(sender, instance, *args, **kwargs):
+    Card.objects.update_counters([instance.card_id])
+    board_id = Card.objects.filter(pk=instance.card_id).values_list('list__board', flat=True).first()
+    BoardChange.objects.record(board_id, {'cardcomment': [instance.pk]}, deleted=kwargs.get('signal') is post_delete)
+    BoardChange.objects.record(board_id, {'card': [instance.card_id]})
+
+
+@receiver(post_save, sender=Board)
+def record_board_change(sender, instance, created, *args, **kwargs):
+    revision = BoardChange.objects.record(instance.pk, {'board': [instance.pk]})
+    if revision is not None:
+        instance.revision = revision
+
+
+@receiver(post_delete, sender=Board)
+def delete_board_changes(sender, instance, *args, **kwargs):
+    BoardChange.objects.filter(board_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=List)
+@receiver(post_delete, sender=List)
+def record_list_change(sender, instance, *args, **kwargs):
+    BoardChange.objects.record(instance.board_id, {'list': [instance.pk]},
+                               deleted=kwargs.get('signal') is post_delete)
+
+
+@receiver(post_init, sender=Card)
+def remember_card_list(sender, instance, *args, **kwargs):
+    instance._original_list_id = instance.list_id
+
+
+@receiver(post_save, sender=Card)
+@receiver(post_delete, sender=Card)
+def record_card_change(sender, instance, *args, **kwargs):
+    deleted = kwargs.get('signal') is post_delete
+    list_ids = set([instance.list_id, instance._original_list_id]) - set([None])
+    boards = dict(List.objects.filter(pk__in=list_ids).values_list('pk', 'board'))
+    board_id = boards.get(instance.list_id)
+    BoardChange.objects.record(board_id, {'card': [instance.pk]}, deleted=deleted)
+
+    previous_board_id = boards.get(instance._original_list_id)
+    if not deleted and previous_board_id not in (None, board_id):
+        record_cards_move([instance.pk], previous_board_id, board_id)
+    instance._original_list_id = instance.list_id
+
+
+@receiver(m2m_changed, sender=Card.labels.through)
+@receiver(m2m_changed, sender=Card.assigned_to.through)
+def record_card_relations_change(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        card_ids = [instance.pk]
+    elif action == 'pre_clear':
+        # From a label or a user
+        card_ids = instance.card_set.values_list('pk', flat=True)
+    else:
+        card_ids = pk_set
+    boards = defaultdict(list)
+    for card_id, board_id in Card.objects.filter(pk__in=card_ids).values_list('pk', 'list__board'):
+        boards[board_id].append(card_id)
+    for board_id, ids in boards.items():
+        BoardChange.objects.record(board_id, {'card': ids})
+
+
+@receiver(m2m_changed, sender=Board.labels.through)
+def record_board_labels_change(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # From a label: pk_set are boards
+        board_ids = pk_set if action != 'pre_clear' else instance.boards.values_list('pk', flat=True)
+        for board_id in board_ids:
+            BoardChange.objects.record(board_id, {'label': [instance.pk]}, deleted=action != 'post_add')
+    else:
+        label_ids = pk_set if action != 'pre_clear' else instance.labels.values_list('pk', flat=True)
+        BoardChange.objects.record(instance.pk, {'label': label_ids}, deleted=action != 'post_add')
+
+
+@receiver(post_save, sender=Label)
+def record_label_change(sender, instance, *args, **kwargs):
+    for board_id in instance.boards.values_list('pk', flat=True):
+        BoardChange.objects.record(board_id, {'label': [instance.pk]})
+
+
+@receiver(pre_delete, sender=Label)
+def record_label_deletion(sender, instance, *args, **kwargs):
+    for board_id in instance.boards.values_list('pk', flat=True):
+        BoardChange.objects.record(board_id, {'label': [instance.pk]}, deleted=True)
+
+
+def sync_board_members(board_ids, user_ids):
+    """
+    Update the membership of the users `user_ids` to the boards `board_ids`
+    from their object permissions.
+    """
+    user_ids = set(user_ids)
+    board_ids = set(Board.objects.filter(pk__in=set(int(pk) for pk in board_ids)).values_list('pk', flat=True))
+    if not board_ids or not user_ids:
+        return
+    ctype = ContentType.objects.get_for_model(Board)
+    object_pks = [unicode(pk) for pk in board_ids]
+    members = set()
+    for manager, user_lookup in ((UserObjectPermission.objects, 'user'),
+                                 (GroupObjectPermission.objects, 'group__user')):
+        permissions = manager.filter(content_type=ctype, object_pk__in=object_pks,
+                                     **{'%s__in' % user_lookup: user_ids})
+        members.update((int(object_pk), user_id)
+                       for object_pk, user_id in permissions.values_list('object_pk', user_lookup))
+
+    through = Board.members.through
+    current = set(through.objects.filter(board__in=board_ids, user__in=user_ids).values_list('board', 'user'))
+    removed = current - members
+    for board_id in set(board_id for board_id, user_id in removed):
+        through.objects.filter(board=board_id, user__in=[u for b, u in removed if b == board_id]).delete()
+    through.objects.bulk_create([through(board_id=board_id, user_id=user_id)
+                                 for board_id, user_id in members - current])
+    for board_id in set(board_id for board_id, user_id in removed | (members - current)):
+        BoardChange.objects.record(board_id, {'board': [board_id]})
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+def sync_members_on_user_permission(sender, instance, *args, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Board).pk:
+        sync_board_members([instance.object_pk], [instance.user_id])
+
+
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+def sync_members_on_group_permission(sender, instance, *args, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Board).pk:
+        sync_board_members([instance.object_pk],
+                           User.objects.filter(groups=instance.group_id).values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def sync_members_on_group_membership(sender, instance, action, reverse, pk_set, *args, **kwargs):
+    if action == 'pre_clear':
+        related = instance.user_set if reverse else instance.groups
+        instance._cleared_pks = list(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_pks', [])
+    elif action not in ('post_add', 'post_remove'):
+        return
+    # From a group: pk_set are users
+    group_ids, user_ids = ([instance.pk], pk_set) if reverse else (pk_set, [instance.pk])
+    board_pks = GroupObjectPermission.objects.filter(content_type=ContentType.objects.get_for_model(Board),
+                                                     group__in=group_ids).values_list('object_pk', flat=True)
+    sync_board_members(board_pks, user_ids)
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_members(sender, instance, *args, **kwargs):
+    # Memberships are deleted without signals before the group permissions
+    instance._board_members = (
+        list(GroupObjectPermission.objects.filter(content_type=ContentType.objects.get_for_model(Board),
+                                                  group=instance).values_list('object_pk', flat=True)),
+        list(instance.user_set.values_list('pk', flat=True)))
+
+
+@receiver(post_delete, sender=Group)
+def sync_members_on_group_deletion(sender, instance, *args, **kwargs):
+    board_pks, user_ids = instance.__dict__.pop('_board_members', ([], []))
+    sync_board_members(board_pks, user_ids)
+
+
 @receiver(post_save, sender=Board)
 def allow_user_to_edit_boards(sender, instance, created, *args, **kwargs):
     assign_perm("view_board", user_or_group=instance.created_by, obj=instance)
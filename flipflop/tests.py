@@ -4,9 +4,17 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
 
+from django.contrib.auth.models import Group, User
+from django.core.urlresolvers import reverse
 from django.test import TestCase
 
+from guardian.shortcuts import assign_perm
+from tastypie.models import ApiKey
+
+from .models import Board, BoardChange, Card, List, Task
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +22,197 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class BoardTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('bob', 'bob@example.org', 'secret')
+        self.board = Board.objects.create(created_by=self.user, title='Board')
+        self.labels = [self.board.labels.create(label='Label %d' % number) for number in range(2)]
+        self.todo = List.objects.create(board=self.board, title='To do')
+        self.done = List.objects.create(board=self.board, title='Done')
+        self.cards = [Card.objects.create(list=self.todo, title='Card %d' % number, submitter=self.user)
+                      for number in range(4)]
+
+    def auth(self, user):
+        return 'username=%s&api_key=%s' % (user.username, ApiKey.objects.get_or_create(user=user)[0].key)
+
+    def url(self, name, resource_name, **kwargs):
+        kwargs.update(api_name='v0', resource_name=resource_name)
+        return reverse(name, kwargs=kwargs)
+
+
+class CardTest(BoardTestCase):
+    def test_new_cards_are_appended(self):
+        self.assertEqual([card.position for card in self.cards], [0, 1, 2, 3])
+        card = Card.objects.create(list=self.done, title='First', submitter=self.user)
+        self.assertEqual(card.position, 0)
+
+    def test_explicit_position(self):
+        card = Card.objects.create(list=self.todo, title='Top', submitter=self.user, position=0)
+        self.assertEqual(Card.objects.get(pk=card.pk).position, 0)
+
+    def test_save_keeps_counters(self):
+        card = Card.objects.get(pk=self.cards[0].pk)
+        Task.objects.create(card=card, title='Task', done=True)
+        card.title = 'Renamed'
+        card.save()
+        card = Card.objects.get(pk=card.pk)
+        self.assertEqual((card.title, card.task_count, card.tasks_done_count), ('Renamed', 1, 1))
+
+    def test_new_cards_with_a_primary_key(self):
+        card = Card(pk=1000, list=self.done, title='Imported', submitter=self.user)
+        card.save()
+        card = Card.objects.get(pk=1000)
+        self.assertEqual((card.title, card.position), ('Imported', 0))
+
+
+class RevisionTest(BoardTestCase):
+    def revision(self):
+        return Board.objects.get(pk=self.board.pk).revision
+
+    def test_revisions_increase(self):
+        board = Board.objects.get(pk=self.board.pk)
+        revisions = [board.revision]
+        response = self.client.patch('%s?%s' % (self.url('api_dispatch_detail', 'flipflop/board', pk=board.pk),
+                                                self.auth(self.user)),
+                                     json.dumps({'title': 'Renamed'}), content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        revisions.append(json.loads(response.content)['revision'])
+        self.assertEqual(revisions[-1], self.revision())
+        Card.objects.create(list=self.todo, title='New', submitter=self.user)
+        revisions.append(self.revision())
+        # Saved from an instance loaded before the changes
+        board.title = 'Stale'
+        board.save()
+        revisions.append(board.revision)
+        Card.objects.filter(pk=self.cards[0].pk)[0].save()
+        revisions.append(self.revision())
+        self.assertEqual(revisions, sorted(set(revisions)))
+
+    def test_new_boards_with_a_primary_key(self):
+        Board(pk=1000, created_by=self.user, title='Imported').save()
+        self.assertEqual(Board.objects.get(pk=1000).title, 'Imported')
+
+    def test_change_feed(self):
+        since = self.revision()
+        card = self.cards[0]
+        card.title = 'Renamed'
+        card.save()
+        deleted = self.cards[1].pk
+        self.cards[1].delete()
+        task = Task.objects.create(card=self.cards[2], title='Task')
+        response = self.client.get('%s?since=%d&%s' % (self.url('api_board_changes', 'flipflop/board',
+                                                                 pk=self.board.pk),
+                                                        since, self.auth(self.user)))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['revision'], self.revision())
+        self.assertEqual(sorted(obj['id'] for obj in data['changed']['card']), [card.pk, self.cards[2].pk])
+        self.assertEqual([obj['id'] for obj in data['changed']['task']], [task.pk])
+        self.assertEqual(data['deleted'], {'card': [deleted]})
+
+        response = self.client.get('%s?since=%d&%s' % (self.url('api_board_changes', 'flipflop/board',
+                                                                 pk=self.board.pk),
+                                                        data['revision'], self.auth(self.user)))
+        self.assertEqual(json.loads(response.content)['changed'], {})
+
+    def test_change_feed_needs_view_permission(self):
+        other = User.objects.create_user('eve', 'eve@example.org', 'secret')
+        response = self.client.get('%s?%s' % (self.url('api_board_changes', 'flipflop/board', pk=self.board.pk),
+                                              self.auth(other)))
+        self.assertEqual(response.status_code, 403)
+
+
+class MembersTest(BoardTestCase):
+    def members(self):
+        return sorted(self.board.members.values_list('username', flat=True))
+
+    def test_group_members(self):
+        other = User.objects.create_user('eve', 'eve@example.org', 'secret')
+        group = Group.objects.create(name='team')
+        assign_perm('view_board', group, self.board)
+        self.assertEqual(self.members(), ['bob'])
+        other.groups.add(group)
+        self.assertEqual(self.members(), ['bob', 'eve'])
+        other.groups.remove(group)
+        self.assertEqual(self.members(), ['bob'])
+
+    def test_deleted_groups(self):
+        other = User.objects.create_user('eve', 'eve@example.org', 'secret')
+        group = Group.objects.create(name='team')
+        group.user_set.add(other)
+        assign_perm('view_board', group, self.board)
+        self.assertEqual(self.members(), ['bob', 'eve'])
+        group.delete()
+        self.assertEqual(self.members(), ['bob'])
+
+
+class BatchTest(BoardTestCase):
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.tasks = [Task.objects.create(card=self.cards[0], title='Task %d' % number) for number in range(3)]
+
+    def post(self, kind, data, user=None):
+        return self.client.post('%s?%s' % (self.url('api_%s_batch' % kind, 'flipflop/%s' % kind),
+                                           self.auth(user or self.user)),
+                                json.dumps(data), content_type='application/json')
+
+    def test_batch_urls(self):
+        self.assertEqual(self.url('api_card_batch', 'flipflop/card'), '/api/v0/flipflop/card/batch/')
+        self.assertEqual(self.url('api_task_batch', 'flipflop/task'), '/api/v0/flipflop/task/batch/')
+
+    def test_card_batch(self):
+        first, second, third, fourth = [card.pk for card in self.cards]
+        response = self.post('card', {
+            'order': [{'list': self.done.pk, 'cards': [third, first]}],
+            'labels': [{'card': second, 'add': [self.labels[0].pk]}],
+            'archive': [fourth],
+        })
+        self.assertEqual(response.status_code, 200)
+        cards = dict((card.pk, card) for card in Card.objects.all())
+        self.assertEqual([(cards[pk].list_id, cards[pk].position) for pk in (third, first)],
+                         [(self.done.pk, 0), (self.done.pk, 1)])
+        self.assertEqual(list(cards[second].labels.values_list('pk', flat=True)), [self.labels[0].pk])
+        self.assertTrue(cards[fourth].archived)
+        self.assertEqual(json.loads(response.content)['labels'], {str(second): [self.labels[0].pk]})
+
+    def test_task_batch(self):
+        revision = Board.objects.get(pk=self.board.pk).revision
+        response = self.post('task', {
+            'create': [{'card': self.cards[1].pk, 'title': 'New', 'done': True},
+                       {'card': self.cards[1].pk, 'title': 'Other'}],
+            'update': [{'id': self.tasks[0].pk, 'done': True, 'title': 'Renamed'}],
+            'delete': [self.tasks[1].pk],
+        })
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual([(task['title'], task['done']) for task in data['created']], [('New', True), ('Other', False)])
+        self.assertEqual(data['updated'], [{'id': self.tasks[0].pk, 'card': self.cards[0].pk,
+                                            'title': 'Renamed', 'done': True}])
+        self.assertEqual(data['deleted'], [self.tasks[1].pk])
+
+        counters = dict((card.pk, (card.task_count, card.tasks_done_count)) for card in Card.objects.all())
+        self.assertEqual(counters[self.cards[0].pk], (2, 1))
+        self.assertEqual(counters[self.cards[1].pk], (2, 1))
+        # Created tasks are in the change feed
+        created = BoardChange.objects.filter(board_id=self.board.pk, kind='task', revision__gt=revision,
+                                             object_id__in=[task['id'] for task in data['created']])
+        self.assertEqual(created.count(), 2)
+
+    def test_viewers_cannot_change(self):
+        viewer = User.objects.create_user('eve', 'eve@example.org', 'secret')
+        assign_perm('view_board', viewer, self.board)
+        self.assertEqual(self.post('card', {'archive': [self.cards[0].pk]}, viewer).status_code, 403)
+        self.assertEqual(self.post('task', {'delete': [self.tasks[0].pk]}, viewer).status_code, 403)
+        self.assertFalse(Card.objects.get(pk=self.cards[0].pk).archived)
+        self.assertTrue(Task.objects.filter(pk=self.tasks[0].pk).exists())
+
+    def test_malformed_batches(self):
+        for kind, data in (('card', ['archive']),
+                           ('card', {'labels': [self.cards[0].pk]}),
+                           ('card', {'order': [{'list': self.todo.pk, 'cards': 'all'}]}),
+                           ('card', {'archive': [9999]}),
+                           ('task', {'create': ['New']}),
+                           ('task', {'update': [{'title': 'No id'}]})):
+            self.assertEqual(self.post(kind, data).status_code, 400, data)
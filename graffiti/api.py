@@ -6,6 +6,8 @@ from django.conf.urls import url
 from tastypie.utils import dict_strip_unicode_keys, trailing_slash
 from django.contrib.contenttypes.models import ContentType
 from tastypie.constants import ALL_WITH_RELATIONS
+from base.api import PrefetchRelatedMixin
+from base.paginator import KeysetPaginator
 from dataserver.authentication import AnonymousApiKeyAuthentication
 from django.http.response import HttpResponse
 from tastypie import http
@@ -40,12 +42,13 @@ class TagResource(ModelResource):
         return bundle
 
 
-class TaggedItemResource(ModelResource):
+class TaggedItemResource(PrefetchRelatedMixin, ModelResource):
     tag = fields.ToOneField(TagResource, 'tag', full=True)
     content_type = fields.CharField(attribute='content_type__model')
 
     class Meta:
         queryset = TaggedItem.objects.all()
+        paginator_class = KeysetPaginator
         resource_name = 'taggeditem'
         allowed_methods = ['get', 'post', 'patch', 'delete']
         authentication = AnonymousApiKeyAuthentication()
@@ -6,6 +6,7 @@ from tastypie import fields
 from .models import Post
 from accounts.models import Profile, ObjectProfileLink
 
+from base.api import PrefetchRelatedMixin
 from graffiti.api import TaggedItemResource
 from dataserver.authentication import AnonymousApiKeyAuthentication
 from tastypie.authorization import DjangoAuthorization
@@ -15,7 +16,7 @@ from tastypie.utils import trailing_slash
 from accounts.api import ProfileResource
 
 
-class PostResource(ModelResource):
+class PostResource(PrefetchRelatedMixin, ModelResource):
 
     """ A post resource """
 
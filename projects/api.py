@@ -1,12 +1,27 @@
+import math
+import operator
+
+from django.conf.urls import url
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db.models import Count, Q
+
+from taggit.models import Tag
+from tastypie.exceptions import BadRequest
+from tastypie.paginator import Paginator
 from tastypie.resources import ModelResource
+from tastypie.utils import trailing_slash
 from tastypie import fields
 
 from .models import Project, ProjectProgressRange, ProjectProgress, ProjectNews
 
 from accounts.api import ProfileResource
-from base.api import HistorizedModelResource
+from base.api import HistorizedModelResource, PrefetchRelatedMixin
+from base.paginator import KeysetPaginator
 from graffiti.api import TaggedItemResource
-from scout.api import PlaceResource
+from scout.api import PlaceResource, parse_bbox
+from scout.tiles import bounds_polygons
 from dataserver.authentication import AnonymousApiKeyAuthentication
 from tastypie.authorization import DjangoAuthorization
 from tastypie.constants import ALL_WITH_RELATIONS
@@ -14,6 +29,9 @@ from tastypie.constants import ALL_WITH_RELATIONS
 
 # from accounts.api import ProfileResource
 
+# Tags counted in the facets of project searches
+MAX_TAG_FACETS = 20
+
 
 class ProjectProgressRangeResource(ModelResource):
     class Meta:
@@ -45,7 +63,7 @@ class ProjectHistoryResource(ModelResource):
         filtering = {'id': ALL_WITH_RELATIONS}
 
 
-class ProjectResource(HistorizedModelResource):
+class ProjectResource(PrefetchRelatedMixin, HistorizedModelResource):
     location = fields.ToOneField(PlaceResource, 'location',
                                  null=True, blank=True, full=True)
     progress = fields.ToOneField(ProjectProgressResource, 'progress',
@@ -54,6 +72,7 @@ class ProjectResource(HistorizedModelResource):
 
     class Meta:
         queryset = Project.objects.all()
+        paginator_class = KeysetPaginator
         allowed_methods = ['get', 'post', 'put', 'patch']
         resource_name = 'project/project'
         always_return_data = True
@@ -66,13 +85,117 @@ class ProjectResource(HistorizedModelResource):
             'location': ALL_WITH_RELATIONS,
         }
 
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/near%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_near'),
+                name="api_project_near"),
+        ] + super(ProjectResource, self).prepend_urls()
+
+    def _float_param(self, request, name):
+        try:
+            return float(request.GET[name])
+        except ValueError:
+            raise BadRequest("Invalid %s '%s' provided." % (name, request.GET[name]))
+
+    def get_near(self, request, **kwargs):
+        """
+        Projects located around a point or in a box, in one query on the
+        indexed positions of their places:
+
+        * `lng` and `lat`: sorts by distance to the point, each project
+          getting its `distance` (km),
+        * `radius` (km, with `lng` and `lat`): projects within the radius,
+        * `k` (with `lng` and `lat`): the k nearest projects,
+        * `bbox` (min_lng,min_lat,max_lng,max_lat): projects in the box,
+        * `tags` (comma separated slugs): projects having all the tags.
+
+        Results are paginated with `limit` and `offset`; ``meta.tags``
+        counts the tags of the matching projects (k excepted), for facets.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        center = None
+        if 'lng' in request.GET or 'lat' in request.GET:
+            if not ('lng' in request.GET and 'lat' in request.GET):
+                raise BadRequest("Both lng and lat are required.")
+            center = Point(self._float_param(request, 'lng'), self._float_param(request, 'lat'), srid=4326)
+            if not (-180 <= center.x <= 180 and -90 <= center.y <= 90):
+                raise BadRequest("Invalid point (%s, %s) provided, coordinates out of range."
+                                 % (request.GET['lng'], request.GET['lat']))
+        if center is None and 'bbox' not in request.GET:
+            raise BadRequest("A point (lng and lat) or a bbox is required.")
+        if center is None and ('radius' in request.GET or 'k' in request.GET):
+            raise BadRequest("radius and k need a point (lng and lat).")
+        k = None
+        if 'k' in request.GET:
+            try:
+                k = int(request.GET['k'])
+            except ValueError:
+                k = -1
+            if k < 0:
+                raise BadRequest("Invalid k '%s' provided." % request.GET['k'])
+
+        objects = self.get_object_list(request).filter(location__geo__isnull=False)
+        if 'bbox' in request.GET:
+            objects = objects.filter(reduce(operator.or_, [Q(location__geo__intersects=polygon) for polygon
+                                                           in bounds_polygons(parse_bbox(request.GET['bbox']))]))
+        if 'radius' in request.GET:
+            radius = self._float_param(request, 'radius')
+            if radius < 0:
+                raise BadRequest("Invalid radius '%s' provided." % request.GET['radius'])
+            # The box around the circle uses the spatial index, the distance
+            # check is exact
+            lat_delta = radius / 111.32
+            lng_delta = radius / (111.32 * max(math.cos(math.radians(center.y)), 0.01))
+            box = Polygon.from_bbox((max(center.x - lng_delta, -180), max(center.y - lat_delta, -90),
+                                     min(center.x + lng_delta, 180), min(center.y + lat_delta, 90)))
+            box.srid = 4326
+            objects = objects.filter(location__geo__bboverlaps=box,
+                                     location__geo__distance_lte=(center, D(km=radius)))
+        for slug in filter(None, request.GET.get('tags', '').split(',')):
+            objects = objects.filter(tags__slug=slug.strip())
+        bundle = self.build_bundle(request=request)
+        objects = self.authorized_read_list(objects, bundle)
+
+        project_type = ContentType.objects.get_for_model(Project)
+        tags = Tag.objects.filter(taggit_taggeditem_items__content_type=project_type,
+                                  taggit_taggeditem_items__object_id__in=objects.order_by().values('pk')) \
+                          .annotate(count=Count('taggit_taggeditem_items')) \
+                          .order_by('-count', 'name')[:MAX_TAG_FACETS]
+
+        if center is not None:
+            objects = objects.distance(center, field_name='location__geo').order_by('distance')
+            if k is not None:
+                objects = objects[:k]
+
+        paginator = Paginator(request.GET, objects, resource_uri=self._build_reverse_url(
+                                  'api_project_near', kwargs={'resource_name': self._meta.resource_name,
+                                                              'api_name': self._meta.api_name}),
+                              limit=self._meta.limit, max_limit=self._meta.max_limit,
+                              collection_name=self._meta.collection_name)
+        data = paginator.page()
+        bundles = []
+        for obj in data[self._meta.collection_name]:
+            bundle = self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+            if center is not None:
+                bundle.data['distance'] = round(obj.distance.km, 3)
+            bundles.append(bundle)
+        data[self._meta.collection_name] = bundles
+        data['meta']['tags'] = [{'slug': tag.slug, 'name': tag.name, 'count': tag.count} for tag in tags]
+
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
     def hydrate_website(self, bundle):
         if "website" in bundle.data and bundle.data["website"]:
             if bundle.data["website"].startswith("http://") == False ^ bundle.data["website"].startswith("https://") == False:
                 bundle.data["website"] = "http://" + bundle.data["website"]
         return bundle
 
-class ProjectNewsResource(ModelResource):
+class ProjectNewsResource(PrefetchRelatedMixin, ModelResource):
     author = fields.ToOneField(ProfileResource, 'author', full=True)
 
     class Meta:
@@ -1,6 +1,7 @@
 """ Projects and related models. """
 
 from django.db import models
+from django.contrib.gis.db.models import GeoManager
 # from django.contrib.auth.models import Group
 from simple_history.models import HistoricalRecords
 
@@ -68,6 +69,9 @@ class Project(models.Model):
 
     history = HistoricalRecords()
 
+    # Spatial lookups through `location`
+    objects = GeoManager()
+
     def __unicode__(self):
         """ pep257, you know I love you. """
         return self.title
@@ -0,0 +1,65 @@
+import json
+
+from django.contrib.gis.geos import Point
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from scout.models import Place
+
+from .models import Project
+
+
+class NearTest(TestCase):
+    def setUp(self):
+        for title, lng, lat, tags in (('paris', 2.35, 48.85, ['green', 'city']),
+                                      ('london', -0.13, 51.5, ['city']),
+                                      ('lyon', 4.83, 45.76, ['green'])):
+            project = Project.objects.create(title=title, location=Place.objects.create(geo=Point(lng, lat)))
+            project.tags.add(*tags)
+        Project.objects.create(title='nowhere').tags.add('green')
+
+    def near(self, status_code=200, **params):
+        params['format'] = 'json'
+        response = self.client.get(reverse('api_project_near', kwargs={'api_name': 'v0',
+                                                                       'resource_name': 'project/project'}),
+                                   params)
+        self.assertEqual(response.status_code, status_code, response.content)
+        return json.loads(response.content)
+
+    def titles(self, **params):
+        return [project['title'] for project in self.near(**params)['objects']]
+
+    def test_distance_ordering(self):
+        projects = self.near(lng=2.35, lat=48.85)['objects']
+        self.assertEqual([project['title'] for project in projects], ['paris', 'london', 'lyon'])
+        self.assertEqual(projects[0]['distance'], 0)
+        self.assertTrue(300 < projects[1]['distance'] < projects[2]['distance'] < 450)
+
+    def test_radius(self):
+        self.assertEqual(self.titles(lng=2.35, lat=48.85, radius=200), ['paris'])
+        self.assertEqual(self.titles(lng=2.35, lat=48.85, radius=370), ['paris', 'london'])
+
+    def test_k_nearest(self):
+        self.assertEqual(self.titles(lng=4.8, lat=45.7, k=2), ['lyon', 'paris'])
+        self.assertEqual(self.titles(lng=4.8, lat=45.7, k=0), [])
+
+    def test_bbox(self):
+        self.assertEqual(sorted(self.titles(bbox='-1,48,3,52')), ['london', 'paris'])
+        self.assertEqual(self.titles(bbox='-1,48,3,52', lng=-0.1, lat=51.5), ['london', 'paris'])
+
+    def test_tags(self):
+        self.assertEqual(self.titles(lng=2.35, lat=48.85, tags='green'), ['paris', 'lyon'])
+        self.assertEqual(self.titles(lng=2.35, lat=48.85, tags='green,city'), ['paris'])
+
+    def test_tag_facets(self):
+        facets = self.near(bbox='-180,-90,180,90')['meta']['tags']
+        self.assertEqual([(tag['slug'], tag['count']) for tag in facets], [('city', 2), ('green', 2)])
+        facets = self.near(lng=2.35, lat=48.85, tags='green')['meta']['tags']
+        self.assertEqual([(tag['slug'], tag['count']) for tag in facets], [('green', 2), ('city', 1)])
+
+    def test_invalid_parameters(self):
+        for params in ({}, {'lng': 2}, {'lng': 'east', 'lat': 48}, {'lng': 200, 'lat': 48},
+                       {'lng': 2, 'lat': -91}, {'bbox': '0,0,10'}, {'bbox': '0,0,10,10', 'k': 2},
+                       {'lng': 2, 'lat': 48, 'k': 'two'}, {'lng': 2, 'lat': 48, 'k': -1},
+                       {'lng': 2, 'lat': 48, 'radius': 'far'}, {'lng': 2, 'lat': 48, 'radius': -5}):
+            self.near(status_code=400, **params)
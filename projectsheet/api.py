@@ -10,7 +10,7 @@ from tastypie.paginator import Paginator
 from tastypie.utils import trailing_slash
 
 from dataserver.authentication import AnonymousApiKeyAuthentication
-from base.api import HistorizedModelResource
+from base.api import HistorizedModelResource, PrefetchRelatedMixin
 from bucket.api import BucketResource, BucketFileResource
 from projects.api import ProjectResource
 from projects.models import Project
@@ -42,7 +42,7 @@ class ProjectSheetQuestionResource(ModelResource):
         return bundle
 
 
-class ProjectSheetTemplateResource(ModelResource):
+class ProjectSheetTemplateResource(PrefetchRelatedMixin, ModelResource):
     questions = fields.ToManyField(ProjectSheetQuestionResource,
                                    'questions', full=True, null=True)
 
@@ -60,7 +60,7 @@ class ProjectSheetTemplateResource(ModelResource):
         }
 
 
-class ProjectSheetQuestionAnswerResource(ModelResource):
+class ProjectSheetQuestionAnswerResource(PrefetchRelatedMixin, ModelResource):
     question = fields.ToOneField(ProjectSheetQuestionResource, 'question', full=True)
     projectsheet = fields.ToOneField("projectsheet.api.ProjectSheetResource", 'projectsheet')
     selected_choices_id = fields.ListField(attribute='selected_choices_id', null=True)
@@ -81,7 +81,7 @@ class ProjectSheetHistoryResource(ModelResource):
         filtering = {'id': ALL_WITH_RELATIONS}
 
 
-class ProjectSheetResource(HistorizedModelResource):
+class ProjectSheetResource(PrefetchRelatedMixin, HistorizedModelResource):
     project = fields.ToOneField(ProjectResource, 'project', full=True)
     template = fields.ToOneField(ProjectSheetTemplateResource, 'template')
     template_file = fields.CharField(attribute='template__template_file', null=True)
@@ -1,7 +1,11 @@
 import datetime
 
+from django.db.models import Q
+
 from haystack import indexes
 from taggit.models import Tag
+from projects.models import Project
+
 from .models import ProjectSheet
 
 
@@ -13,5 +17,30 @@ class ProjectSheetIndex(indexes.SearchIndex, indexes.Indexable):
   def get_model(self):
       return ProjectSheet
   
+  def index_queryset(self, using=None):
+      """Sheets with what the text template and `prepare_tags` read."""
+      return self.get_model().objects.select_related('project') \
+                                     .prefetch_related('project__tags', 'question_answers')
+
+  def build_queryset(self, using=None, start_date=None, end_date=None):
+      """
+      Sheets edited in the dates given, or whose project was, according to
+      their history. Changes of tags and answers are not recorded there:
+      the search queue indexes them as they happen, with their sheet (see
+      bucket.signals.QueuedSignalProcessor).
+      """
+      queryset = self.index_queryset(using=using)
+      if start_date or end_date:
+          sheets = ProjectSheet.history.all()
+          projects = Project.history.all()
+          if start_date:
+              sheets = sheets.filter(history_date__gte=start_date)
+              projects = projects.filter(history_date__gte=start_date)
+          if end_date:
+              sheets = sheets.filter(history_date__lte=end_date)
+              projects = projects.filter(history_date__lte=end_date)
+          queryset = queryset.filter(Q(pk__in=sheets.values('id')) | Q(project__in=projects.values('id')))
+      return queryset
+
   def prepare_tags(self, obj):
       return [tag.name for tag in obj.project.tags.all()]
@@ -0,0 +1,87 @@
+import datetime
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from haystack import connection_router, connections
+
+from bucket import signals
+from bucket.models import Bucket
+from projects.models import Project
+
+from .models import ProjectSheet, ProjectSheetQuestion, ProjectSheetQuestionAnswer, ProjectSheetTemplate
+
+
+class ProjectSheetTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.org', 'secret')
+        self.template = ProjectSheetTemplate.objects.create(name='Template', type='project')
+        self.question = ProjectSheetQuestion.objects.create(template=self.template, text='Why?')
+        self.sheets = [self.sheet('Project %d' % number) for number in range(5)]
+
+    def sheet(self, title):
+        project = Project.objects.create(title=title)
+        return ProjectSheet.objects.create(project=project, template=self.template,
+                                           bucket=Bucket.objects.create(created_by=self.user, name=title))
+
+
+class ReindexTest(ProjectSheetTestCase):
+    def reindex(self, *labels, **options):
+        out = StringIO()
+        call_command('reindex', *labels, stdout=out, **options)
+        return out.getvalue().splitlines()
+
+    def test_chunks(self):
+        lines = self.reindex('projectsheet.projectsheet', batch_size=2, verbosity=2)
+        self.assertEqual([line.strip().split(' objects/s')[0].rsplit(',', 1)[0] for line in lines[:-1]],
+                         ['projectsheet.projectsheet: 2 of 5 objects',
+                          'projectsheet.projectsheet: 4 of 5 objects',
+                          'projectsheet.projectsheet: 5 of 5 objects'])
+        self.assertTrue(lines[-1].startswith("projectsheet.projectsheet: 5 objects indexed on 'default'"))
+
+    def test_since(self):
+        old = datetime.datetime(2010, 1, 1)
+        ProjectSheet.history.all().update(history_date=old)
+        Project.history.all().update(history_date=old)
+        edited = self.sheets[1]
+        edited.videos = ['http://example.org/video']
+        edited.save()
+        project = self.sheets[3].project
+        project.baseline = 'Edited'
+        project.save()
+
+        index = connections['default'].get_unified_index().get_index(ProjectSheet)
+        queryset = index.build_queryset(start_date=datetime.datetime(2015, 1, 1))
+        self.assertEqual(sorted(queryset.values_list('pk', flat=True)), [self.sheets[1].pk, self.sheets[3].pk])
+        self.assertEqual(index.build_queryset(end_date=datetime.datetime(2015, 1, 1)).count(), 5)
+
+        lines = self.reindex('projectsheet.projectsheet', since='2015-01-01', verbosity=1)
+        self.assertTrue(lines[0].startswith("projectsheet.projectsheet: 2 objects indexed"))
+        self.assertRaises(CommandError, self.reindex, since='last week')
+
+    def test_unknown_labels(self):
+        self.assertRaises(CommandError, self.reindex, 'projectsheet.unknown')
+
+
+class AnswerQueueTest(ProjectSheetTestCase):
+    def setUp(self):
+        super(AnswerQueueTest, self).setUp()
+        self.queue = signals.LocalQueue()
+        signals.set_queue(self.queue)
+        with self.settings(SEARCH_QUEUE_FLUSH_ON_REQUEST=False):
+            self.processor = signals.QueuedSignalProcessor(connections, connection_router)
+
+    def tearDown(self):
+        self.processor.teardown()
+        signals.set_queue(None)
+
+    def test_answers_are_indexed_with_their_sheet(self):
+        sheet = self.sheets[0]
+        answer = ProjectSheetQuestionAnswer.objects.create(projectsheet=sheet, question=self.question,
+                                                           answer='Because')
+        self.assertEqual(self.queue.pop(10), [('projectsheet.projectsheet.%s' % sheet.pk, signals.UPDATE)])
+        answer.delete()
+        self.assertEqual(self.queue.pop(10), [('projectsheet.projectsheet.%s' % sheet.pk, signals.UPDATE)])
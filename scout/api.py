@@ -1,26 +1,66 @@
 import base64
+import hashlib
+import json
 import os
 import mimetypes
 
-from pygeocoder import Geocoder
+from django.conf import settings
+from django.conf.urls import url
+from django.core.cache import get_cache
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified
 
-from tastypie import fields
+from tastypie import fields, http
 from tastypie.authorization import Authorization, ReadOnlyAuthorization,\
     DjangoAuthorization
 from tastypie.authentication import ApiKeyAuthentication
 from tastypie.constants import ALL, ALL_WITH_RELATIONS
+from tastypie.exceptions import BadRequest
 from tastypie.contrib.gis.resources import ModelResource as GeoModelResource
 from tastypie.fields import DictField
 from tastypie.resources import ModelResource
+from tastypie.utils import trailing_slash
 
-from dataserver.authorization import GuardianAuthorization
+from base.api import PrefetchRelatedMixin
+from base.events import stream_response
+from dataserver.authorization import GuardianAuthorization, get_resolver
 from dataserver.authentication import AnonymousApiKeyAuthentication
 
 from accounts.api import UserResource
 from bucket.models import Bucket
 
+from .clustering import cluster_markers
+from .geocoding import cached_address
+from .importer import READERS, ImportFileError, MarkerImporter
 from .models import (Map, DataLayer, TileLayer, Marker,
                      MarkerCategory, PostalAddress, Place)
+from .tiles import filter_bounds, filter_tile, get_tile_cache, max_zoom, tile_cache_key, tile_version
+
+
+def parse_bbox(value):
+    """
+    Bounds of a "min_lng,min_lat,max_lng,max_lat" bounding box, for
+    `filter_bounds`. Boxes crossing the antimeridian have min_lng > max_lng.
+    """
+    try:
+        min_x, min_y, max_x, max_y = [float(coordinate) for coordinate in value.split(',')]
+    except ValueError:
+        raise BadRequest("Invalid bbox '%s' provided, expected min_lng,min_lat,max_lng,max_lat." % value)
+    if not (-180 <= min_x <= 180 and -180 <= max_x <= 180 and -90 <= min_y <= max_y <= 90):
+        raise BadRequest("Invalid bbox '%s' provided, coordinates out of range." % value)
+    return min_x, min_y, max_x, max_y
+
+
+# Invalid rows listed in import responses
+MAX_REPORTED_ERRORS = 1000
+
+
+def embed_markers(bundle):
+    """
+    Markers are embedded in data layers unless asked otherwise with
+    ``markers=0``: clients loading them by viewport do not need them.
+    """
+    return bundle.request.GET.get('markers') != '0'
 
 class MapAuthorization(GuardianAuthorization):
     def __init__(self):
@@ -31,14 +71,26 @@ class MapAuthorization(GuardianAuthorization):
             delete_permission_code="delete_map"
         )
 
-    def read_detail(self, object_list, bundle):
-        for obj in object_list:
-            if obj.privacy != 'GROUP_RW_OTHERS_RO':
-                return super(MapAuthorization, self).read_detail(object_list, bundle)
+    public = Q(privacy='GROUP_RW_OTHERS_RO')
 
-        return True
+    def read_list(self, object_list, bundle):
+        """
+        Public maps, and the maps the user or their groups can view.
+        """
+        self.generic_base_check(object_list, bundle)
+        return get_resolver(bundle.request).filter_queryset(self.view_permission_code, object_list,
+                                                            public=self.public)
 
-class MapResource(GeoModelResource):
+    def read_detail(self, object_list, bundle):
+        """
+        Public maps are readable without any query, the permissions of the
+        user on other maps are loaded once per request.
+        """
+        if bundle.obj.privacy == 'GROUP_RW_OTHERS_RO':
+            return True
+        return super(MapAuthorization, self).read_detail(object_list, bundle)
+
+class MapResource(PrefetchRelatedMixin, GeoModelResource):
     class Meta:
         queryset = Map.objects.all()
         resource_name = 'scout/map'
@@ -61,6 +113,69 @@ class MapResource(GeoModelResource):
 
         return bundle
 
+    def get_detail(self, request, **kwargs):
+        """
+        Map details, compiled once per map revision: maps are read far more
+        often than they change. Compiled JSON documents are kept in the
+        SCOUT_MAP_DOCUMENTS_CACHE cache, one for anonymous and one for
+        authenticated users (users are serialized differently), and served
+        with a strong ETag.
+        """
+        if self.determine_format(request) != 'application/json' or 'slug' not in kwargs:
+            return super(MapResource, self).get_detail(request, **kwargs)
+        try:
+            map = Map.objects.get(slug=kwargs['slug'])
+        except Map.DoesNotExist:
+            return http.HttpNotFound()
+        self.authorized_read_detail(Map.objects.filter(pk=map.pk), self.build_bundle(obj=map, request=request))
+
+        key = 'scout:map:%s:%s:%s:%s' % (map.pk, map.revision,
+                                         'anonymous' if request.user.is_anonymous() else 'user',
+                                         'markers' if embed_markers(self.build_bundle(request=request)) else 'nomarkers')
+        cache = get_cache(getattr(settings, 'SCOUT_MAP_DOCUMENTS_CACHE', 'default'))
+        document = cache.get(key)
+        if document is None:
+            response = super(MapResource, self).get_detail(request, **kwargs)
+            if response.status_code != 200:
+                return response
+            document = ('"%s"' % hashlib.md5(response.content).hexdigest(), response.content)
+            cache.set(key, document)
+        etag, content = document
+
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/(?P<slug>[\w-]+)/events%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_events'),
+                name="api_map_events"),
+        ]
+
+    def get_events(self, request, **kwargs):
+        """
+        Changes of the layers and markers of the map as they happen, over
+        Server-Sent Events or long-polling (see
+        `base.events.stream_response`).
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            map = Map.objects.get(slug=kwargs['slug'])
+        except Map.DoesNotExist:
+            return http.HttpNotFound()
+        bundle = self.build_bundle(obj=map, request=request)
+        self.authorized_read_detail(Map.objects.filter(pk=map.pk), bundle)
+
+        self.log_throttled_access(request)
+        return stream_response(request, 'scout.map.%s' % map.pk)
+
 
 class MarkerCategoryResource(ModelResource):
     class Meta:
@@ -81,18 +196,148 @@ class TileLayerResource(GeoModelResource):
 
     maps = fields.ToManyField(MapResource, 'maps', null=True)
 
-class DataLayerResource(ModelResource):
+class DataLayerResource(PrefetchRelatedMixin, ModelResource):
     class Meta:
         queryset = DataLayer.objects.all()
         resource_name = 'scout/datalayer'
         authentication = AnonymousApiKeyAuthentication()
         authorization = Authorization()
 
-    markers = fields.ToManyField('scout.api.MarkerResource', 'markers', null=True, full=True)
+    markers = fields.ToManyField('scout.api.MarkerResource', 'markers', null=True, full=True,
+                                 use_in=embed_markers)
     map = fields.ToOneField('scout.api.MapResource', 'map')
     json_mapping = fields.DictField(attribute='json_mapping')
 
-class MarkerResource(GeoModelResource):
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/(?P<pk>\d+)/tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)%s$" % (
+                self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_tile'),
+                name="api_datalayer_tile"),
+            url(r"^(?P<resource_name>%s)/(?P<pk>\d+)/import%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('dispatch_import'),
+                name="api_datalayer_import"),
+        ]
+
+    def dispatch_import(self, request, **kwargs):
+        """
+        Import markers into the data layer from a GeoJSON feature collection
+        or a CSV file (see scout.importer), sent as the request body or as
+        the `file` of a multipart form. The format is given by `type`
+        (geojson or csv), else guessed from the content type or file name.
+        Rows without a category get the `category` parameter (name or id).
+        Returns the number of markers created and the invalid rows::
+
+            {"created": 49990, "error_count": 10, "errors": [{"row": 12, "error": "..."}, ...]}
+        """
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            datalayer = DataLayer.objects.select_related('map').get(pk=kwargs['pk'])
+        except DataLayer.DoesNotExist:
+            return http.HttpNotFound()
+        map_resource = MapResource()
+        map_resource.authorized_update_detail(Map.objects.filter(pk=datalayer.map_id),
+                                              map_resource.build_bundle(obj=datalayer.map, request=request))
+
+        upload = request.FILES.get('file')
+        source = upload if upload is not None else request
+        file_type = request.GET.get('type')
+        if file_type is None:
+            name = upload.name.lower() if upload is not None else ''
+            content_type = upload.content_type if upload is not None else request.META.get('CONTENT_TYPE', '')
+            file_type = 'csv' if name.endswith('.csv') or 'csv' in content_type else 'geojson'
+        if file_type not in READERS:
+            raise BadRequest("Unknown import type '%s'." % file_type)
+
+        importer = MarkerImporter(datalayer, request.user)
+        if request.GET.get('category'):
+            importer.default_category = importer.get_category(request.GET['category'])
+            if importer.default_category is None:
+                raise BadRequest("Unknown category '%s'." % request.GET['category'])
+        try:
+            importer.run(READERS[file_type](source))
+        except ImportFileError as e:
+            raise BadRequest(unicode(e))
+
+        data = {
+            'created': importer.created,
+            'error_count': len(importer.errors),
+            'errors': [{'row': row, 'error': error} for row, error in importer.errors[:MAX_REPORTED_ERRORS]],
+        }
+        self.log_throttled_access(request)
+        if importer.created:
+            response_class = http.HttpCreated
+        else:
+            response_class = http.HttpBadRequest if importer.errors else HttpResponse
+        return self.create_response(request, data, response_class=response_class)
+
+    def build_tile(self, datalayer, z, x, y):
+        """
+        GeoJSON feature collection of the markers of a tile. Below
+        SCOUT_CLUSTER_MAX_ZOOM, markers close to each other are replaced by
+        a cluster feature (``cluster``, ``count`` and ``bbox`` properties).
+        """
+        markers = filter_tile(Marker.objects.filter(datalayer=datalayer), z, x, y)
+        features = []
+        if z < getattr(settings, 'SCOUT_CLUSTER_MAX_ZOOM', 15):
+            cells = cluster_markers(markers, z)
+            features = [{'type': 'Feature',
+                         'geometry': {'type': 'Point', 'coordinates': list(cell['center'])},
+                         'properties': {'cluster': True, 'count': cell['count'], 'bbox': list(cell['bbox'])}}
+                        for cell in cells if cell['count'] > 1]
+            markers = markers.filter(pk__in=[cell['marker'] for cell in cells if cell['count'] == 1])
+        for pk, position, title, category_id in markers.values_list('pk', 'position', 'title', 'category'):
+            features.append({'type': 'Feature', 'id': pk,
+                             'geometry': {'type': 'Point', 'coordinates': [position.x, position.y]},
+                             'properties': {'title': title, 'category': category_id}})
+        return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+    def get_tile(self, request, **kwargs):
+        """
+        Markers of the data layer in the {z}/{x}/{y} tile, as GeoJSON (see
+        `build_tile`). Tiles are cached until one of their markers changes,
+        and sent with an ETag: tiles of maps readable by anyone are public,
+        so that a CDN can keep them for SCOUT_TILES_MAX_AGE seconds.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        z, x, y = int(kwargs['z']), int(kwargs['x']), int(kwargs['y'])
+        if z > max_zoom() or x >= 2 ** z or y >= 2 ** z:
+            return http.HttpNotFound()
+        try:
+            datalayer = DataLayer.objects.select_related('map').get(pk=kwargs['pk'])
+        except DataLayer.DoesNotExist:
+            return http.HttpNotFound()
+        map_resource = MapResource()
+        map_resource.authorized_read_detail(Map.objects.filter(pk=datalayer.map_id),
+                                            map_resource.build_bundle(obj=datalayer.map, request=request))
+
+        cache = get_tile_cache()
+        key = tile_cache_key(datalayer.pk, tile_version(datalayer.pk), z, x, y)
+        tile = cache.get(key)
+        if tile is None:
+            content = self.build_tile(datalayer, z, x, y)
+            tile = ('"%s"' % hashlib.md5(content).hexdigest(), content)
+            cache.set(key, tile)
+        etag, content = tile
+
+        self.log_throttled_access(request)
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = '%s, max-age=%d' % (
+            'public' if datalayer.map.privacy == 'GROUP_RW_OTHERS_RO' else 'private',
+            getattr(settings, 'SCOUT_TILES_MAX_AGE', 60))
+        return response
+
+class MarkerResource(PrefetchRelatedMixin, GeoModelResource):
     class Meta:
         queryset = Marker.objects.all()
         resource_name = 'scout/marker'
@@ -104,15 +349,113 @@ class MarkerResource(GeoModelResource):
     created_by = fields.ToOneField(UserResource, 'created_by', full=True)
     category = fields.ToOneField(MarkerCategoryResource, 'category', full=True)
 
+    def build_filters(self, filters=None):
+        """
+        Markers can be filtered by `map` (slug), `datalayer` (id) and `bbox`
+        (min_lng,min_lat,max_lng,max_lat), the latter using the spatial
+        index of the positions (see `filter_bounds`).
+        """
+        if filters is None:
+            filters = {}
+        orm_filters = super(MarkerResource, self).build_filters(filters)
+        if 'map' in filters:
+            orm_filters['datalayer__map__slug'] = filters['map']
+        if 'datalayer' in filters:
+            try:
+                orm_filters['datalayer'] = int(filters['datalayer'])
+            except ValueError:
+                raise BadRequest("Invalid datalayer '%s' provided." % filters['datalayer'])
+        if 'bbox' in filters:
+            # Not an ORM lookup, see apply_filters
+            orm_filters['bbox'] = parse_bbox(filters['bbox'])
+        return orm_filters
+
+    def apply_filters(self, request, applicable_filters):
+        bbox = applicable_filters.pop('bbox', None)
+        objects = super(MarkerResource, self).apply_filters(request, applicable_filters)
+        if bbox is not None:
+            objects = filter_bounds(objects, bbox)
+        return objects
+
+    def prepend_urls(self):
+        return [
+            url(r"^(?P<resource_name>%s)/viewport%s$" % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('get_viewport'),
+                name="api_marker_viewport"),
+        ]
+
+    def get_viewport(self, request, **kwargs):
+        """
+        Markers of a map view: requires `bbox` and `zoom`, accepts the
+        filters of the list. Below SCOUT_CLUSTER_MAX_ZOOM, markers close to
+        each other are aggregated::
+
+            {"zoom": 5,
+             "clusters": [{"count": 12, "position": {"type": "Point", "coordinates": [lng, lat]},
+                           "bbox": [min_lng, min_lat, max_lng, max_lat]}, ...],
+             "markers": [markers alone in their cell, as in the list],
+             "truncated": false}
+
+        From SCOUT_CLUSTER_MAX_ZOOM on, every marker of the box is in
+        `markers`. Clusters and markers are each limited to
+        SCOUT_VIEWPORT_MAX_FEATURES, the biggest clusters and the first
+        markers by id being kept: `truncated` is then true, and the client
+        should zoom in.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if 'bbox' not in request.GET:
+            raise BadRequest("A bbox is required.")
+        try:
+            zoom = int(request.GET['zoom'])
+        except (KeyError, ValueError):
+            raise BadRequest("A zoom level is required.")
+
+        objects = self.apply_filters(request, self.build_filters(request.GET))
+        bundle = self.build_bundle(request=request)
+        objects = self.authorized_read_list(objects, bundle)
+
+        limit = getattr(settings, 'SCOUT_VIEWPORT_MAX_FEATURES', 1000)
+        clusters = []
+        truncated = False
+        if zoom < getattr(settings, 'SCOUT_CLUSTER_MAX_ZOOM', 15):
+            cells = cluster_markers(objects, zoom)
+            groups = sorted((cell for cell in cells if cell['count'] > 1), key=lambda cell: -cell['count'])
+            clusters = [{'count': cell['count'],
+                         'position': {'type': 'Point', 'coordinates': list(cell['center'])},
+                         'bbox': list(cell['bbox'])}
+                        for cell in groups[:limit]]
+            alone = sorted(cell['marker'] for cell in cells if cell['count'] == 1)
+            truncated = len(groups) > limit or len(alone) > limit
+            objects = objects.filter(pk__in=alone[:limit])
+        markers = list(objects.order_by('pk')[:limit + 1])
+        if len(markers) > limit:
+            markers = markers[:limit]
+            truncated = True
+
+        data = {
+            'zoom': zoom,
+            'clusters': clusters,
+            'markers': [self.full_dehydrate(self.build_bundle(obj=obj, request=request), for_list=True)
+                        for obj in markers],
+            'truncated': truncated,
+        }
+        self.log_throttled_access(request)
+        return self.create_response(request, data)
+
     def hydrate(self, bundle, request=None):
         if not bundle.obj.pk:
             bundle.data['created_by'] = bundle.request.user
 
-        # Resolve position
-        position = bundle.data['position']['coordinates']
-        geo_results = Geocoder.reverse_geocode(position[0], position[1])
-        if len(geo_results) > 0:
-            bundle.data['address'] = geo_results[0]
+        # Address of new or moved markers, from the geocoding cache or
+        # filled later (see scout.geocoding)
+        if 'address' not in bundle.data and 'position' in bundle.data:
+            lng, lat = bundle.data['position']['coordinates'][:2]
+            position = bundle.obj.position
+            if not bundle.obj.pk or position is None or (position.x, position.y) != (lng, lat):
+                bundle.data['address'] = cached_address(lng, lat) or ''
 
         return bundle
 
@@ -125,7 +468,7 @@ class PostalAddressResource(ModelResource):
         authorization = DjangoAuthorization()
 
 
-class PlaceResource(GeoModelResource):
+class PlaceResource(PrefetchRelatedMixin, GeoModelResource):
     class Meta:
         queryset = Place.objects.all()
         resource_name = 'scout/place'
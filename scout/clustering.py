@@ -0,0 +1,74 @@
+"""
+Grid clustering of markers, for maps seen at low zoom levels.
+
+Markers are grouped by square cells of CLUSTER_CELL_PIXELS pixels at the
+requested zoom level (in degrees, as on a web mercator map at the
+equator). On PostGIS the grouping runs in the database, so only one row per
+cell is fetched; other databases group the marker positions in Python.
+"""
+import math
+
+from django.db import connection
+
+from .models import Marker
+
+TILE_PIXELS = 256
+CLUSTER_CELL_PIXELS = 64
+
+
+def cell_size(zoom):
+    """
+    Size of a cluster cell in degrees at `zoom`.
+    """
+    return 360.0 / (2 ** zoom) * CLUSTER_CELL_PIXELS / TILE_PIXELS
+
+
+def _cluster_in_database(markers, size):
+    qn = connection.ops.quote_name
+    sql, params = markers.order_by().values('pk').query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT COUNT(*), AVG(ST_X(geom)), AVG(ST_Y(geom)),
+               MIN(ST_X(geom)), MIN(ST_Y(geom)), MAX(ST_X(geom)), MAX(ST_Y(geom)), MIN(id)
+        FROM (SELECT %(pk)s AS id, %(position)s::geometry AS geom
+              FROM %(table)s WHERE %(pk)s IN (%(markers)s)) AS markers
+        GROUP BY FLOOR(ST_X(geom) / %%s), FLOOR(ST_Y(geom) / %%s)
+    """ % {
+        'pk': qn(Marker._meta.pk.column),
+        'position': qn(Marker._meta.get_field('position').column),
+        'table': qn(Marker._meta.db_table),
+        'markers': sql,
+    }, tuple(params) + (size, size))
+    return [{'count': count, 'center': (x, y), 'bbox': (min_x, min_y, max_x, max_y), 'marker': marker_id}
+            for count, x, y, min_x, min_y, max_x, max_y, marker_id in cursor.fetchall()]
+
+
+def _cluster_in_python(markers, size):
+    cells = {}
+    for pk, position in markers.order_by().values_list('pk', 'position'):
+        cells.setdefault((math.floor(position.x / size), math.floor(position.y / size)), []) \
+             .append((pk, position.x, position.y))
+    clusters = []
+    for points in cells.values():
+        xs = [x for pk, x, y in points]
+        ys = [y for pk, x, y in points]
+        clusters.append({
+            'count': len(points),
+            'center': (sum(xs) / len(xs), sum(ys) / len(ys)),
+            'bbox': (min(xs), min(ys), max(xs), max(ys)),
+            'marker': min(pk for pk, x, y in points),
+        })
+    return clusters
+
+
+def cluster_markers(markers, zoom):
+    """
+    Group the `markers` queryset by cells at `zoom`, and return one dict per
+    cell: marker `count`, `center` (mean position), `bbox` of the markers
+    (zooming to it splits the cluster) and lowest `marker` id (the marker
+    itself for cells of one marker).
+    """
+    size = cell_size(zoom)
+    if getattr(connection.ops, 'postgis', False):
+        return _cluster_in_database(markers, size)
+    return _cluster_in_python(markers, size)
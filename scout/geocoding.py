@@ -0,0 +1,188 @@
+"""
+Geocoding of postal addresses, and reverse geocoding of markers.
+
+Lookups never call the provider in the request: results are kept in a
+persistent cache (GeocodingCache), keyed on the normalized address or on
+the coordinates rounded to SCOUT_GEOCODING_PRECISION decimals, and misses
+are queued as GeocodingTasks. The `process_geocoding` command resolves the
+queue with the provider named by SCOUT_GEOCODING_PROVIDER, at most
+SCOUT_GEOCODING_RATE_LIMIT lookups per second and once per key, then fills
+the places and markers waiting for them.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.contrib.gis.geos import Point
+from django.utils.module_loading import import_by_path
+
+from .models import GeocodingCache, GeocodingTask, Marker, Place, bump_map_revision
+
+logger = logging.getLogger(__name__)
+
+ADDRESS = 'address'
+REVERSE = 'reverse'
+
+
+class GoogleProvider(object):
+    """
+    Google Maps geocoding API, through geopy.
+    """
+    def __init__(self):
+        from geopy.geocoders import GoogleV3
+        self.geolocator = GoogleV3(api_key=getattr(settings, 'GOOGLE_API_KEY', None))
+
+    def geocode(self, address):
+        location = self.geolocator.geocode(address)
+        return (location.longitude, location.latitude) if location else None
+
+    def reverse(self, lng, lat):
+        location = self.geolocator.reverse((lat, lng), exactly_one=True)
+        return location.address if location else None
+
+
+class DummyProvider(object):
+    """
+    Offline provider, for tests and development: addresses are looked up in
+    SCOUT_GEOCODING_DUMMY_ADDRESSES ({address: (lng, lat)}), positions are
+    "reverse geocoded" to their coordinates.
+    """
+    def __init__(self):
+        self.addresses = dict((normalize_address(address), position) for address, position
+                              in getattr(settings, 'SCOUT_GEOCODING_DUMMY_ADDRESSES', {}).items())
+
+    def geocode(self, address):
+        return self.addresses.get(normalize_address(address))
+
+    def reverse(self, lng, lat):
+        return u"%s, %s" % (lat, lng)
+
+
+def get_provider():
+    return import_by_path(getattr(settings, 'SCOUT_GEOCODING_PROVIDER', 'scout.geocoding.GoogleProvider'))()
+
+
+def normalize_address(address):
+    return u" ".join(address.lower().split())[:255]
+
+
+def reverse_key(lng, lat):
+    precision = getattr(settings, 'SCOUT_GEOCODING_PRECISION', 4)
+    return "%.*f,%.*f" % (precision, lat, precision, lng)
+
+
+def cached_address(lng, lat):
+    """
+    Address of a position if it is in the cache, else None.
+    """
+    cached = GeocodingCache.objects.filter(kind=REVERSE, key=reverse_key(lng, lat)).first()
+    return cached.address if cached is not None and cached.found else None
+
+
+def _apply(cached, object_ids):
+    if not cached.found:
+        return
+    if cached.kind == ADDRESS:
+        Place.objects.filter(pk__in=object_ids).update(geo=cached.position)
+    else:
+        # Unless an address was given meanwhile
+        if Marker.objects.filter(pk__in=object_ids, address='').update(address=cached.address):
+            bump_map_revision(datalayers__markers__pk__in=object_ids)
+
+
+def _geocode(kind, key, object_id):
+    # A newer lookup replaces the pending one of the object
+    GeocodingTask.objects.filter(kind=kind, object_id=object_id).delete()
+    cached = GeocodingCache.objects.filter(kind=kind, key=key).first()
+    if cached is None:
+        GeocodingTask.objects.create(kind=kind, key=key, object_id=object_id)
+    else:
+        _apply(cached, [object_id])
+
+
+def geocode_place(place, address):
+    """
+    Position `place` at `address`, from the cache or once the lookup is
+    processed.
+    """
+    key = normalize_address(address)
+    if key:
+        _geocode(ADDRESS, key, place.pk)
+
+
+def reverse_geocode_marker(marker):
+    """
+    Fill the address of `marker` from its position, from the cache or once
+    the lookup is processed.
+    """
+    if marker.position is not None:
+        _geocode(REVERSE, reverse_key(marker.position.x, marker.position.y), marker.pk)
+
+
+def queue_reverse_geocoding(markers):
+    """
+    Queue the reverse geocoding of (pk, position) `markers`, e.g. after a
+    bulk_create: cached addresses are applied by `process_queue` too.
+    """
+    GeocodingTask.objects.bulk_create([
+        GeocodingTask(kind=REVERSE, key=reverse_key(position.x, position.y), object_id=pk)
+        for pk, position in markers
+    ])
+
+
+def _lookup(provider, kind, key):
+    if kind == ADDRESS:
+        position = provider.geocode(key)
+        return GeocodingCache(kind=kind, key=key, position=Point(*position, srid=4326) if position else None)
+    lat, lng = [float(coordinate) for coordinate in key.split(',')]
+    return GeocodingCache(kind=kind, key=key, address=provider.reverse(lng, lat) or '')
+
+
+def process_queue(provider=None, limit=None):
+    """
+    Resolve the queued lookups, oldest first, and fill the objects waiting
+    for them. At most `limit` distinct lookups are processed. Failed lookups
+    are retried up to SCOUT_GEOCODING_MAX_ATTEMPTS times. Return the number
+    of lookups processed.
+    """
+    provider = provider or get_provider()
+    interval = 1.0 / getattr(settings, 'SCOUT_GEOCODING_RATE_LIMIT', 10)
+    max_attempts = getattr(settings, 'SCOUT_GEOCODING_MAX_ATTEMPTS', 3)
+    last_call = 0
+    processed = 0
+
+    seen = set()
+    for kind, key in GeocodingTask.objects.order_by('pk').values_list('kind', 'key').iterator():
+        if (kind, key) in seen:
+            continue
+        if limit is not None and len(seen) >= limit:
+            break
+        seen.add((kind, key))
+        tasks = GeocodingTask.objects.filter(kind=kind, key=key)
+
+        cached = GeocodingCache.objects.filter(kind=kind, key=key).first()
+        if cached is None:
+            time.sleep(max(0, last_call + interval - time.time()))
+            last_call = time.time()
+            try:
+                cached = _lookup(provider, kind, key)
+            except Exception:
+                logger.warning("Geocoding of %s '%s' failed", kind, key, exc_info=True)
+                tasks.update(attempts=F('attempts') + 1)
+                tasks.filter(attempts__gte=max_attempts).delete()
+                continue
+            try:
+                with transaction.atomic():
+                    cached.save()
+            except IntegrityError:
+                # Looked up concurrently
+                cached = GeocodingCache.objects.get(kind=kind, key=key)
+
+        with transaction.atomic():
+            object_ids = list(tasks.values_list('object_id', flat=True))
+            _apply(cached, object_ids)
+            tasks.filter(object_id__in=object_ids).delete()
+        processed += 1
+    return processed
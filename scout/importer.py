@@ -0,0 +1,168 @@
+"""
+Bulk import of markers into a data layer, from GeoJSON or CSV.
+
+Rows are validated in batches of `chunk_size`, valid markers of a batch are
+created with a single bulk_create, and invalid rows are reported with their
+number instead of failing the import. Markers imported without an address
+are queued for reverse geocoding (see scout.geocoding) rather than looked
+up during the import.
+
+CSV files need a header with `lng` and `lat` (or `longitude`/`latitude`)
+columns; GeoJSON features need a Point geometry. Other columns, or feature
+properties, may be: title, subtitle, description, address, category (name or
+id of a category of the map), picture_url and video_src.
+"""
+import codecs
+import csv
+import json
+
+from django.contrib.gis.geos import Point
+from django.db import transaction
+
+from base import events
+
+from .geocoding import queue_reverse_geocoding
+from .models import Marker, bump_map_revision
+from .tiles import bump_tile_version
+
+TEXT_FIELDS = ('title', 'subtitle', 'description', 'address', 'picture_url', 'video_src')
+MAX_LENGTHS = {'title': 255, 'subtitle': 255, 'picture_url': 255}
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+def read_csv(fp):
+    """
+    Yield the (row number, properties) of a CSV file, positions being read
+    from the `lng`/`lat` or `longitude`/`latitude` columns.
+    """
+    reader = csv.DictReader(fp)
+    if not reader.fieldnames:
+        raise ImportFileError("Empty CSV file.")
+    for number, row in enumerate(reader, 1):
+        row = dict((name.lstrip(codecs.BOM_UTF8).strip().lower(),
+                    value.decode('utf-8') if isinstance(value, str) else value)
+                   for name, value in row.items() if name)
+        row['lng'] = row.pop('longitude', row.get('lng'))
+        row['lat'] = row.pop('latitude', row.get('lat'))
+        yield number, row
+
+
+def read_geojson(fp):
+    """
+    Yield the (feature number, properties) of a GeoJSON feature collection,
+    with the `lng` and `lat` of Point features. The document is parsed at
+    once, unlike CSV files which are read row by row: very large imports
+    are better sent as CSV.
+    """
+    try:
+        data = json.load(fp)
+    except ValueError:
+        raise ImportFileError("Invalid JSON.")
+    if not isinstance(data, dict) or data.get('type') != 'FeatureCollection':
+        raise ImportFileError("A GeoJSON FeatureCollection is expected.")
+    for number, feature in enumerate(data.get('features') or [], 1):
+        row = dict(feature.get('properties') or {}) if isinstance(feature, dict) else {}
+        geometry = feature.get('geometry') if isinstance(feature, dict) else None
+        if geometry and geometry.get('type') == 'Point' and len(geometry.get('coordinates') or ()) >= 2:
+            row['lng'], row['lat'] = geometry['coordinates'][:2]
+        else:
+            row['lng'] = row['lat'] = None
+        yield number, row
+
+
+READERS = {
+    'csv': read_csv,
+    'geojson': read_geojson,
+}
+
+
+class MarkerImporter(object):
+    """
+    Import rows into `datalayer`, created by `user`. Rows without a category
+    get `default_category` (a category of the map), if any.
+    """
+    chunk_size = 1000
+
+    def __init__(self, datalayer, user, default_category=None, chunk_size=None):
+        self.datalayer = datalayer
+        self.user = user
+        self.default_category = default_category
+        if chunk_size:
+            self.chunk_size = chunk_size
+        categories = list(datalayer.map.marker_categories.all())
+        self.categories_by_id = dict((unicode(category.pk), category) for category in categories)
+        self.categories_by_name = dict((category.name.strip().lower(), category) for category in categories)
+        self.created = 0
+        self.errors = []
+
+    def get_category(self, value):
+        if value in (None, ''):
+            return self.default_category
+        value = unicode(value).strip()
+        return self.categories_by_name.get(value.lower()) or self.categories_by_id.get(value)
+
+    def build_marker(self, row):
+        """
+        Return the marker of `row`, or raise ValueError.
+        """
+        try:
+            lng, lat = float(row.get('lng')), float(row.get('lat'))
+        except (TypeError, ValueError):
+            raise ValueError("Missing or invalid coordinates.")
+        if not (-180 <= lng <= 180 and -90 <= lat <= 90):
+            raise ValueError("Coordinates out of range.")
+
+        category = self.get_category(row.get('category'))
+        if category is None:
+            raise ValueError("Unknown category '%s'." % (row.get('category') or ''))
+
+        values = {}
+        for name in TEXT_FIELDS:
+            value = row.get(name)
+            value = u'' if value is None else unicode(value).strip()
+            if name in MAX_LENGTHS and len(value) > MAX_LENGTHS[name]:
+                raise ValueError("%s is longer than %d characters." % (name, MAX_LENGTHS[name]))
+            values[name] = value
+        # Nullable columns
+        for name in ('title', 'subtitle', 'description', 'video_src'):
+            values[name] = values[name] or None
+
+        return Marker(position=Point(lng, lat, srid=4326), datalayer=self.datalayer,
+                      created_by=self.user, category=category, **values)
+
+    def save_chunk(self, markers):
+        with transaction.atomic():
+            last_pk = Marker.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            Marker.objects.bulk_create(markers)
+            # bulk_create does not set the primary keys
+            queue_reverse_geocoding(Marker.objects.filter(datalayer=self.datalayer, pk__gt=last_pk, address='')
+                                                  .values_list('pk', 'position'))
+        # One cache operation, rather than one per marker and zoom level
+        bump_tile_version(self.datalayer.pk)
+        self.created += len(markers)
+
+    def run(self, rows):
+        """
+        Import the (row number, properties) `rows`. Return the number of
+        markers created; invalid rows are in `errors`, as (row number,
+        message) tuples.
+        """
+        chunk = []
+        for number, row in rows:
+            try:
+                chunk.append(self.build_marker(row))
+            except ValueError as e:
+                self.errors.append((number, unicode(e)))
+            if len(chunk) >= self.chunk_size:
+                self.save_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.save_chunk(chunk)
+        if self.created:
+            bump_map_revision(pk=self.datalayer.map_id)
+            events.publish('scout.map.%s' % self.datalayer.map_id, kind='datalayer', id=self.datalayer.pk,
+                           action='changed')
+        return self.created
@@ -0,0 +1,57 @@
+import os
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from scout.importer import READERS, ImportFileError, MarkerImporter
+from scout.models import DataLayer
+
+
+class Command(BaseCommand):
+    args = "<datalayer id> <file>"
+    help = "Import markers into a data layer from a GeoJSON feature collection or a CSV file."
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='user', default=None,
+                    help="Username of the creator of the markers (default: the creator of the map)."),
+        make_option('--type', dest='type', default=None, choices=sorted(READERS),
+                    help="File type: csv or geojson (default: from the file extension)."),
+        make_option('--category', dest='category', default=None,
+                    help="Name or id of the category of rows without one."),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=None,
+                    help="Number of markers created per query."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Expected a data layer id and a file.")
+        try:
+            datalayer = DataLayer.objects.select_related('map').get(pk=args[0])
+        except (DataLayer.DoesNotExist, ValueError):
+            raise CommandError("Unknown data layer '%s'." % args[0])
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user '%s'." % options['user'])
+        else:
+            user = datalayer.map.created_by
+        file_type = options['type'] or ('csv' if args[1].lower().endswith('.csv') else 'geojson')
+
+        importer = MarkerImporter(datalayer, user, chunk_size=options['chunk_size'])
+        if options['category']:
+            importer.default_category = importer.get_category(options['category'])
+            if importer.default_category is None:
+                raise CommandError("Unknown category '%s'." % options['category'])
+
+        if not os.path.exists(args[1]):
+            raise CommandError("No such file '%s'." % args[1])
+        with open(args[1], 'rb') as fp:
+            try:
+                importer.run(READERS[file_type](fp))
+            except ImportFileError as e:
+                raise CommandError(unicode(e))
+
+        for row, error in importer.errors:
+            self.stderr.write("Row %d: %s" % (row, error))
+        self.stdout.write("%d markers created, %d invalid rows" % (importer.created, len(importer.errors)))
@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from scout.geocoding import process_queue
+
+
+class Command(BaseCommand):
+    help = "Resolve the queued geocoding lookups and fill the places and markers waiting for them."
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help="Maximum number of lookups to process."),
+        make_option('--loop', type='int', dest='loop', default=None, metavar='SECONDS',
+                    help="Keep processing the queue, checking it every SECONDS when empty."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        while True:
+            processed = process_queue(limit=options['limit'])
+            if verbosity > 1 or (processed and verbosity > 0):
+                self.stdout.write("%d lookups processed" % processed)
+            if options['loop'] is None:
+                break
+            if not processed:
+                time.sleep(options['loop'])
@@ -1,20 +1,27 @@
 import os
+import operator
 
 from django.dispatch import receiver
-from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db import models
-from django.contrib.gis.geos import GEOSGeometry
 from django.core.urlresolvers import reverse
-from django.db.models.signals import post_save
+from django.db.models import F, Q
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
 from django.utils.translation import ugettext as _
 
 from autoslug import AutoSlugField
 from guardian.shortcuts import assign_perm
 from jsonfield import JSONField
-from geopy.geocoders import Nominatim, GoogleV3
+from taggit.models import Tag, TaggedItem
 
-from bucket.models import Bucket
+from accounts.models import Profile
+from base import events
+from bucket.models import Bucket, BucketFile, Experience
+
+from .tiles import check_tile_cache, invalidate_tiles
+
+check_tile_cache()
 
 
 ## Transitional schema for a postal address
@@ -50,6 +57,41 @@ class Place(models.Model):
     def __unicode__(self):
         return u"%s" % self.address
 
+class GeocodingCache(models.Model):
+    """
+    Result of a geocoding lookup (see scout.geocoding), found or not.
+    """
+    KIND_CHOICES = (
+        ('address', _("Address")),
+        ('reverse', _("Reverse")),
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Normalized address, or rounded "lat,lng" for reverse lookups
+    key = models.CharField(max_length=255)
+    position = models.PointField(null=True, blank=True)
+    address = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    objects = models.GeoManager()
+
+    class Meta:
+        unique_together = ('kind', 'key')
+
+    @property
+    def found(self):
+        return self.position is not None if self.kind == 'address' else bool(self.address)
+
+class GeocodingTask(models.Model):
+    """
+    Lookup waiting for the `process_geocoding` command, with the place
+    (address lookups) or marker (reverse lookups) to fill.
+    """
+    kind = models.CharField(max_length=10, choices=GeocodingCache.KIND_CHOICES)
+    key = models.CharField(max_length=255, db_index=True)
+    object_id = models.PositiveIntegerField()
+    attempts = models.PositiveIntegerField(default=0)
+    created_on = models.DateTimeField(auto_now_add=True)
+
 class TileLayer(models.Model):
     """
     A Tile layer for a given map.
@@ -102,14 +144,21 @@ class Map(models.Model):
     # File container (bucket)
     bucket = models.ForeignKey(Bucket, related_name='map')
 
+    # Bumped by any change of the map or of its content, see
+    # bump_map_revision
+    revision = models.PositiveIntegerField(default=0, editable=False)
+
     objects = models.GeoManager()
 
     def save(self, *args, **kwargs):
-        if self.pk is None:
+        if self._state.adding:
             self.tilelayer = TileLayer.objects.all()[0]
             if not self.bucket:
                 self.bucket = Bucket.objects.create()
-
+        if not self._state.adding and not kwargs.get('force_insert') and 'update_fields' not in kwargs:
+            # Do not write back a revision bumped meanwhile
+            kwargs['update_fields'] = [field.name for field in self._meta.local_fields
+                                       if not field.primary_key and field.name != 'revision']
 
         result = super(Map, self).save(*args, **kwargs)
 
@@ -205,6 +254,148 @@ def allow_user_to_edit_maps(sender, instance, created, *args, **kwargs):
     assign_perm("delete_bucket", user_or_group=instance.created_by, obj=instance.bucket)
 
 
+def bump_map_revision(*args, **lookups):
+    """
+    Bump the revision of the maps matching `lookups`, which outdates their
+    compiled documents (see scout.api.MapResource.get_detail).
+    """
+    Map.objects.filter(*args, **lookups).update(revision=F('revision') + 1)
+
+
+@receiver(post_save, sender=Map)
+def bump_saved_map_revision(sender, instance, **kwargs):
+    bump_map_revision(pk=instance.pk)
+
+
+@receiver(post_save, sender=DataLayer)
+@receiver(post_delete, sender=DataLayer)
+@receiver(post_save, sender=MarkerCategory)
+@receiver(post_delete, sender=MarkerCategory)
+@receiver(post_save, sender=Marker)
+@receiver(post_delete, sender=Marker)
+def publish_map_event(sender, instance, **kwargs):
+    """
+    Tell the clients watching a map that one of its layers, categories or
+    markers changed, and bump its revision.
+    """
+    if sender is Marker:
+        try:
+            map_id = instance.datalayer.map_id
+        except DataLayer.DoesNotExist:
+            # Deleted with its layer, which sends its own event
+            return
+    else:
+        map_id = instance.map_id
+    bump_map_revision(pk=map_id)
+    events.publish('scout.map.%s' % map_id, kind=sender._meta.model_name, id=instance.pk,
+                   action='changed' if 'created' in kwargs else 'deleted')
+
+
+@receiver(post_save, sender=Bucket)
+@receiver(post_save, sender=BucketFile)
+@receiver(post_delete, sender=BucketFile)
+def bump_bucket_map_revision(sender, instance, **kwargs):
+    """
+    Maps embed their bucket and its files.
+    """
+    bump_map_revision(bucket=instance.pk if sender is Bucket else instance.bucket_id)
+
+
+@receiver(post_save, sender=TileLayer)
+def bump_tilelayer_map_revision(sender, instance, **kwargs):
+    bump_map_revision(tilelayer=instance.pk)
+
+
+@receiver(post_save, sender=Experience)
+def bump_experience_map_revision(sender, instance, **kwargs):
+    bump_map_revision(bucket__files__experience=instance.pk)
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def bump_tagged_file_map_revision(sender, instance, **kwargs):
+    """
+    Maps embed the tags of their bucket files.
+    """
+    if instance.content_type_id == ContentType.objects.get_for_model(BucketFile).pk:
+        bump_map_revision(bucket__files=instance.object_id)
+
+
+@receiver(post_save, sender=Tag)
+def bump_renamed_tag_map_revision(sender, instance, created, **kwargs):
+    if not created:
+        bump_map_revision(bucket__files__tags=instance)
+
+
+# Where maps embed users (with their profile and groups)
+MAP_USERS = ('created_by', 'datalayers__markers__created_by',
+             'bucket__files__uploaded_by', 'bucket__files__being_edited_by')
+
+
+def bump_user_map_revision(**lookups):
+    """
+    Bump the revision of the maps embedding the users matching `lookups`.
+    """
+    bump_map_revision(reduce(operator.or_, [Q(**dict(('%s__%s' % (path, lookup), value)
+                                                      for lookup, value in lookups.items()))
+                                            for path in MAP_USERS]))
+
+
+@receiver(post_save, sender=User)
+def bump_saved_user_map_revision(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only change last_login, which is not serialized
+    if created or (update_fields is not None and set(update_fields) == set(['last_login'])):
+        return
+    bump_user_map_revision(pk=instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+def bump_profile_map_revision(sender, instance, created, **kwargs):
+    if not created:
+        bump_user_map_revision(pk=instance.user_id)
+
+
+@receiver(post_save, sender=Group)
+def bump_group_map_revision(sender, instance, created, **kwargs):
+    if not created:
+        bump_user_map_revision(groups=instance.pk)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def bump_user_groups_map_revision(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        bump_user_map_revision(pk=instance.pk)
+    elif action == 'pre_clear':
+        bump_user_map_revision(groups=instance.pk)
+    else:
+        bump_user_map_revision(pk__in=pk_set)
+
+
+def _marker_tile(marker):
+    # A copy, positions can be changed in place
+    return (marker.datalayer_id, marker.position.clone() if marker.position else None)
+
+
+@receiver(post_init, sender=Marker)
+def remember_marker_tile(sender, instance, **kwargs):
+    instance._original_tile = _marker_tile(instance)
+
+
+@receiver(post_save, sender=Marker)
+@receiver(post_delete, sender=Marker)
+def invalidate_marker_tiles(sender, instance, **kwargs):
+    """
+    Drop the cached tiles showing the marker, where it was and where it is.
+    """
+    invalidate_tiles(instance.datalayer_id, instance.position)
+    original = getattr(instance, '_original_tile', None)
+    if original is not None and original != (instance.datalayer_id, instance.position):
+        invalidate_tiles(*original)
+    instance._original_tile = _marker_tile(instance)
+
+
 @receiver(post_save, sender=User)
 def allow_user_to_create_map_via_api(sender, instance, created, *args, **kwargs):
     if created:
@@ -212,6 +403,8 @@ def allow_user_to_create_map_via_api(sender, instance, created, *args, **kwargs)
 
 @receiver(post_save, sender=PostalAddress)
 def geocode_postal_address(sender, instance, created, *args, **kwargs):
+    from .geocoding import geocode_place
+
     places = Place.objects.filter(address=instance)
     if places.count() > 0:
         place = places[0]
@@ -221,11 +414,12 @@ def geocode_postal_address(sender, instance, created, *args, **kwargs):
         place, place_created = Place.objects.get_or_create(address=instance)
 
     if instance.address_locality:
-        try:
-            geolocator = GoogleV3(api_key=settings.GOOGLE_API_KEY)
-            location = geolocator.geocode(instance.address_locality)
-            pnt = GEOSGeometry('POINT(%s %s)' % (location.longitude, location.latitude))
-            place.geo = pnt
-            place.save()
-        except:
-            pass
+        geocode_place(place, instance.address_locality)
+
+
+@receiver(post_save, sender=Marker)
+def geocode_marker_address(sender, instance, **kwargs):
+    from .geocoding import reverse_geocode_marker
+
+    if not instance.address:
+        reverse_geocode_marker(instance)
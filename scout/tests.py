@@ -4,8 +4,26 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
 
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
+
+from tastypie.exceptions import BadRequest
+from tastypie.models import ApiKey
+
+from bucket.models import Bucket
+
+from . import geocoding
+from .api import parse_bbox
+from .models import GeocodingTask, Map, Marker, MarkerCategory, Place, PostalAddress, TileLayer
+from .importer import MarkerImporter
+from .tiles import bump_tile_version, check_tile_cache, filter_bounds, filter_tile, tile_of, tile_version
 
 
 class SimpleTest(TestCase):
@@ -14,3 +32,313 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class MarkerTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.org', 'secret')
+        TileLayer.objects.create(name='OSM', url_template='http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
+                                 attribution='OpenStreetMap')
+        self.map = Map.objects.create(name='Map', privacy='GROUP_RW_OTHERS_RO', center=Point(0, 0),
+                                      created_by=self.user,
+                                      bucket=Bucket.objects.create(created_by=self.user, name='Map'))
+        self.datalayer = self.map.datalayers.all()[0]
+        self.category = MarkerCategory.objects.create(map=self.map, name='Category', icon_name='star',
+                                                      icon_color='white', marker_color='red')
+
+    def marker(self, lng, lat, **kwargs):
+        return Marker.objects.create(position=Point(lng, lat, srid=4326), datalayer=self.datalayer,
+                                     created_by=self.user, category=self.category, **kwargs)
+
+
+class BoundsTest(MarkerTestCase):
+    def within(self, bounds):
+        return sorted(filter_bounds(Marker.objects.all(), bounds).values_list('title', flat=True))
+
+    def test_parse_bbox(self):
+        self.assertEqual(parse_bbox('-1.5,40,2,50.5'), (-1.5, 40, 2, 50.5))
+        for value in ('1,2,3', 'a,b,c,d', '-200,0,0,10', '0,10,10,0'):
+            self.assertRaises(BadRequest, parse_bbox, value)
+
+    def test_boxes_follow_parallels(self):
+        self.marker(-45, 68, title='north')
+        self.marker(-45, 60, title='south')
+        # The great circle between the top corners passes north of 68
+        self.assertEqual(self.within((-90, 0, 0, 66.5)), ['south'])
+
+    def test_boxes_wider_than_180_degrees(self):
+        for number, lng in enumerate((-170, -60, 60, 170)):
+            self.marker(lng, 10, title='%d' % number)
+        self.assertEqual(self.within((-180, -90, 180, 90)), ['0', '1', '2', '3'])
+        self.assertEqual(self.within((-100, 0, 100, 20)), ['1', '2'])
+
+    def test_boxes_crossing_the_antimeridian(self):
+        self.marker(175, 0, title='east')
+        self.marker(-175, 0, title='west')
+        self.marker(0, 0, title='greenwich')
+        self.assertEqual(self.within((170, -10, -170, 10)), ['east', 'west'])
+
+    def test_list_filter(self):
+        self.marker(2.35, 48.85, title='paris')
+        self.marker(-0.13, 51.5, title='london')
+        response = self.client.get(reverse('api_dispatch_list', kwargs={'api_name': 'v0',
+                                                                        'resource_name': 'scout/marker'}),
+                                   {'bbox': '2,48,3,49', 'format': 'json'})
+        self.assertEqual([marker['title'] for marker in json.loads(response.content)['objects']], ['paris'])
+
+
+class TileTest(MarkerTestCase):
+    def tiles(self, marker, z):
+        n = 2 ** z
+        return [(x, y) for x in range(n) for y in range(n)
+                if filter_tile(Marker.objects.filter(pk=marker.pk), z, x, y).exists()]
+
+    def test_markers_are_in_the_tile_they_invalidate(self):
+        for lng, lat in ((-45, 68), (0, 0), (-180, 0), (180, 0), (10, 89.5), (10, -89.5)):
+            marker = self.marker(lng, lat)
+            for z in range(4):
+                self.assertEqual(self.tiles(marker, z), [tile_of(lng, lat, z)], (lng, lat, z))
+
+    def get_tile(self, z, x, y):
+        url = reverse('api_datalayer_tile', kwargs={'api_name': 'v0', 'resource_name': 'scout/datalayer',
+                                                    'pk': self.datalayer.pk, 'z': z, 'x': x, 'y': y})
+        response = self.client.get(url, {'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        return [feature['properties']['title'] for feature in json.loads(response.content)['features']]
+
+    def test_tiles_follow_marker_changes(self):
+        marker = self.marker(-45, 68, title='north')
+        self.assertEqual(self.get_tile(2, 1, 0), ['north'])
+        self.assertEqual(self.get_tile(2, 1, 1), [])
+        marker.position = Point(-45, 60, srid=4326)
+        marker.save()
+        self.assertEqual(self.get_tile(2, 1, 0), [])
+        self.assertEqual(self.get_tile(2, 1, 1), ['north'])
+
+
+    def test_private_maps(self):
+        self.map.privacy = 'GROUP_RW'
+        self.map.save()
+        url = reverse('api_datalayer_tile', kwargs={'api_name': 'v0', 'resource_name': 'scout/datalayer',
+                                                    'pk': self.datalayer.pk, 'z': 0, 'x': 0, 'y': 0})
+        self.assertEqual(self.client.get(url, {'format': 'json'}).status_code, 401)
+        self.client.login(username='alice', password='secret')
+        self.assertEqual(self.client.get(url, {'format': 'json'}).status_code, 200)
+
+    def test_tile_caches_are_shared(self):
+        with self.settings(SCOUT_TILES_CACHE='default', DEBUG=False):
+            self.assertRaises(ImproperlyConfigured, check_tile_cache)
+        with self.settings(SCOUT_TILES_CACHE='default', DEBUG=True):
+            check_tile_cache()
+        check_tile_cache()
+
+    def test_versions(self):
+        version = tile_version(self.datalayer.pk)
+        self.assertEqual(tile_version(self.datalayer.pk), version)
+        bump_tile_version(self.datalayer.pk)
+        self.assertNotEqual(tile_version(self.datalayer.pk), version)
+
+    @override_settings(SCOUT_CLUSTER_MAX_ZOOM=0)
+    def test_imports_refresh_tiles(self):
+        self.marker(-45, 68, title='north')
+        self.assertEqual(self.get_tile(2, 1, 0), ['north'])
+        importer = MarkerImporter(self.datalayer, self.user, default_category=self.category, chunk_size=2)
+        rows = [(number, {'lng': -40 - number, 'lat': 70, 'title': 'imported %d' % number}) for number in range(3)]
+        self.assertEqual(importer.run(rows), 3)
+        self.assertEqual(sorted(self.get_tile(2, 1, 0)), ['imported 0', 'imported 1', 'imported 2', 'north'])
+
+class MapDetailTest(MarkerTestCase):
+    def get_map(self):
+        url = reverse('api_dispatch_detail', kwargs={'api_name': 'v0', 'resource_name': 'scout/map',
+                                                     'slug': self.map.slug})
+        return self.client.get(url, {'format': 'json'})
+
+    def test_private_maps(self):
+        self.map.privacy = 'GROUP_RW'
+        self.map.save()
+        self.assertEqual(self.get_map().status_code, 401)
+        self.client.login(username='alice', password='secret')
+        response = self.get_map()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['name'], 'Map')
+
+    def test_events_of_private_maps(self):
+        self.map.privacy = 'GROUP_RW'
+        self.map.save()
+        url = reverse('api_map_events', kwargs={'api_name': 'v0', 'resource_name': 'scout/map',
+                                                'slug': self.map.slug})
+        params = {'format': 'json', 'poll': 1, 'timeout': 0}
+        self.assertEqual(self.client.get(url, params).status_code, 401)
+        self.client.login(username='alice', password='secret')
+        self.assertEqual(self.client.get(url, params).status_code, 200)
+
+    def test_saving_a_map_with_a_primary_key(self):
+        other = Map(pk=self.map.pk + 100, name='Other', privacy='GROUP_RW', center=Point(0, 0),
+                    created_by=self.user, bucket=self.map.bucket)
+        other.save()
+        self.assertEqual(Map.objects.get(pk=other.pk).name, 'Other')
+
+    def test_documents_follow_nested_changes(self):
+        self.assertEqual(json.loads(self.get_map().content)['tile_layer']['name'], 'OSM')
+        tilelayer = self.map.tilelayer
+        tilelayer.name = 'Renamed'
+        tilelayer.save()
+        self.assertEqual(json.loads(self.get_map().content)['tile_layer']['name'], 'Renamed')
+
+        self.marker(0, 0)
+        revision = Map.objects.get(pk=self.map.pk).revision
+        self.user.first_name = 'Alice'
+        self.user.save()
+        self.assertGreater(Map.objects.get(pk=self.map.pk).revision, revision)
+
+
+class ImportTest(MarkerTestCase):
+    def import_url(self, authenticated=True, **params):
+        url = reverse('api_datalayer_import', kwargs={'api_name': 'v0', 'resource_name': 'scout/datalayer',
+                                                      'pk': self.datalayer.pk})
+        params['format'] = 'json'
+        if authenticated:
+            params.update(username='alice', api_key=ApiKey.objects.get_or_create(user=self.user)[0].key)
+        return '%s?%s' % (url, '&'.join('%s=%s' % item for item in params.items()))
+
+    def titles(self):
+        return sorted(self.datalayer.markers.values_list('title', flat=True))
+
+    def test_geojson(self):
+        features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [2.35, 48.85]},
+                     'properties': {'title': 'paris', 'address': 'Paris'}},
+                    {'type': 'Feature', 'geometry': None, 'properties': {'title': 'nowhere'}}]
+        body = json.dumps({'type': 'FeatureCollection', 'features': features})
+        response = self.client.post(self.import_url(authenticated=False), body, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.post(self.import_url(category='Category'), body, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.content)
+        self.assertEqual((data['created'], data['error_count']), (1, 1))
+        self.assertEqual(data['errors'][0]['row'], 2)
+        self.assertEqual(self.titles(), ['paris'])
+
+    def test_csv(self):
+        upload = SimpleUploadedFile('markers.csv', 'title,longitude,latitude,category,address\n'
+                                                   'paris,2.35,48.85,Category,Paris\n'
+                                                   'london,-0.13,51.5,Unknown,London\n'
+                                                   'rome,12.5,41.9,,Rome\n', content_type='text/csv')
+        response = self.client.post(self.import_url(), {'file': upload})
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.content)
+        self.assertEqual((data['created'], data['error_count']), (1, 2))
+        self.assertEqual(self.titles(), ['paris'])
+
+    def test_invalid_files(self):
+        response = self.client.post(self.import_url(type='geojson'), '{"type": "Feature"}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(self.import_url(type='kml'), '', content_type='application/xml')
+        self.assertEqual(response.status_code, 400)
+
+
+class ViewportTest(MarkerTestCase):
+    def viewport(self, zoom, bbox='-180,-90,180,90'):
+        response = self.client.get(reverse('api_marker_viewport', kwargs={'api_name': 'v0',
+                                                                          'resource_name': 'scout/marker'}),
+                                   {'bbox': bbox, 'zoom': zoom, 'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_clusters(self):
+        self.marker(2.35, 48.85, title='paris')
+        self.marker(2.36, 48.86, title='paris too')
+        self.marker(-0.13, 51.5, title='london')
+        data = self.viewport(5)
+        self.assertEqual([cluster['count'] for cluster in data['clusters']], [2])
+        self.assertEqual([marker['title'] for marker in data['markers']], ['london'])
+        self.assertFalse(data['truncated'])
+
+    @override_settings(SCOUT_VIEWPORT_MAX_FEATURES=2)
+    def test_features_are_limited(self):
+        for number in range(3):
+            self.marker(number, number, title='%d' % number)
+        data = self.viewport(16)
+        self.assertEqual([marker['title'] for marker in data['markers']], ['0', '1'])
+        self.assertTrue(data['truncated'])
+        data = self.viewport(16, '-1,-1,1.5,1.5')
+        self.assertEqual(len(data['markers']), 2)
+        self.assertFalse(data['truncated'])
+
+
+class CountingProvider(geocoding.DummyProvider):
+    def __init__(self):
+        super(CountingProvider, self).__init__()
+        self.lookups = []
+
+    def geocode(self, address):
+        self.lookups.append(address)
+        return super(CountingProvider, self).geocode(address)
+
+    def reverse(self, lng, lat):
+        self.lookups.append((lng, lat))
+        return super(CountingProvider, self).reverse(lng, lat)
+
+
+class FailingProvider(geocoding.DummyProvider):
+    def reverse(self, lng, lat):
+        raise IOError("Geocoding service unavailable")
+
+
+@override_settings(SCOUT_GEOCODING_PROVIDER='scout.geocoding.DummyProvider',
+                   SCOUT_GEOCODING_DUMMY_ADDRESSES={'Paris': (2.3522, 48.8566)},
+                   SCOUT_GEOCODING_RATE_LIMIT=1000, SCOUT_GEOCODING_MAX_ATTEMPTS=2)
+class GeocodingTest(MarkerTestCase):
+    def address(self, marker):
+        return Marker.objects.get(pk=marker.pk).address
+
+    def test_markers_are_geocoded_by_the_queue(self):
+        marker = self.marker(2.35, 48.85)
+        self.assertEqual(self.address(marker), '')
+        self.assertEqual(geocoding.process_queue(), 1)
+        self.assertEqual(self.address(marker), '48.85, 2.35')
+        self.assertFalse(GeocodingTask.objects.exists())
+
+    def test_cached_addresses_are_applied_at_once(self):
+        self.marker(2.35, 48.85)
+        geocoding.process_queue()
+        # Same position once rounded
+        marker = self.marker(2.350001, 48.85)
+        self.assertEqual(self.address(marker), '48.85, 2.35')
+        self.assertEqual(geocoding.cached_address(2.35, 48.85), '48.85, 2.35')
+        self.assertFalse(GeocodingTask.objects.exists())
+
+    def test_positions_are_looked_up_once(self):
+        markers = [self.marker(2.35, 48.85) for number in range(3)]
+        provider = CountingProvider()
+        self.assertEqual(geocoding.process_queue(provider), 1)
+        self.assertEqual(provider.lookups, [(2.35, 48.85)])
+        self.assertEqual([self.address(marker) for marker in markers], ['48.85, 2.35'] * 3)
+
+    def test_given_addresses_are_kept(self):
+        marker = self.marker(2.35, 48.85)
+        Marker.objects.filter(pk=marker.pk).update(address='Place de la Concorde')
+        geocoding.process_queue()
+        self.assertEqual(self.address(marker), 'Place de la Concorde')
+
+    def test_failed_lookups_are_retried(self):
+        marker = self.marker(2.35, 48.85)
+        geocoding.process_queue(FailingProvider())
+        self.assertEqual(GeocodingTask.objects.get().attempts, 1)
+        geocoding.process_queue(FailingProvider())
+        self.assertFalse(GeocodingTask.objects.exists())
+        self.assertEqual(self.address(marker), '')
+
+    def test_places_are_geocoded(self):
+        address = PostalAddress.objects.create(country='FR', address_locality='  paris ')
+        self.assertIsNone(Place.objects.get(address=address).geo)
+        geocoding.process_queue()
+        geo = Place.objects.get(address=address).geo
+        self.assertEqual((geo.x, geo.y), (2.3522, 48.8566))
+
+    def test_unknown_addresses(self):
+        address = PostalAddress.objects.create(country='FR', address_locality='Nowhere')
+        self.assertEqual(geocoding.process_queue(), 1)
+        self.assertIsNone(Place.objects.get(address=address).geo)
+        self.assertFalse(GeocodingTask.objects.exists())
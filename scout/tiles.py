@@ -0,0 +1,186 @@
+"""
+GeoJSON tiles of the markers of a data layer.
+
+Tiles follow the usual web mercator {z}/{x}/{y} scheme. Generated tiles
+are kept in the SCOUT_TILES_CACHE cache, and the tiles holding a marker are
+invalidated, at every zoom level, when it is saved or deleted. Bulk changes
+bump the tile version of the data layer instead, which is part of the
+cache keys of its tiles.
+"""
+import math
+import operator
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.cache import get_cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import Q
+
+MAX_LATITUDE = 85.0511287798
+
+
+def get_tile_cache():
+    return get_cache(getattr(settings, 'SCOUT_TILES_CACHE', 'default'))
+
+
+def check_tile_cache():
+    """
+    Refuse to run with a tile cache private to each process outside
+    development (DEBUG): the other processes would keep serving the tiles
+    and versions invalidated by one of them.
+    """
+    if not settings.DEBUG and isinstance(get_tile_cache(), (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured("SCOUT_TILES_CACHE must be shared by every process (database, "
+                                   "memcached...), not local to one.")
+
+
+def max_zoom():
+    return getattr(settings, 'SCOUT_TILES_MAX_ZOOM', 18)
+
+
+def tile_bounds(z, x, y):
+    """
+    (min_lng, min_lat, max_lng, max_lat) of a tile.
+    """
+    n = 2.0 ** z
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return (x / n * 360.0 - 180.0, latitude(y + 1), (x + 1) / n * 360.0 - 180.0, latitude(y))
+
+
+def _position_geometry(markers):
+    qn = connection.ops.quote_name
+    position = '%s.%s' % (qn(markers.model._meta.db_table),
+                          qn(markers.model._meta.get_field('position').column))
+    # Positions are plain geometries on SpatiaLite (benchmarks)
+    return '%s::geometry' % position if connection.ops.postgis else position
+
+
+def bounds_polygons(bounds):
+    """
+    Polygons of `bounds` (min_lng, min_lat, max_lng, max_lat): two when
+    they cross the antimeridian (min_lng > max_lng).
+    """
+    min_x, min_y, max_x, max_y = bounds
+    if min_x <= max_x:
+        boxes = [bounds]
+    else:
+        boxes = [(min_x, min_y, 180.0, max_y), (-180.0, min_y, max_x, max_y)]
+    polygons = []
+    for box in boxes:
+        polygon = Polygon.from_bbox(box)
+        polygon.srid = 4326
+        polygons.append(polygon)
+    return polygons
+
+
+def filter_bounds(markers, bounds):
+    """
+    Filter the `markers` queryset on the positions within `bounds`
+    (min_lng, min_lat, max_lng, max_lat, edges included), as drawn on a
+    map: positions are compared as geometry, with the index of
+    position::geometry, since the edges of geography polygons are great
+    circles. Bounds with min_lng > max_lng cross the antimeridian.
+
+    Other spatial backends (SpatiaLite, for benchmarks) store plain
+    geometries, filtered with the `contained` lookup.
+    """
+    polygons = bounds_polygons(bounds)
+    if not connection.ops.postgis:
+        return markers.filter(reduce(operator.or_, [Q(position__contained=polygon) for polygon in polygons]))
+
+    envelope = '%s && ST_MakeEnvelope(%%s, %%s, %%s, %%s, 4326)' % _position_geometry(markers)
+    return markers.extra(where=['(%s)' % ' OR '.join([envelope] * len(polygons))],
+                         params=[coordinate for polygon in polygons for coordinate in polygon.extent])
+
+
+def filter_tile(markers, z, x, y):
+    """
+    Filter the `markers` queryset on the positions of a tile, as `tile_of`
+    assigns them, so that a tile holds the markers which invalidate it:
+    tiles hold their west and north edges, and the edge tiles everything up
+    to the antimeridian and the poles.
+    """
+    n = 2 ** z
+    min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+    if y == 0:
+        max_y = 90.0
+    if y == n - 1:
+        min_y = -90.0
+    markers = filter_bounds(markers, (min_x, min_y, max_x, max_y))
+    position = _position_geometry(markers)
+    where, params = [], []
+    if x < n - 1:
+        where.append('ST_X(%s) < %%s' % position)
+        params.append(max_x)
+    if y < n - 1:
+        where.append('ST_Y(%s) > %%s' % position)
+        params.append(min_y)
+    return markers.extra(where=where, params=params) if where else markers
+
+
+def tile_of(lng, lat, z):
+    """
+    (x, y) of the tile holding a position at zoom level `z`.
+    """
+    n = 2 ** z
+    lat = math.radians(max(min(lat, MAX_LATITUDE), -MAX_LATITUDE))
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _version_key(datalayer_id):
+    return 'scout:tile:%s:version' % datalayer_id
+
+
+def tile_version(datalayer_id):
+    """
+    Version of the tiles of a data layer, part of their cache keys.
+    """
+    cache = get_tile_cache()
+    version = cache.get(_version_key(datalayer_id))
+    if version is None:
+        # Lost or new: a version the data layer has not had before
+        cache.add(_version_key(datalayer_id), int(time.time() * 1000))
+        version = cache.get(_version_key(datalayer_id))
+    return version
+
+
+def bump_tile_version(datalayer_id):
+    """
+    Drop every cached tile of a data layer at once, e.g. after a bulk
+    import: their keys change.
+    """
+    cache = get_tile_cache()
+    try:
+        cache.incr(_version_key(datalayer_id))
+    except ValueError:
+        tile_version(datalayer_id)
+
+
+def tile_cache_key(datalayer_id, version, z, x, y):
+    return 'scout:tile:%s:%s:%s:%s:%s' % (datalayer_id, version, z, x, y)
+
+
+def invalidate_tiles(datalayer_id, *positions):
+    """
+    Drop the cached tiles of `datalayer_id` holding `positions`.
+    """
+    positions = [position for position in positions if position is not None]
+    if datalayer_id is None or not positions:
+        return
+    version = tile_version(datalayer_id)
+    keys = set(tile_cache_key(datalayer_id, version, z, *tile_of(position.x, position.y, z))
+               for position in positions
+               for z in range(max_zoom() + 1))
+    cache = get_tile_cache()
+    keys = list(keys)
+    for start in range(0, len(keys), 1000):
+        cache.delete_many(keys[start:start + 1000])
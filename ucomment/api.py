@@ -21,6 +21,8 @@ from tastypie.utils import dict_strip_unicode_keys, trailing_slash
 from tastypie.constants import ALL_WITH_RELATIONS
 from tastypie import http
 
+from base.events import stream_response
+from base.paginator import KeysetPaginator
 from dataserver.authentication import AnonymousApiKeyAuthentication
 from accounts.api import ProfileResource, UserResource
 from accounts.models import Profile
@@ -39,6 +41,7 @@ class CommentResource(ModelResource):
     content_type = fields.CharField(attribute='content_type__model')
     class Meta:
         queryset = Comment.objects.all()
+        paginator_class = KeysetPaginator
         resource_name = 'comment'
         filtering = {
             "comment": ALL_WITH_RELATIONS,
@@ -56,11 +59,41 @@ class CommentResource(ModelResource):
            url(r"^(?P<resource_name>%s)/(?P<content_type>\w+?)/(?P<object_pk>\d+?)%s$" % (self._meta.resource_name, trailing_slash()),
                self.wrap_view('dispatch_list'),
                name="api_dispatch_list"),
+           url(r"^(?P<resource_name>%s)/(?P<content_type>\w+?)/(?P<object_pk>\d+?)/events%s$" % (self._meta.resource_name, trailing_slash()),
+               self.wrap_view('get_events'),
+               name="api_comment_events"),
            url(r"^(?P<resource_name>%s)/(?P<comment_id>\d+?)/flag%s$" % (self._meta.resource_name, trailing_slash()),
                self.wrap_view('flag_ucomment'),
                name="api_flag")
             ]
 
+    def get_events(self, request, **kwargs):
+        """
+        Comments of an object posted or removed, as they happen, over
+        Server-Sent Events or long-polling (see
+        `base.events.stream_response`). Open to the users who may read the
+        comments of the object.
+        """
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        try:
+            content_type = ContentType.objects.get(model=kwargs['content_type'])
+        except (ContentType.DoesNotExist, ContentType.MultipleObjectsReturned):
+            return http.HttpNotFound()
+        model = content_type.model_class()
+        if model is None or not model._default_manager.filter(pk=kwargs['object_pk']).exists():
+            return http.HttpNotFound()
+        # Same check as reading the comments of the object
+        comments = self.get_object_list(request).filter(content_type=content_type, object_pk=kwargs['object_pk'])
+        bundle = self.build_bundle(obj=Comment(content_type=content_type, object_pk=kwargs['object_pk']),
+                                   request=request)
+        self.authorized_read_detail(comments, bundle)
+
+        self.log_throttled_access(request)
+        return stream_response(request, 'comments.%s.%s' % (kwargs['content_type'], kwargs['object_pk']))
+
     def flag_ucomment(self, request, **kwargs):
         """
         Flags a comment on POST request only using method from django_comments view (to bypass csrf protection)
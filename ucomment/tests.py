@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from base import events
+
+
+class CommentEventsTest(TestCase):
+    def setUp(self):
+        events.set_backend(events.InMemoryBackend())
+        self.user = User.objects.create_user('bob', 'bob@example.org', 'secret')
+
+    def tearDown(self):
+        events.set_backend(None)
+
+    def get(self, content_type, object_pk):
+        url = reverse('api_comment_events', kwargs={'api_name': 'v0', 'resource_name': 'comment',
+                                                    'content_type': content_type, 'object_pk': object_pk})
+        return self.client.get(url, {'poll': 1, 'timeout': 0})
+
+    def test_events_of_an_object(self):
+        events.publish('comments.user.%s' % self.user.pk, comment=1)
+        response = self.get('user', self.user.pk)
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_objects(self):
+        self.assertEqual(self.get('unknown', self.user.pk).status_code, 404)
+        self.assertEqual(self.get('user', 9999).status_code, 404)